@@ -1,18 +1,46 @@
 from django.contrib import admin
-from accounts.models import Account, Transaction
+from accounts.models import Account, CurrencyRate, DailyCurrencySummary, QueuedOperation, Transaction
 
 class AccountAdmin(admin.ModelAdmin):
-    list_display = ('number', 'currency', 'creation_date', 'balance')
+    list_display = ('number', 'currency', 'creation_date', 'current_balance', 'shard_count')
+    # Only transactions change it (see Account.save)
+    readonly_fields = ('balance',)
+
+    def get_queryset(self, request):
+        return super(AccountAdmin, self).get_queryset(request).with_shards()
+
+    def current_balance(self, account):
+        return account.current_balance
+    current_balance.admin_order_field = 'current_balance'
 
 
 class TransactionAdmin(admin.ModelAdmin):
     list_display = ('id', 'op_type', 'date', 'source_account', 'dest_account', 'source_amount', 'dest_amount')
+    list_select_related = ('source_acc', 'dest_acc') # fetch the accounts in the same query, not 1 query per row
     def source_account(self,t):
         return t.source_acc.number if t.source_acc else None
     def dest_account(self,t):
         return t.dest_acc.number if t.dest_acc else None
 
 
+class CurrencyRateAdmin(admin.ModelAdmin):
+    list_display = ('source', 'dest', 'rate', 'date', 'fetched_at')
+    list_filter = ('source', 'dest')
+
+
+class DailyCurrencySummaryAdmin(admin.ModelAdmin):
+    list_display = ('day', 'currency', 'inflow', 'outflow', 'deposits', 'withdrawals', 'transactions', 'closing_balance')
+    list_filter = ('currency',)
+    date_hierarchy = 'day'
+
+
+class QueuedOperationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'op_type', 'date', 'source_amount', 'dest_amount', 'transaction_id', 'error', 'processed_date')
+    list_filter = ('status',)
+
+
 admin.site.register(Account, AccountAdmin)
 admin.site.register(Transaction, TransactionAdmin)
-
+admin.site.register(CurrencyRate, CurrencyRateAdmin)
+admin.site.register(DailyCurrencySummary, DailyCurrencySummaryAdmin)
+admin.site.register(QueuedOperation, QueuedOperationAdmin)
@@ -1,92 +1,365 @@
+from django.conf import settings
+from django.conf.urls import url
+from tastypie import http
 from tastypie.resources import ModelResource
 from tastypie.authorization import DjangoAuthorization, Authorization
-from tastypie.authentication import ApiKeyAuthentication
+from tastypie.utils import trailing_slash, dict_strip_unicode_keys
 from tastypie.validation import Validation
-from accounts.models import Account, Transaction, ALLOWED_CURRENCIES
-from accounts.currency import currency_rate
+from accounts.models import Account, Transaction, IdempotencyKey, QueuedOperation, ALLOWED_CURRENCIES, post_transactions, allocate_account_numbers, bulk_create_accounts, history_ids
+from accounts.authentication import CachedApiKeyAuthentication
+from accounts.currency import CurrencyRateError, currency_rate_info, currency_rates
+from accounts.errors import ApiError, api_error
+from accounts.instrumentation import stage
+from accounts.money import parse_amount, convert, quantize_money, quantize_rate
+from accounts.statements import parse_day
+from accounts.summaries import balance_at
+from accounts.transaction_queue import enqueue
+from django.core.exceptions import ValidationError
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import http_date
+from collections import OrderedDict
+import base64
+import calendar
 import datetime
-from decimal import Decimal
-import re
-
-
-ERROR_CODES = {
-    'm_par': 'Missing parameters',
-    'm_destacc': "Missing destination account",
-    'm_srcacc': "Missing source account",
-    'm_am': "Missing amount",
-    'm_cur': "Missing currency",
-    'nf_cur': "Currency not supported",
-    'nf_acc': "Account doesn't exist",
-    'z_srcacc': "Source account would have negative balance",
-    'z_destacc': "Destination account would have negative balance",
-    'no_same': "Can't transfer to same account",
-    'no_number': "Not a valid number",
-    'no_zero': "Amount cannot be zero",
-    'e_netw': "Connection to get currency rates failed",
-}
+import hashlib
+import json
+
 
 def extract_error_code_from_bundle(errors):
     """From a tastypie "errors" dict, return the error code of 1 error message. It returns error code (not message) from our table. It discards other errors if there are >1. It can handle different input formats."""
+    return first_error(errors).code
+
+def first_error(errors):
+    """The ApiError of 1 of the messages in a tastypie "errors" dict"""
     # Normalize errors. The ones from validator are "{transactions: {…}}", the ones from obj_create are "{…}", the ones from models are "{error:…}"
-    # print(type(errors))
-    # print(errors)
     if 'transactions' in errors:
         errors=errors['transactions']
     elif 'accounts' in errors:
         errors=errors['accounts']
     elif 'error' in errors:
         errors=errors['error']
-    # print(type(errors))
-    # print(errors)
     if isinstance(errors,dict):
         # the "errors" dict could have many errors but our response format mandates to tell only one. So we take any of them
-        error_msg=next(iter(errors.values())) # details: https://stackoverflow.com/questions/3097866/access-an-arbitrary-element-in-a-dictionary-in-python
-    elif isinstance(errors,str):
-        error_msg=re.sub("^\['","",errors)
-        error_msg=re.sub("'\]$","",error_msg)
-    else:
+        errors=next(iter(errors.values())) # details: https://stackoverflow.com/questions/3097866/access-an-arbitrary-element-in-a-dictionary-in-python
+    if not isinstance(errors,str):
         raise NotImplementedError()
+    return api_error(errors)
+
+
+def account_number(value):
+    """Account numbers come as strings or ints in the input. Returns the int, or None if it can't be a number"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def accounts_by_number(items):
+    """Fetch, in 1 query, all accounts mentioned as sourceAccount/destAccount in the given input dicts. Returns {number: Account}"""
+    numbers = set()
+    for data in items:
+        numbers.add(account_number(data.get('sourceAccount')))
+        numbers.add(account_number(data.get('destAccount')))
+    numbers.discard(None)
+    if not numbers:
+        return {}
+    with stage('accounts'):
+        return dict((acc.number, acc) for acc in Account.objects.filter(number__in=numbers))
+
+
+class BatchResourceMixin(object):
+    """
+    Adds POST /api/<resource>/batch/ to a resource, to create many objects in 1 request: {"<resource name>": [{…}, {…}, …], "atomic": true}
+    Each element has the same format as in a normal POST. With "atomic": true (default) either all are saved or none. With false, the valid ones are saved and the others are reported.
+    The response has 1 result per element, in the same order, in the same format as for single POSTs.
+    Resources implement save_batch(request, bundles, all_or_nothing), which saves the bundles and adds to bundle.errors the problems of those that can't be saved.
+    """
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/batch%s$" % (self._meta.resource_name, trailing_slash()), self.wrap_view('post_batch'), name="api_%s_batch" % self._meta.resource_name),
+        ]
+
+    def post_batch(self, request, **kwargs):
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        deserialized = self.deserialize(request, request.body, format=request.META.get('CONTENT_TYPE', 'application/json'))
+        items = deserialized.get(self._meta.resource_name) if isinstance(deserialized, dict) else None
+        if not isinstance(items, list) or not items:
+            return self.error_response(request, {'error': ApiError('m_par')})
+        if len(items) > settings.API_BATCH_MAX_SIZE:
+            return self.error_response(request, {'error': ApiError('big_batch')})
+        all_or_nothing = deserialized.get('atomic', True)
+        # Only JSON booleans: "false" (a string) would be true
+        if not isinstance(all_or_nothing, bool):
+            return self.error_response(request, {'error': ApiError('no_atomic')})
+
+        bundles = [self.build_bundle(data=item if isinstance(item, dict) else {}, request=request) for item in items]
+        with stage('save'):
+            self.save_batch(request, bundles, all_or_nothing)
+        failed = any(b.errors for b in bundles)
+
+        results = []
+        for b in bundles:
+            if b.errors:
+                results.append(first_error(b.errors).as_dict())
+            elif failed and all_or_nothing:
+                results.append(ApiError('e_batch').as_dict())
+            else:
+                results.append(self.full_dehydrate(b).data)
+
+        response_class = http.HttpBadRequest if failed and all_or_nothing else http.HttpCreated
+        return self.create_response(request, {'error': failed, 'results': results}, response_class=response_class)
+
+
+class ApiResourceMixin(object):
+    """
+    POST handling and error format shared by our resources.
+    Rejected requests are answered as soon as the problem is found: the input is validated only once, before obj_create, and errors are returned directly, without hydrate/dehydrate and without the exceptions that tastypie would raise and catch (ImmediateHttpResponse, ValidationError).
+    obj_create must expect valid input, and return the bundle with bundle.errors instead of saving if it finds problems.
+    """
+    def post_list(self, request, **kwargs):
+        with stage('validation'):
+            deserialized = self.deserialize(request, request.body, format=request.META.get('CONTENT_TYPE', 'application/json'))
+            deserialized = self.alter_deserialized_detail_data(request, deserialized)
+            bundle = self.build_bundle(data=dict_strip_unicode_keys(deserialized), request=request)
+            valid = self.is_valid(bundle)
+        if not valid:
+            return self.error_response(request, bundle.errors)
+        try:
+            bundle = self.obj_create(bundle, **self.remove_api_resource_names(kwargs))
+        except ValidationError as e:
+            # from the models. Their messages are ApiErrors
+            return self.error_response(request, {'error': e.messages[0]})
+        if bundle.errors:
+            return self.error_response(request, bundle.errors)
+
+        with stage('response'):
+            return self.created_response(request, bundle)
+
+    def created_response(self, request, bundle):
+        """201 with the new object"""
+        bundle = self.full_dehydrate(bundle)
+        bundle = self.alter_detail_data_to_serialize(request, bundle)
+        return self.create_response(request, bundle, response_class=http.HttpCreated, location=self.get_resource_uri(bundle))
+
+    def create_object(self, bundle):
+        """Save the new bundle.obj. Like tastypie's save(), without validating again"""
+        self.authorized_create_detail(self.get_object_list(bundle.request), bundle)
+        with stage('save'):
+            bundle.obj.save()
+        return bundle
 
-    assert isinstance(error_msg,str) # We have 1 and only 1 message
-        
-
-    #import ipdb; ipdb.set_trace()
-
-    codes_for_msg=[k for k,v in ERROR_CODES.items() if v==error_msg] # find key for the given value. It's a dictionary access in reverse. 
-    if len(codes_for_msg)!=1:
-        raise NotImplementedError("Error message '%s' has no short code defined. Check api.py. %s"%(error_msg,codes_for_msg))
-    
-    error_code=codes_for_msg[0]
-
-    return error_code
+    def is_authenticated(self, request):
+        with stage('auth'):
+            return super(ApiResourceMixin, self).is_authenticated(request)
 
+    def error_response(self, request, errors, response_class=None):
+        """Wrap the original error handler in order to change the message format according to the requirements"""
+        # continue normally but with our dict
+        return super(ApiResourceMixin,self).error_response(request, first_error(errors).as_dict(), response_class)
+
+
+def encode_cursor(*values):
+    """Opaque cursor for the "next" link of a list, from the sort keys of its last row (dates as ISO text)"""
+    values = [v.isoformat() if isinstance(v, datetime.datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """The list of values of a cursor. Raises ValidationError if it's not one of ours"""
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError):
+        raise ValidationError(ApiError('no_cursor'))
+
+
+def is_conditional(request):
+    return 'HTTP_IF_NONE_MATCH' in request.META or 'HTTP_IF_MODIFIED_SINCE' in request.META
+
+def validator_headers(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+class ReadResourceMixin(object):
+    """
+    GET /api/<resource>/ (list) and /api/<resource>/<key>/ (detail), read with .values() of only the needed columns, without tastypie's full_dehydrate.
+    - ?fields=a,b returns only those fields (all in read_fields by default)
+    - Lists are sorted by an indexed key and paginated with a cursor (keyset): "next" is the URL of the next page (null at the end). Each page is 1 indexed range read, so the last page costs the same as the first, unlike with OFFSET. ?limit= (up to API_READ_MAX_PAGE_SIZE) changes the page size
+    - Responses have an ETag (and Last-Modified where rows know it), and If-None-Match/If-Modified-Since requests get an empty 304. The ETag is computed from validator_columns only (e.g. the version of each account), so for conditional requests we first read just those and answer 304 without reading or rendering the rest
+    Resources define read_fields (API name → model field, in output order), read_page(request, cursor, size, columns) → dicts of values in list order, cursor_of(row), validator_columns and not_found_error; and optionally last_modified_column.
+    Problems with the parameters are raised as ValidationError(ApiError), like in the models.
+    """
+    read_fields = OrderedDict()
+    cursor_columns = ()
+    validator_columns = () # must change whenever anything in the row changes
+    last_modified_column = None
+    not_found_error = None
+
+    def requested_columns(self, request):
+        """(API names, model columns to read) for ?fields=…"""
+        names = request.GET['fields'].split(',') if request.GET.get('fields') else list(self.read_fields)
+        if any(name not in self.read_fields for name in names):
+            raise ValidationError(ApiError('no_field'))
+        columns = set(self.read_fields[name] for name in names) | set(self.cursor_columns) | set(self.validator_columns)
+        if self.last_modified_column:
+            columns.add(self.last_modified_column)
+        return names, list(columns)
+
+    def validator_column_list(self):
+        return list(set(self.validator_columns) | set([self.last_modified_column] if self.last_modified_column else []))
+
+    def get_list(self, request, **kwargs):
+        try:
+            names, columns = self.requested_columns(request)
+            size = account_number(request.GET.get('limit', settings.API_READ_PAGE_SIZE))
+            if not size or size < 1:
+                raise ValidationError(ApiError('no_number'))
+            size = min(size, settings.API_READ_MAX_PAGE_SIZE)
+            cursor = decode_cursor(request.GET['cursor']) if request.GET.get('cursor') else None
+            # 1 more row than needed tells us whether there's a next page
+            if is_conditional(request):
+                # Cheap check first: only the validator columns of the page
+                not_modified = self.not_modified(request, self.read_page(request, cursor, size + 1, self.validator_column_list()))
+                if not_modified:
+                    return not_modified
+            rows = self.read_page(request, cursor, size + 1, columns)
+        except ValidationError as e:
+            return self.error_response(request, {'error': e.messages[0]})
+        validators = self.validators(request, rows)
+        next_url = None
+        if len(rows) > size:
+            rows = rows[:size]
+            params = request.GET.copy()
+            params['cursor'] = self.cursor_of(rows[-1])
+            next_url = '%s?%s' % (request.path, params.urlencode())
+        data = {'error': False, 'data': [self.row_data(row, names) for row in rows], 'next': next_url}
+        return self.conditional_response(request, data, validators)
+
+    def get_detail(self, request, **kwargs):
+        key = kwargs[self._meta.detail_uri_name]
+        rows = self._meta.queryset.filter(**{self._meta.detail_uri_name: key}) if key.isdigit() else self._meta.queryset.none()
+        try:
+            names, columns = self.requested_columns(request)
+            if is_conditional(request):
+                not_modified = self.not_modified(request, list(rows.values(*self.validator_column_list())))
+                if not_modified:
+                    return not_modified
+            row = rows.values(*columns).first()
+        except ValidationError as e:
+            return self.error_response(request, {'error': e.messages[0]})
+        if row is None:
+            return self.error_response(request, {'error': ApiError(self.not_found_error)}, response_class=http.HttpNotFound)
+        return self.conditional_response(request, {'error': False, 'data': self.row_data(row, names)}, self.validators(request, [row]))
+
+    def row_data(self, row, names):
+        return OrderedDict((name, row[self.read_fields[name]]) for name in names)
+
+    def validators(self, request, rows):
+        """
+        (ETag, Last-Modified timestamp or None) of the response with these rows, from their validator_columns only.
+        The URL (fields, filters, cursor, limit) and the Accept header are part of the ETag: they change the content for the same rows
+        """
+        key = [request.path, request.GET.urlencode(), request.META.get('HTTP_ACCEPT', '')] + [[row[c] for c in self.validator_columns] for row in rows]
+        etag = '"%s"' % hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+        last_modified = None
+        if self.last_modified_column and rows:
+            last_modified = calendar.timegm(max(row[self.last_modified_column] for row in rows).utctimetuple())
+        return etag, last_modified
+
+    def not_modified(self, request, rows):
+        """An empty 304 if the client has the response with these rows already (only validator columns are needed), else None"""
+        if not rows:
+            return None # 404s and empty pages are cheap anyway
+        etag, last_modified = self.validators(request, rows)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified, response=validator_headers(HttpResponse(), etag, last_modified))
+        return response if response.status_code == 304 else None
+
+    def conditional_response(self, request, data, validators):
+        """The response, with the ETag and Last-Modified of validators() (or a 304 if the client has it already: conditional requests which get here were checked with older rows)"""
+        with stage('response'):
+            response = validator_headers(self.create_response(request, data), *validators)
+        return get_conditional_response(request, etag=validators[0], last_modified=validators[1], response=response)
+
+
+ALLOWED_CURRENCY_CODES = frozenset(code for code, name in ALLOWED_CURRENCIES)
+
+def allowed_currency(value):
+    """The currency code if we support it, else None"""
+    return value if isinstance(value, str) and value in ALLOWED_CURRENCY_CODES else None
+
+
+class InputSchema(object):
+    """
+    The fields that the input of a POST must have, and how each one is read.
+    Built once per resource, so checking a request is 1 loop over a tuple. Used by the validators of the resources and by the fast path (see fastpath.py), so both give the same errors
+    """
+    def __init__(self, *fields):
+        # (name, error if it's missing, parser or None, error if the parser returns None)
+        self.fields = tuple((name, ApiError(missing), parser, ApiError(invalid) if parser else None) for name, missing, parser, invalid in fields)
+
+    def errors(self, data):
+        """{field: ApiError} with the problems of data (a dict); empty if it's valid. Parsed values replace the given ones in data"""
+        if not data:
+            return {'__all__': ApiError('m_par')}
+        errors = {}
+        for name, missing, parser, invalid in self.fields:
+            if name not in data:
+                errors[name] = missing
+            elif parser is not None:
+                value = parser(data[name])
+                if value is None:
+                    errors[name] = invalid
+                else:
+                    data[name] = value
+        return errors
 
+ACCOUNT_SCHEMA = InputSchema(
+    ('currency', 'm_cur', allowed_currency, 'nf_cur'),
+)
 
 class AccountInputValidation(Validation):
     def is_valid(self, bundle, request=None):
         """Check validity of input parameters."""
         # This runs at an early step in tastypie
-        errors = {}
-        if not bundle.data:
-            return {'__all__': 'Missing parameters'}
-        if 'currency' not in bundle.data:
-            errors['currency']="Missing currency"
-        elif bundle.data['currency'] not in [k for k,v in ALLOWED_CURRENCIES]:
-            errors['currency']="Currency not supported"
-        return errors
+        return ACCOUNT_SCHEMA.errors(bundle.data)
 
 # e.g. http://127.0.0.1:8000/api/account/?format=json
 # See scripts/api_client_calls.sh to test this
-class AccountResource(ModelResource):
+class AccountResource(ApiResourceMixin, ReadResourceMixin, BatchResourceMixin, ModelResource):
     class Meta:
-        queryset = Account.objects.all()
+        queryset = Account.objects.with_shards() # balance + shards of sharded accounts (see AccountBalanceShard)
         resource_name = 'accounts'
-        authentication = ApiKeyAuthentication() # this requires HTTP header
+        authentication = CachedApiKeyAuthentication() # this requires HTTP header
         authorization = Authorization() # authenticated user can modify everything
         always_return_data = True
         validation = AccountInputValidation()
-        allowed_methods = ['post'] # limit to our requirements
+        list_allowed_methods = ['get', 'post']
+        detail_allowed_methods = ['get']
+        detail_uri_name = 'number' # /api/accounts/12345678/
+
+    # GET (see ReadResourceMixin): sorted by number
+    read_fields = OrderedDict([('accountNumber', 'number'), ('currency', 'currency'), ('balance', 'current_balance'), ('creation_date', 'creation_date')])
+    cursor_columns = ('number',)
+    validator_columns = ('number', 'current_version') # every change of the balance increases the version
+    not_found_error = 'nf_acc'
+
+    def read_page(self, request, cursor, size, columns):
+        accounts = Account.objects.with_shards().order_by('number')
+        if cursor:
+            accounts = accounts.filter(number__gt=account_number(cursor[0]) or 0)
+        return list(accounts.values(*columns)[:size])
 
+    def cursor_of(self, row):
+        return encode_cursor(row['number'])
 
     def dehydrate(self, bundle):
         """Create the appropriate response, e.g. include an "error" attribute in the response"""
@@ -97,138 +370,316 @@ class AccountResource(ModelResource):
         bundle.data={'error':False, 'data':orig_data}
         return bundle
 
-    def error_response(self, request, errors, response_class=None):
-        """Wrap the original error handler in order to change the message format according to the requirements"""
-
-        error_code=extract_error_code_from_bundle(errors)
-
-        errors={"error": True, "code": error_code, "message": ERROR_CODES[error_code]}
-
-        # continue normally but with our dict
-        res=super(AccountResource,self).error_response(request, errors, response_class)
-
-        return res
-
+    def obj_create(self, bundle, **kwargs):
+        """The input was validated already (see ApiResourceMixin). Only the currency can be chosen"""
+        bundle.obj = Account(currency=bundle.data['currency'])
+        return self.create_object(bundle)
+
+    def save_batch(self, request, bundles, all_or_nothing):
+        """See BatchResourceMixin. Account numbers for all new accounts are reserved at once, and accounts are inserted in bulk"""
+        to_save = [b for b in bundles if self.is_valid(b)]
+        if not to_save or (all_or_nothing and len(to_save) < len(bundles)):
+            return
+        for b, number in zip(to_save, allocate_account_numbers(len(to_save))):
+            self.authorized_create_detail(self.get_object_list(request), b)
+            b.obj.currency = b.data['currency']
+            b.obj.number = number
+        bulk_create_accounts([b.obj for b in to_save])
+
+    def prepend_urls(self):
+        return super(AccountResource, self).prepend_urls() + [
+            url(r"^(?P<resource_name>%s)/(?P<number>\d{8})/balance%s$" % (self._meta.resource_name, trailing_slash()), self.wrap_view('get_balance'), name="api_account_balance"),
+        ]
+
+    def get_balance(self, request, number, **kwargs):
+        """
+        GET /api/accounts/<number>/balance/?at=2017-06-02T10:00:00 → the balance the account had at that moment (default: now). A date alone (?at=2017-06-02) means the end of that day.
+        Computed from the daily summaries (see summaries.balance_at), so it doesn't read the whole history
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        at = parse_balance_date(request.GET.get('at'))
+        if at is None:
+            return self.error_response(request, {'error': ApiError('no_date')})
+        account = Account.objects.filter(number=number).first()
+        if account is None:
+            return self.error_response(request, {'error': ApiError('nf_acc')}, response_class=http.HttpNotFound)
+        with stage('balances'):
+            balance = balance_at(account, at)
+        data = {'accountNumber': account.number, 'currency': account.currency, 'balance': quantize_money(balance), 'at': at}
+        return self.create_response(request, {'error': False, 'data': data})
+
+
+def parse_balance_date(value):
+    """?at= of the balance API: now if empty, an ISO datetime (in the current time zone if it has none), or a date (its last instant). None if it's not valid"""
+    if not value:
+        return timezone.now()
+    try:
+        at = parse_datetime(value)
+        if at is None:
+            day = parse_date(value)
+            if day is None:
+                return None
+            at = datetime.datetime.combine(day, datetime.time.max)
+    except ValueError: # well formatted but impossible, e.g. 2017-02-30
+        return None
+    if timezone.is_naive(at):
+        at = timezone.make_aware(at)
+    return at
+
+
+# Amounts are parsed only once: later steps get the Decimal
+TRANSACTION_SCHEMA = InputSchema(
+    ('destAccount', 'm_destacc', None, None),
+    ('sourceAccount', 'm_srcacc', None, None),
+    ('amount', 'm_am', parse_amount, 'no_number'),
+)
 
 class TransactionInputValidation(Validation):
     def is_valid(self, bundle, request=None):
         """This checks basic formats, e.g. the parameters should be present.
         Similar validations are done later in obj_create but they're semantic (e.g. the given accounts must exist)"""
-        if not bundle.data:
-            return {'__all__': 'Missing parameters'}
-
-        errors = {}
-
-        if 'destAccount' not in bundle.data:
-            errors['destAccount']="Missing destination account"
-        if 'sourceAccount' not in bundle.data:
-            errors['sourceAccount']="Missing source account"
-
-        if 'amount' not in bundle.data:
-            errors['amount']="Missing amount"
-        elif isinstance(bundle.data['amount'],(float,int)):
-            pass
-        elif not bundle.data['amount'].replace('.','',1).isdigit():
-            errors['amount']="Not a valid number"
-
-        #print("Returning errors:",errors)
-
-        return errors
+        return TRANSACTION_SCHEMA.errors(bundle.data)
 
 # also see test programs in scripts/
-class TransactionResource(ModelResource):
+class TransactionResource(ApiResourceMixin, ReadResourceMixin, BatchResourceMixin, ModelResource):
     class Meta:
-        queryset = Transaction.objects.all()
+        queryset = Transaction.objects.select_related('source_acc', 'dest_acc')
         resource_name = 'transactions'
-        authentication = ApiKeyAuthentication()
+        authentication = CachedApiKeyAuthentication()
         authorization = Authorization()
         validation = TransactionInputValidation()
         always_return_data = True
-        allowed_methods = ['post'] # limit to our requirements
-
+        list_allowed_methods = ['get', 'post']
+        detail_allowed_methods = ['get']
+
+    # GET (see ReadResourceMixin): newest first. Transactions never change, so Last-Modified is when the newest of the page was created
+    read_fields = OrderedDict([
+        ('transactionId', 'id'), ('date', 'date'), ('op_type', 'op_type'),
+        ('sourceAccount', 'source_acc__number'), ('destAccount', 'dest_acc__number'),
+        ('source_amount', 'source_amount'), ('dest_amount', 'dest_amount'),
+        ('source_balance_after', 'source_balance_after'), ('dest_balance_after', 'dest_balance_after'),
+        ('currency_rate', 'currency_rate'), ('currency_date', 'currency_date'), ('creation_date', 'creation_date'),
+    ])
+    cursor_columns = ('id', 'date')
+    validator_columns = ('id',) # they never change
+    last_modified_column = 'creation_date'
+    not_found_error = 'nf_tr'
+
+    def read_page(self, request, cursor, size, columns):
+        """
+        Filters: ?account=<number> (as source or destination), ?since=YYYY-MM-DD, ?until=YYYY-MM-DD (both days included).
+        With an account, the page is found with history_ids (its (account, date) indexes); without, with the (date, id) index
+        """
+        try:
+            since = parse_day(request.GET.get('since'))
+            until = parse_day(request.GET.get('until'), next_day=True)
+        except ValueError:
+            raise ValidationError(ApiError('no_date'))
+        if cursor:
+            date = parse_datetime(cursor[0]) if len(cursor) == 2 and isinstance(cursor[0], str) else None
+            if date is None or not isinstance(cursor[1], int):
+                raise ValidationError(ApiError('no_cursor'))
+            position = Transaction(id=cursor[1], date=date)
+        else:
+            # right before the day after "until"
+            position = Transaction(id=0, date=until) if until else None
+
+        trans = Transaction.objects.all()
+        if request.GET.get('account'):
+            account = Account.objects.filter(number=account_number(request.GET['account'])).first()
+            if account is None:
+                raise ValidationError(ApiError('nf_acc'))
+            trans = trans.filter(pk__in=history_ids(account, position, size=size))
+        elif position:
+            trans = trans.filter(Q(date__lt=position.date)|Q(date=position.date, id__lt=position.id))
+        if since:
+            trans = trans.filter(date__gte=since)
+        return list(trans.order_by('-date', '-id').values(*columns)[:size])
+
+    def cursor_of(self, row):
+        return encode_cursor(row['date'], row['id'])
+
+    def post_list(self, request, **kwargs):
+        """
+        With an "Idempotency-Key: <any text>" header, the response is stored, and later requests of the same user with the same key get it again without doing anything. So clients can retry safely (e.g. after a timeout) without creating the transaction twice.
+        The transaction and the stored response are saved in the same DB transaction, so if 2 requests with the same key run at the same time, only 1 of them is kept.
+        """
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if key is None:
+            return super(TransactionResource, self).post_list(request, **kwargs)
+        if not 0 < len(key) <= IdempotencyKey._meta.get_field('key').max_length:
+            return self.error_response(request, {'error': ApiError('no_idem')})
+        request_hash = hashlib.sha256(request.body).hexdigest()
+
+        with stage('idempotency'):
+            stored = IdempotencyKey.objects.filter(user=request.user, key=key).first()
+        if stored is None:
+            try:
+                with transaction.atomic():
+                    response = super(TransactionResource, self).post_list(request, **kwargs)
+                    IdempotencyKey.objects.create(user=request.user, key=key, request_hash=request_hash, status_code=response.status_code, content_type=response['Content-Type'], response=response.content.decode('utf-8'))
+                return response
+            except IntegrityError:
+                # Another request with this key was saved first; ours was rolled back
+                stored = IdempotencyKey.objects.get(user=request.user, key=key)
+
+        if stored.request_hash != request_hash:
+            return self.error_response(request, {'error': ApiError('e_idem')}, response_class=http.HttpUnprocessableEntity)
+        response = HttpResponse(stored.response, status=stored.status_code, content_type=stored.content_type)
+        response['Idempotent-Replayed'] = 'true'
+        return response
 
     def obj_create(self, bundle, request=None, **kwargs):
-        """Extend input data to make it match with model data."""
-        #bundle = super(TransactionResource, self).obj_create(bundle, request, user=request.user)
-
-        # Only try to find accounts etc. if the parameters are valid (they exist, valid format, …)
-        if self.is_valid(bundle):
-
-            # Validator already checked this, so our usage is safe
-            assert 'sourceAccount' in bundle.data
-            assert 'destAccount' in bundle.data
-            assert 'amount' in bundle.data
-    
-            # This is what tastypie calls "hydrate": transform text→model. It may get None if we don't find the IDs
-            try:
-                dest_acc=Account.objects.get(number=bundle.data['destAccount'])
-            except Account.DoesNotExist:
-                dest_acc=None
-            try:
-                source_acc=Account.objects.get(number=bundle.data['sourceAccount'])
-            except Account.DoesNotExist:
-                source_acc=None
-            amount=Decimal(bundle.data['amount'])
-
-            if amount==0:
-                bundle.errors['amount']="Amount cannot be zero"
-    
-            # Depending on transaction type, fill some data or other. Also, require different data
-            if bundle.data['sourceAccount'] is None:
-                bundle.obj.op_type='dep'
-                # bundle.data['dest_acc']=bundle.data['destAccount']
-                if not dest_acc:
-                    bundle.errors['destAccount']="Account doesn't exist"
-                bundle.obj.dest_acc=dest_acc
-                bundle.obj.dest_amount=amount
-                bundle.obj.source_acc=None
-                bundle.obj.source_amount=None
-    
-            elif bundle.data['destAccount'] is None:
-                bundle.obj.op_type='wd'
-                if not source_acc:
-                    bundle.errors['sourceAccount']="Account doesn't exist"
-                bundle.obj.source_acc=source_acc
-                bundle.obj.source_amount=amount
-                bundle.obj.dest_acc=None
-                bundle.obj.dest_amount=None
-    
-            elif bundle.data['sourceAccount'] and bundle.data['destAccount']:
-                bundle.obj.op_type='tra'
-                if not dest_acc:
-                    bundle.errors['destAccount']="Account doesn't exist"
-                if not source_acc:
-                    bundle.errors['sourceAccount']="Account doesn't exist"
-                if dest_acc and source_acc and dest_acc==source_acc:
-                    bundle.errors['destAccount']="Can't transfer to same account"
-
-                bundle.obj.source_acc=source_acc
-                bundle.obj.dest_acc=dest_acc
-                # The given amount is always written as source amount. The destination amount, however, can be computed
-                bundle.obj.source_amount=amount
-                if source_acc and dest_acc and source_acc.currency != dest_acc.currency:
-                    #rate=0.5
-                    rate=currency_rate(source_acc.currency,dest_acc.currency)
-                    rate=Decimal(rate)
-                    bundle.obj.dest_amount=amount*rate
-                else:
-                    # same currency (or nulls)
-                    bundle.obj.dest_amount=amount
-    
+        """Extend input data to make it match with model data. The parameters were validated already (they exist, valid format, …; see ApiResourceMixin)"""
+        accounts = accounts_by_number([bundle.data])
+        self.hydrate_transaction(bundle, accounts, currency_rate_info)
+        if bundle.errors:
+            return bundle
+        if settings.TRANSACTION_QUEUE:
+            # Asynchronous mode: the worker will post it (see transaction_queue.py)
+            self.authorized_create_detail(self.get_object_list(bundle.request), bundle)
+            with stage('save'):
+                bundle.queued = enqueue(bundle.obj, bundle.request.user)
+            return bundle
+        return self.create_object(bundle)
+
+    def created_response(self, request, bundle):
+        """Queued transactions get 202 and their status (the same as from the status URL, in Location)"""
+        queued = getattr(bundle, 'queued', None)
+        if queued is None:
+            return super(TransactionResource, self).created_response(request, bundle)
+        data = self.queued_data(queued)
+        response = self.create_response(request, {'error': False, 'data': data}, response_class=http.HttpAccepted)
+        response['Location'] = data['resource_uri']
+        return response
+
+    def queued_data(self, op):
+        data = OrderedDict([('queueId', op.pk), ('status', op.status), ('date', op.date), ('processed_date', op.processed_date)])
+        data['resource_uri'] = reverse('api_transaction_queue', kwargs={'resource_name': self._meta.resource_name, 'queue_id': op.pk})
+        if op.status == 'done':
+            data['transactionId'] = op.transaction_id
+            data['transaction_uri'] = self.get_resource_uri(Transaction(pk=op.transaction_id))
+        elif op.status == 'failed':
+            error = ApiError(op.error)
+            data['code'], data['message'] = error.code, str(error)
+        return data
+
+    def prepend_urls(self):
+        return super(TransactionResource, self).prepend_urls() + [
+            url(r"^(?P<resource_name>%s)/queue/(?P<queue_id>\d+)%s$" % (self._meta.resource_name, trailing_slash()), self.wrap_view('get_queued'), name="api_transaction_queue"),
+        ]
+
+    def get_queued(self, request, queue_id, **kwargs):
+        """GET /api/transactions/queue/<id>/ → status of a transaction queued in asynchronous mode: queued, done (with its transactionId) or failed (with the error code and message). Only for the user who sent it"""
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        op = QueuedOperation.objects.filter(pk=queue_id, user=request.user).first()
+        if op is None:
+            return self.error_response(request, {'error': ApiError('nf_queue')}, response_class=http.HttpNotFound)
+        return self.create_response(request, {'error': False, 'data': self.queued_data(op)})
+
+    def hydrate_transaction(self, bundle, accounts, rate_function):
+        """
+        Fill bundle.obj (a new Transaction) from the input data, or add the problems to bundle.errors. Call it only with valid input (see is_valid).
+        accounts: dict {account number: Account} with the accounts we need, already fetched. rate_function(source,dest): (currency rate, date of the rate), see currency.py
+        """
+        # Validator already checked this, so our usage is safe
+        assert 'sourceAccount' in bundle.data
+        assert 'destAccount' in bundle.data
+        assert 'amount' in bundle.data
+
+        # This is what tastypie calls "hydrate": transform text→model. It may get None if we don't find the IDs
+        dest_acc=accounts.get(account_number(bundle.data['destAccount']))
+        source_acc=accounts.get(account_number(bundle.data['sourceAccount']))
+        amount=bundle.data['amount'] # a Decimal already, see TransactionInputValidation
+
+        if amount==0:
+            bundle.errors['amount']=ApiError('no_zero')
+
+        # Depending on transaction type, fill some data or other. Also, require different data
+        if bundle.data['sourceAccount'] is None:
+            bundle.obj.op_type='dep'
+            # bundle.data['dest_acc']=bundle.data['destAccount']
+            if not dest_acc:
+                bundle.errors['destAccount']=ApiError('nf_acc')
+            bundle.obj.dest_acc=dest_acc
+            bundle.obj.dest_amount=amount
+            bundle.obj.source_acc=None
+            bundle.obj.source_amount=None
+
+        elif bundle.data['destAccount'] is None:
+            bundle.obj.op_type='wd'
+            if not source_acc:
+                bundle.errors['sourceAccount']=ApiError('nf_acc')
+            bundle.obj.source_acc=source_acc
+            bundle.obj.source_amount=amount
+            bundle.obj.dest_acc=None
+            bundle.obj.dest_amount=None
+
+        elif bundle.data['sourceAccount'] and bundle.data['destAccount']:
+            bundle.obj.op_type='tra'
+            if not dest_acc:
+                bundle.errors['destAccount']=ApiError('nf_acc')
+            if not source_acc:
+                bundle.errors['sourceAccount']=ApiError('nf_acc')
+            if dest_acc and source_acc and dest_acc==source_acc:
+                bundle.errors['destAccount']=ApiError('no_same')
+
+            bundle.obj.source_acc=source_acc
+            bundle.obj.dest_acc=dest_acc
+            # The given amount is always written as source amount. The destination amount, however, can be computed
+            bundle.obj.source_amount=amount
+            if source_acc and dest_acc and source_acc.currency != dest_acc.currency:
+                # Store the rate we used, and its date, so that audits don't need to ask for it again
+                try:
+                    rate,rate_date=rate_function(source_acc.currency,dest_acc.currency)
+                except CurrencyRateError:
+                    # obj_create, save_batch and the fast path all come here
+                    bundle.errors['error']=ApiError('e_netw')
+                    return
+                bundle.obj.currency_rate=quantize_rate(rate)
+                bundle.obj.currency_date=rate_date
+                bundle.obj.dest_amount=convert(amount,bundle.obj.currency_rate)
             else:
-                raise Exception("check validator")
-    
-            # extra data
-            bundle.obj.date = datetime.datetime.utcnow()
-    
-            # No need to do hydrate (== transforming key/value to objects) because we did it above
-            #bundle = self.full_hydrate(bundle)
+                # same currency (or nulls)
+                bundle.obj.dest_amount=amount
+
         else:
-            # if not valid, the save() will not save it
-            pass
+            raise Exception("check validator")
+
+        # extra data
+        bundle.obj.date = datetime.datetime.utcnow()
 
-        # This will check validity before saving and will return error if it finds any problem
-        return self.save(bundle)
+        # No need to do hydrate (== transforming key/value to objects) because we did it above
+        #bundle = self.full_hydrate(bundle)
+        return bundle
+
+    def save_batch(self, request, bundles, all_or_nothing):
+        """See BatchResourceMixin. All accounts are fetched in 1 query, and all operations are saved together (see models.post_transactions)"""
+        valid_bundles = [b for b in bundles if self.is_valid(b)]
+        accounts = accounts_by_number(b.data for b in valid_bundles)
+        rates = {}
+        def rate_function(source, dest):
+            # the whole matrix is fetched once, and only if needed
+            if not rates:
+                rates['matrix'] = currency_rates()
+            return rates['matrix'][(source, dest)], rates['matrix'].dates.get((source, dest))
+        for b in valid_bundles:
+            self.hydrate_transaction(b, accounts, rate_function)
+
+        to_save = [b for b in bundles if not b.errors]
+        if to_save and not (all_or_nothing and len(to_save) < len(bundles)):
+            for b in to_save:
+                self.authorized_create_detail(self.get_object_list(request), b)
+            save_errors = post_transactions([b.obj for b in to_save], all_or_nothing=all_or_nothing)
+            for b, error in zip(to_save, save_errors):
+                if error:
+                    b.errors['error'] = error
 
     def dehydrate(self, bundle):
         """Create the appropriate response, e.g. include an "error" attribute in the response"""
@@ -236,15 +687,3 @@ class TransactionResource(ModelResource):
         orig_data=dict(bundle.data)
         bundle.data={'error':False, 'data':orig_data}
         return bundle
-
-    def error_response(self, request, errors, response_class=None):
-        """Wrap the original error handler in order to change the message format according to the requirements"""
-        error_code=extract_error_code_from_bundle(errors)
-
-        # rewrite the error dict
-        errors={"error": True, "code": error_code, "message": ERROR_CODES[error_code]}
-
-        # continue normally but with our dict
-        res=super(TransactionResource,self).error_response(request, errors, response_class)
-
-        return res
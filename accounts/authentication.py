@@ -0,0 +1,153 @@
+"""
+API authentication with cached lookups.
+tastypie's ApiKeyAuthentication reads the User and its ApiKey from the DB in every request. CachedApiKeyAuthentication remembers the users whose key was valid:
+- in a small LRU in each process, for API_KEY_CACHE_TTL seconds
+- optionally, also in a Django cache shared by all processes (API_KEY_CACHE)
+Changing or deleting an ApiKey or a User removes the user from the caches of this process and from the shared one (see the signal receivers below). Other processes may still accept the old key from their LRU until it expires, so keep the TTL short.
+Caches have the user's fields without the password hash, and each request gets its own User built from them.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from tastypie.authentication import ApiKeyAuthentication
+from tastypie.compat import get_username_field
+from tastypie.models import ApiKey
+
+
+class ExpiringLRUCache(object):
+    """Dict-like cache with at most maxsize entries (the least recently used ones are dropped) which expire after ttl seconds. Thread-safe"""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict() # key → (expiry time, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def key_digest(api_key):
+    """We don't keep the keys themselves in caches, only their hash"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+def shared_cache_key(username):
+    return 'accounts:apikey:%s' % key_digest(username)
+
+def shared_user_id_key(user_id):
+    return 'accounts:apikey:user:%s' % user_id
+
+
+# There's 1 entry per username: (hash of its valid key, user id, user_fields(user))
+authenticated_users = ExpiringLRUCache(settings.API_KEY_CACHE_SIZE, settings.API_KEY_CACHE_TTL)
+# user id → username. An entry is only used while its user's id is here with the same username. Saving a user or its key removes the id, which invalidates the entry whatever username it has (the user may have been renamed) without looking for it
+valid_user_ids = ExpiringLRUCache(settings.API_KEY_CACHE_SIZE, settings.API_KEY_CACHE_TTL)
+
+def user_fields(user):
+    """[(attname, value)] of the User's fields, in model order, except the password hash"""
+    return [(f.attname, getattr(user, f.attname)) for f in user._meta.concrete_fields if f.attname != 'password']
+
+def user_from_fields(fields):
+    """A new User from user_fields(). Its password is a deferred field: read from the DB if something asks for it"""
+    return get_user_model().from_db(DEFAULT_DB_ALIAS, [name for name, value in fields], [value for name, value in fields])
+
+def forget_user(user_id, username=None):
+    """Remove a user from the caches, so that its key is checked again in the DB"""
+    valid_user_ids.delete(user_id)
+    if username is not None:
+        authenticated_users.delete(username)
+    if settings.API_KEY_CACHE:
+        caches[settings.API_KEY_CACHE].delete_many([shared_user_id_key(user_id)] + ([shared_cache_key(username)] if username is not None else []))
+
+
+class CachedApiKeyAuthentication(ApiKeyAuthentication):
+    """Like ApiKeyAuthentication (same header/parameters and responses), but valid keys are remembered. See the module docstring"""
+
+    def is_authenticated(self, request, **kwargs):
+        try:
+            username, api_key = self.extract_credentials(request)
+        except ValueError:
+            return self._unauthorized()
+        if not username or not api_key:
+            return self._unauthorized()
+
+        user = self.cached_user(username, key_digest(api_key))
+        if user is None:
+            # Unknown, expired or different key: the normal check, with DB queries
+            result = super(CachedApiKeyAuthentication, self).is_authenticated(request, **kwargs)
+            if result is True:
+                self.remember_user(request.user, key_digest(api_key))
+            return result
+
+        if not self.check_active(user):
+            return False
+        request.user = user
+        return True
+
+    def cached_user(self, username, digest):
+        """A new User built from the cache if it was authenticated with the same key, otherwise None"""
+        entry = authenticated_users.get(username)
+        if entry is not None and valid_user_ids.get(entry[1]) != username:
+            entry = None
+        if entry is None and settings.API_KEY_CACHE:
+            shared = caches[settings.API_KEY_CACHE]
+            entry = shared.get(shared_cache_key(username))
+            if entry is not None and shared.get(shared_user_id_key(entry[1])) != username:
+                entry = None
+            if entry is not None:
+                authenticated_users.set(username, entry)
+                valid_user_ids.set(entry[1], username)
+        if entry is None or entry[0] != digest:
+            return None
+        return user_from_fields(entry[2])
+
+    def remember_user(self, user, digest):
+        username = getattr(user, get_username_field())
+        entry = (digest, user.pk, user_fields(user))
+        authenticated_users.set(username, entry)
+        valid_user_ids.set(user.pk, username)
+        if settings.API_KEY_CACHE:
+            caches[settings.API_KEY_CACHE].set_many({shared_cache_key(username): entry, shared_user_id_key(user.pk): username}, settings.API_KEY_CACHE_TTL)
+
+
+@receiver([post_save, post_delete], sender=ApiKey)
+def api_key_changed(sender, instance, **kwargs):
+    forget_user(instance.user_id)
+
+@receiver([post_save, post_delete], sender=get_user_model())
+def user_changed(sender, instance, **kwargs):
+    # e.g. deactivated, or renamed (the entry of the previous username is invalid too, see valid_user_ids)
+    forget_user(instance.pk, getattr(instance, get_username_field()))
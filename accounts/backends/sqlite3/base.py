@@ -0,0 +1,28 @@
+"""
+Django's SQLite backend, tuned for several threads or processes writing at the same time (runserver, threaded WSGI servers, scripts/bench_api.py):
+- The journal is in WAL mode, so readers don't wait for writers, nor writers for readers.
+- DB transactions (transaction.atomic) start with BEGIN IMMEDIATE, which takes the write lock at the start. With a plain BEGIN, a transaction which reads and then writes (all of ours do) can't wait for another writer: SQLite answers "database is locked" at once. Waiting up to the busy timeout ("timeout" option) is what we want instead.
+OPTIONS: 'timeout' (seconds to wait for the write lock, default 20), 'journal_mode' (default 'WAL'; None leaves the file as it is). See f4y/databases.py
+"""
+from django.db.backends.sqlite3 import base
+
+DEFAULT_TIMEOUT = 20
+DEFAULT_JOURNAL_MODE = 'WAL'
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        kwargs = super(DatabaseWrapper, self).get_connection_params()
+        # not an argument of sqlite3.connect
+        self.journal_mode = kwargs.pop('journal_mode', DEFAULT_JOURNAL_MODE)
+        kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+        return kwargs
+
+    def init_connection_state(self):
+        super(DatabaseWrapper, self).init_connection_state()
+        # The journal mode is stored in the file, so this only changes something the first time. In-memory DBs (tests) can't use WAL
+        if self.journal_mode and not self.is_in_memory_db():
+            self.connection.execute('PRAGMA journal_mode=%s' % self.journal_mode)
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE")
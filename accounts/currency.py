@@ -1,28 +1,245 @@
+import datetime
+import json
+import threading
+import time
+from decimal import Decimal
+
 import requests
-import re
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.module_loading import import_string
+
+from accounts.instrumentation import stage
+from accounts.models import ALLOWED_CURRENCIES
+from accounts.money import to_decimal
 
 """
 Functions to do currency conversion.
-In a real project (non-demo) this information would be cached in some way (DB, redis) so that we don't have to call a remote API each time.
+Rates come from a "provider" (see CURRENCY_RATE_PROVIDER in settings.py) which gives us the whole cross-rate matrix for all ALLOWED_CURRENCIES in one call. By default it's the CurrencyRate table, which the refresh_currency_rates command fills from a remote API. That matrix is kept in memory and in the Django cache, so we don't call a remote API for each transfer.
+When the matrix gets old we keep serving it for a while (CURRENCY_RATE_STALE_TTL) while a background thread fetches a new one ("stale-while-revalidate"). So once warm, a request never waits for the network.
 """
 
-def currency_rate(source,dest):
+NETWORK_ERROR_MESSAGE = "Connection to get currency rates failed"
+SHARED_CACHE_KEY = 'accounts:currency_rates'
+
+
+class CurrencyRateError(Exception):
+    """Rates couldn't be obtained (remote API down, bad file, …)"""
+    pass
+
+
+def allowed_currency_codes():
+    return [k for k, v in ALLOWED_CURRENCIES]
+
+
+class RateMatrix(dict):
+    """
+    Rates of all (source,dest) pairs: {(source,dest): rate}, e.g. {('EUR','USD'): Decimal('1.12'), ('USD','EUR'): Decimal('0.89'), …}
+    dates has, for each pair, the date for which the rate is valid (given by the provider)
+    """
+    def __init__(self, rates=(), dates=None):
+        super(RateMatrix, self).__init__(rates)
+        self.dates = dates or {}
+
+
+def parse_rate_date(value):
+    """Providers give the date of their rates as "YYYY-MM-DD". We store it as midnight UTC of that day. None if there's no date"""
+    if not value:
+        return None
+    day = parse_date(value)
+    if day is None:
+        raise CurrencyRateError("Bad date for currency rates: %s" % value)
+    return datetime.datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+
+def cross_rates(base, rates, currencies, date=None):
+    """
+    From the rates of one base currency (1 base == rates[X] X), compute the rate for every (source,dest) pair.
+    Returns a RateMatrix
+    """
+    rates = dict((k, to_decimal(v)) for k, v in rates.items())
+    rates[base] = Decimal(1)
+    missing = [c for c in currencies if c not in rates]
+    if missing:
+        raise CurrencyRateError("No rate for currencies %s" % missing)
+    pairs = [(s, d) for s in currencies for d in currencies if s != d]
+    return RateMatrix((((s, d), rates[d] / rates[s]) for s, d in pairs), dict((pair, date) for pair in pairs))
+
+
+class RateProvider(object):
+    """Base class for rate providers. They must return a full matrix, see cross_rates()"""
+    def fetch_matrix(self, currencies):
+        raise NotImplementedError()
+
+    def fetch_base(self, base, symbols):
+        """Rates of the symbols relative to base: returns ({symbol: rate}, date). Providers which can ask this separately for each base override it, see refresh_currency_rates"""
+        matrix = self.fetch_matrix([base] + list(symbols))
+        return dict((d, matrix[(base, d)]) for d in symbols), matrix.dates.get((base, symbols[0]))
+
+
+class FixerRateProvider(RateProvider):
+    """Asks fixer.io for the rates of all currencies relative to one of them, in a single HTTP call"""
+    url = 'http://api.fixer.io/latest'
+    timeout = 10
+
+    def fetch_base(self, base, symbols):
+        params = {'base': base, 'symbols': ','.join(symbols)}
+        try:
+            r = requests.get(self.url, params=params, timeout=self.timeout)
+            r = r.json(parse_float=Decimal)
+            return r['rates'], parse_rate_date(r.get('date'))
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            raise CurrencyRateError(NETWORK_ERROR_MESSAGE)
+
+    def fetch_matrix(self, currencies):
+        base = currencies[0]
+        rates, date = self.fetch_base(base, [c for c in currencies if c != base])
+        return cross_rates(base, rates, currencies, date)
+
+
+class FileRateProvider(RateProvider):
     """
-    Returns the number you should multiply with in order to change from "source" currency to "dest" currency.
+    Reads rates from a local JSON file in the same format that fixer.io returns: {"base": "EUR", "date": "2017-06-02", "rates": {"USD": 1.12, …}}
+    Useful to work offline and in tests. See CURRENCY_RATE_FILE
+    """
+    def __init__(self, path=None):
+        self.path = path or settings.CURRENCY_RATE_FILE
+
+    def fetch_matrix(self, currencies):
+        try:
+            with open(self.path) as f:
+                data = json.load(f, parse_float=Decimal)
+            return cross_rates(data['base'], data['rates'], currencies, parse_rate_date(data.get('date')))
+        except (IOError, ValueError, KeyError):
+            raise CurrencyRateError(NETWORK_ERROR_MESSAGE)
+
+
+class DatabaseRateProvider(RateProvider):
+    """
+    Reads the latest rates stored in the CurrencyRate table by the refresh_currency_rates command, which gets them from CURRENCY_RATE_SOURCE_PROVIDER.
+    This way requests never need the network. The table also keeps the history of rates.
+    """
+    def fetch_matrix(self, currencies):
+        from accounts.models import CurrencyRate
+        latest = CurrencyRate.objects.aggregate(latest=Max('fetched_at'))['latest']
+        rates = CurrencyRate.objects.filter(fetched_at=latest, source__in=currencies, dest__in=currencies).values_list('source', 'dest', 'rate', 'date')
+        matrix = RateMatrix()
+        for source, dest, rate, date in rates:
+            matrix[(source, dest)] = rate
+            matrix.dates[(source, dest)] = date
+        if len(matrix) < len(currencies) * (len(currencies) - 1):
+            raise CurrencyRateError("Currency rates not available. Run ./manage.py refresh_currency_rates")
+        return matrix
+
+
+class RateCache(object):
+    """
+    Keeps the rate matrix of a provider in memory (per process) and in a shared Django cache (for all processes).
+    - younger than ttl: served from memory
+    - between ttl and ttl+stale_ttl: served from memory, and a background thread refreshes it
+    - older, or nothing yet: we must block and fetch it (this happens only when cold)
+    """
+    def __init__(self, provider, ttl, stale_ttl, cache_alias='default'):
+        self.provider = provider
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.cache_alias = cache_alias
+        self._matrix = None
+        self._fetched_at = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def matrix(self):
+        """Returns the full matrix {(source,dest): rate}"""
+        if self._matrix is not None:
+            age = time.time() - self._fetched_at
+            if age < self.ttl:
+                return self._matrix
+            if age < self.ttl + self.stale_ttl:
+                self._refresh_in_background()
+                return self._matrix
+        with self._lock:
+            # another thread may have loaded it while we waited
+            if self._matrix is None or time.time() - self._fetched_at >= self.ttl + self.stale_ttl:
+                self._load()
+        return self._matrix
+
+    def rate(self, source, dest):
+        """Returns (rate, date of the rate)"""
+        if source == dest:
+            return Decimal(1), None
+        matrix = self.matrix()
+        return matrix[(source, dest)], matrix.dates.get((source, dest))
+
+    def _load(self):
+        """Take the matrix from the shared cache if it's fresh there (another process fetched it), otherwise from the provider"""
+        shared = caches[self.cache_alias].get(SHARED_CACHE_KEY)
+        if shared is not None and time.time() - shared[1] < self.ttl:
+            matrix, fetched_at = shared
+        else:
+            matrix = self.provider.fetch_matrix(allowed_currency_codes())
+            fetched_at = time.time()
+            caches[self.cache_alias].set(SHARED_CACHE_KEY, (matrix, fetched_at), self.ttl + self.stale_ttl)
+        self._matrix, self._fetched_at = matrix, fetched_at
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self._load()
+        except CurrencyRateError:
+            pass # keep serving the stale matrix; next request will try again
+        finally:
+            self._refreshing = False
+            connection.close() # the provider may have used the DB from this thread
+
+
+_rate_cache = None
+_rate_cache_lock = threading.Lock()
+
+def get_rate_cache():
+    """The process-wide RateCache, built from settings the first time it's needed"""
+    global _rate_cache
+    if _rate_cache is None:
+        with _rate_cache_lock:
+            if _rate_cache is None:
+                provider = import_string(settings.CURRENCY_RATE_PROVIDER)()
+                _rate_cache = RateCache(provider, settings.CURRENCY_RATE_TTL, settings.CURRENCY_RATE_STALE_TTL, settings.CURRENCY_RATE_CACHE)
+    return _rate_cache
+
+def reset_rate_cache():
+    """Forget the in-process matrix and provider (e.g. after changing settings in tests). The shared cache is cleared too"""
+    global _rate_cache
+    if _rate_cache is not None:
+        caches[_rate_cache.cache_alias].delete(SHARED_CACHE_KEY)
+    _rate_cache = None
+
+
+def currency_rates():
+    """Returns the full cross-rate matrix {(source,dest): rate} for ALLOWED_CURRENCIES. Useful when many rates are needed at once"""
+    with stage('rates'):
+        return get_rate_cache().matrix()
+
+def currency_rate_info(source,dest):
+    """
+    Returns (rate, date): the number you should multiply with in order to change from "source" currency to "dest" currency, and the date for which that rate is valid.
     E.g. convert 1 EUR (source) to USD (dest) = 0.89
-    Does real-time HTTP call.
-    """
-    assert re.match("[A-Z]{3}",source)
-    assert re.match("[A-Z]{3}",dest)
-    # We need to set source=1 and ask only about the dest. currency
-    # e.g. "tell me the destination currency, in my terms"
-    params = {'base': source, 'symbols': dest}
-    try:
-        r = requests.get('http://api.fixer.io/latest', params=params)
-        r = r.json()
-    except requests.exceptions.ConnectionError:
-        raise Exception("Connection to get currency rates failed")
-
-    rate = r['rates'][dest]
-    #print("Returning rate: 1 %s == %f %s"%(source,rate,dest))
-    return rate
+    Served from cache; it only asks the provider when the cache is cold. Raises CurrencyRateError if rates can't be obtained.
+    """
+    assert source in allowed_currency_codes()
+    assert dest in allowed_currency_codes()
+    with stage('rates'):
+        return get_rate_cache().rate(source, dest)
+
+def currency_rate(source,dest):
+    """Like currency_rate_info, but returns only the rate"""
+    return currency_rate_info(source, dest)[0]
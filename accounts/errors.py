@@ -0,0 +1,65 @@
+"""
+Errors reported by the API: {"error": true, "code": "nf_acc", "message": "Account doesn't exist"}
+Code that finds a problem (validators, obj_create, models) raises or stores an ApiError, which already knows its code. Plain messages are still understood, through an index built once here.
+"""
+
+ERROR_CODES = {
+    'm_par': 'Missing parameters',
+    'm_destacc': "Missing destination account",
+    'm_srcacc': "Missing source account",
+    'm_am': "Missing amount",
+    'm_cur': "Missing currency",
+    'nf_cur': "Currency not supported",
+    'nf_acc': "Account doesn't exist",
+    'z_srcacc': "Source account would have negative balance",
+    'z_destacc': "Destination account would have negative balance",
+    'no_same': "Can't transfer to same account",
+    'no_number': "Not a valid number",
+    'no_zero': "Amount cannot be zero",
+    'e_netw': "Connection to get currency rates failed",
+    'e_batch': "Not saved because other operations in the batch failed",
+    'big_batch': "Too many operations in one batch",
+    'no_atomic': '"atomic" must be true or false',
+    'e_accnum': "No more account numbers available",
+    'no_idem': "Idempotency key must have between 1 and 255 characters",
+    'e_idem': "Idempotency key already used for a different request",
+    'no_date': "Not a valid date",
+    'nf_tr': "Transaction doesn't exist",
+    'no_field': "Unknown field",
+    'no_cursor': "Not a valid cursor",
+    'nf_queue': "Queued operation doesn't exist",
+}
+
+# message → code
+ERROR_CODES_BY_MESSAGE = dict((message, code) for code, message in ERROR_CODES.items())
+assert len(ERROR_CODES_BY_MESSAGE) == len(ERROR_CODES), "Each error message must have only 1 code"
+
+
+class ApiError(str):
+    """
+    An error message which knows its code: ApiError('nf_acc') == "Account doesn't exist", and its .code is 'nf_acc'.
+    As it's a str, it can go wherever messages went before (bundle.errors, ValidationError, …)
+    """
+    def __new__(cls, code):
+        error = super(ApiError, cls).__new__(cls, ERROR_CODES[code])
+        error.code = code
+        return error
+
+    def __reduce__(self):
+        return (ApiError, (self.code,))
+
+    def as_dict(self):
+        """The response body"""
+        return {"error": True, "code": self.code, "message": str(self)}
+
+
+def api_error(message):
+    """The ApiError for a message: an ApiError, a known plain message, or a message from a ValidationError as tastypie gives it ("['…']")"""
+    if isinstance(message, ApiError):
+        return message
+    code = ERROR_CODES_BY_MESSAGE.get(message)
+    if code is None and message.startswith("['") and message.endswith("']"):
+        code = ERROR_CODES_BY_MESSAGE.get(message[2:-2])
+    if code is None:
+        raise NotImplementedError("Error message '%s' has no short code defined. Check errors.py" % message)
+    return ApiError(code)
@@ -0,0 +1,127 @@
+"""
+Fast path for the 2 most frequent API calls, POST /api/transactions/ and POST /api/accounts/: plain Django views instead of tastypie's pipeline (deserialize, Bundle, full_dehydrate, to_simple, …), enabled with API_FAST_PATH = True.
+Requests and responses are the same as with the resources in api.py, and most of the work is shared with them: the input is checked with the same InputSchema, transactions are filled by TransactionResource.hydrate_transaction and saved by Transaction.save, and the response has the same fields, formatted by tastypie's serializer. What's skipped is the plumbing around that: the JSON is parsed once, and the response is built from a table of fields made once per resource.
+Anything else (GET, Idempotency-Key, formats other than JSON, bodies which aren't a JSON object, API_FAST_PATH = False, transactions in asynchronous mode) goes to the tastypie resource, as if this didn't exist.
+"""
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from tastypie import fields, http
+from tastypie.bundle import Bundle
+
+from accounts.api import ACCOUNT_SCHEMA, TRANSACTION_SCHEMA, accounts_by_number, first_error
+from accounts.currency import currency_rate_info
+from accounts.instrumentation import stage
+from accounts.models import Account, Transaction
+
+JSON = 'application/json'
+
+
+def json_response(data, response_class=HttpResponse):
+    """Like tastypie's create_response with JSON (same key order and separators), so both paths give the same bytes"""
+    return response_class(json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True, ensure_ascii=False), content_type=JSON)
+
+def error_response(errors):
+    return json_response(first_error(errors).as_dict(), http.HttpBadRequest)
+
+
+class FastPost(object):
+    """
+    A view for POST /api/<resource>/ which creates 1 object with create(request, data), data being the checked input; create returns (object, errors).
+    The response is what the resource's full_dehydrate and dehydrate would give: its fields (renamed with "renames"), after the input data.
+    Authorization isn't checked: our resources use Authorization(), which lets every authenticated user create
+    """
+    csrf_exempt = True # like tastypie's views; see CsrfViewMiddleware
+
+    def __init__(self, resource, schema, create, renames, unless=None):
+        self.resource = resource
+        self.unless = unless # name of a setting which, when true, sends everything to tastypie
+        self.schema = schema
+        self.create = create
+        self.fallback = resource.wrap_view('dispatch_list')
+        format_datetime = resource._meta.serializer.format_datetime
+        # (key in the response, attribute, function for non-None values), in tastypie's order
+        self.output_fields = []
+        for name, field in resource.fields.items():
+            if field.attribute is None: # resource_uri
+                continue
+            convert = format_datetime if isinstance(field, fields.DateTimeField) else field.convert
+            self.output_fields.append((renames.get(name, name), field.attribute, convert))
+        self.detail_attribute = resource._meta.detail_uri_name
+        self.list_uri = None # known after URLs are loaded
+
+    def wants_fast_path(self, request):
+        return (settings.API_FAST_PATH and request.method == 'POST'
+            and not (self.unless and getattr(settings, self.unless))
+            and request.META.get('CONTENT_TYPE', '').startswith(JSON)
+            and 'HTTP_IDEMPOTENCY_KEY' not in request.META
+            and self.resource.determine_format(request) == JSON)
+
+    def __call__(self, request, **kwargs):
+        if not self.wants_fast_path(request):
+            return self.fallback(request, **kwargs)
+        with stage('auth'):
+            authenticated = self.resource._meta.authentication.is_authenticated(request)
+        if authenticated is not True:
+            return authenticated if isinstance(authenticated, HttpResponse) else http.HttpUnauthorized()
+
+        with stage('validation'):
+            try:
+                data = json.loads(request.body.decode('utf-8'))
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                # tastypie has its own answers for these
+                return self.fallback(request, **kwargs)
+            errors = self.schema.errors(data)
+        if errors:
+            return error_response(errors)
+        try:
+            obj, errors = self.create(request, data)
+        except ValidationError as e:
+            return error_response({'error': e.messages[0]})
+        if errors:
+            return error_response(errors)
+
+        with stage('response'):
+            for name, attribute, convert in self.output_fields:
+                value = getattr(obj, attribute)
+                data[name] = None if value is None else convert(value)
+            if self.list_uri is None:
+                self.list_uri = self.resource.get_resource_uri()
+            data['resource_uri'] = uri = '%s%s/' % (self.list_uri, getattr(obj, self.detail_attribute))
+            response = json_response({'error': False, 'data': data}, http.HttpCreated)
+            response['Location'] = uri
+            response['Vary'] = 'Accept'
+            return response
+
+
+def create_transaction(resource):
+    """create() for TransactionResource: the same steps as its obj_create"""
+    def create(request, data):
+        bundle = Bundle(obj=Transaction(), data=data, request=request)
+        resource.hydrate_transaction(bundle, accounts_by_number([data]), currency_rate_info)
+        if not bundle.errors:
+            with stage('save'):
+                bundle.obj.save()
+        return bundle.obj, bundle.errors
+    return create
+
+def create_account(resource):
+    def create(request, data):
+        account = Account(currency=data['currency'])
+        with stage('save'):
+            account.save()
+        return account, None
+    return create
+
+
+def fast_transactions_view(resource):
+    # Queued transactions (asynchronous mode) have another response
+    return FastPost(resource, TRANSACTION_SCHEMA, create_transaction(resource), {'id': 'transactionId'}, unless='TRANSACTION_QUEUE')
+
+def fast_accounts_view(resource):
+    return FastPost(resource, ACCOUNT_SCHEMA, create_account(resource), {'number': 'accountNumber'})
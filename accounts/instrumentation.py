@@ -0,0 +1,217 @@
+"""
+Where does the time of each request go.
+InstrumentationMiddleware measures every request: total time, DB queries (count and time) and the time of the "stages" marked in the code with "with stage('name'):" (authentication, validation, rates, saving, …; they can be nested).
+The results are:
+- sent in the Server-Timing header of each response, so they can be seen in the browser's developer tools or with curl -i
+- accumulated in histograms (per process) which /metrics shows in Prometheus' text format
+- optionally (PROFILE_SAMPLE_RATE), a sample of requests runs under cProfile, and the profiles of those slower than PROFILE_SLOW_REQUEST_MS are saved to PROFILE_DIR, to be read with pstats or snakeviz
+Django 1.11 has no connection.execute_wrapper, so queries are counted by wrapping the cursors of each DB connection (see CountingCursor).
+"""
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+
+# Histogram buckets, in seconds / number of queries
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram(object):
+    """Prometheus-style histogram with labels: for each label value, count of observations <= each bucket, their sum and count. Thread-safe"""
+    def __init__(self, name, help_text, label, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = OrderedDict() # label value → [count per bucket…, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def text(self):
+        """The lines for the /metrics page"""
+        lines = ["# HELP %s %s" % (self.name, self.help_text), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            for label_value, series in self._series.items():
+                for bound, count in zip(self.buckets + ('+Inf',), series[:len(self.buckets)] + [series[-1]]):
+                    lines.append('%s_bucket{%s="%s",le="%s"} %s' % (self.name, self.label, label_value, bound, count))
+                lines.append('%s_sum{%s="%s"} %s' % (self.name, self.label, label_value, series[-2]))
+                lines.append('%s_count{%s="%s"} %s' % (self.name, self.label, label_value, series[-1]))
+        return lines
+
+
+request_duration = Histogram('http_request_duration_seconds', "Time to answer requests, by view", 'view', DURATION_BUCKETS)
+request_queries = Histogram('http_request_db_queries', "DB queries per request, by view", 'view', QUERY_BUCKETS)
+stage_duration = Histogram('http_request_stage_duration_seconds', "Time spent in each stage of the requests", 'stage', DURATION_BUCKETS)
+HISTOGRAMS = [request_duration, request_queries, stage_duration]
+
+
+class RequestMetrics(object):
+    """What we measure during 1 request"""
+    def __init__(self):
+        self.stages = OrderedDict() # name → [seconds, queries]
+        self.queries = 0
+        self.query_time = 0.0
+
+_current = threading.local()
+
+def current_metrics():
+    """The RequestMetrics of the request running in this thread, or None (e.g. in management commands)"""
+    return getattr(_current, 'metrics', None)
+
+@contextmanager
+def stage(name):
+    """Measure the time and queries of a part of the request. Does nothing outside requests"""
+    metrics = current_metrics()
+    if metrics is None:
+        yield
+        return
+    queries = metrics.queries
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        totals = metrics.stages.setdefault(name, [0.0, 0])
+        totals[0] += time.perf_counter() - start
+        totals[1] += metrics.queries - queries
+
+
+class CountingCursor(object):
+    """Wraps a DB cursor to add its queries, and their time, to the current request"""
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self, method, sql, params):
+        metrics = current_metrics()
+        if metrics is None:
+            return method(sql, params)
+        start = time.perf_counter()
+        try:
+            return method(sql, params)
+        finally:
+            metrics.queries += 1
+            metrics.query_time += time.perf_counter() - start
+
+    def execute(self, sql, params=None):
+        return self._run(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._run(self.cursor.executemany, sql, param_list)
+
+    def callproc(self, procname, params=None):
+        return self._run(self.cursor.callproc, procname, params)
+
+
+def count_queries():
+    """Make the DB connections of this thread (there's 1 per thread and DB alias) wrap their cursors with CountingCursor. Only the first time"""
+    for connection in connections.all():
+        if getattr(connection, 'counts_queries', False):
+            continue
+        make_cursor, make_debug_cursor = connection.make_cursor, connection.make_debug_cursor
+        connection.make_cursor = lambda cursor, make_cursor=make_cursor: CountingCursor(make_cursor(cursor))
+        connection.make_debug_cursor = lambda cursor, make_debug_cursor=make_debug_cursor: CountingCursor(make_debug_cursor(cursor))
+        connection.counts_queries = True
+
+
+def server_timing(metrics, total):
+    """Server-Timing header value, e.g. 'auth;dur=0.2, save;dur=3.1;desc="4 queries", db;dur=2.5;desc="7 queries", total;dur=5.0' (ms)"""
+    parts = []
+    for name, (seconds, queries) in metrics.stages.items():
+        parts.append('%s;dur=%.3f;desc="%i queries"' % (name, seconds * 1000, queries))
+    parts.append('db;dur=%.3f;desc="%i queries"' % (metrics.query_time * 1000, metrics.queries))
+    parts.append('total;dur=%.3f' % (total * 1000))
+    return ', '.join(parts)
+
+def view_label(request):
+    """Name of the URL, e.g. 'account-list'. The API URLs have the same name for all resources, so it's prefixed with the resource: 'transactions:api_dispatch_list'"""
+    match = request.resolver_match
+    if match is None or not match.url_name:
+        return 'other'
+    if 'resource_name' in match.kwargs:
+        return '%s:%s' % (match.kwargs['resource_name'], match.url_name)
+    return match.url_name
+
+def profile_path(request):
+    """File for the profile of a request: <PROFILE_DIR>/<time>-<method>-<path>.prof"""
+    path = re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_') or 'root'
+    return os.path.join(settings.PROFILE_DIR, '%s-%s-%s.prof' % (time.strftime('%Y%m%d-%H%M%S'), request.method, path))
+
+
+class InstrumentationMiddleware(object):
+    """See the module docstring. Put it first in MIDDLEWARE so that it measures the others too"""
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        count_queries()
+        metrics = _current.metrics = RequestMetrics()
+        profiler = None
+        if settings.PROFILE_SAMPLE_RATE and random.random() < settings.PROFILE_SAMPLE_RATE:
+            profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            if profiler:
+                response = profiler.runcall(self.get_response, request)
+            else:
+                response = self.get_response(request)
+        finally:
+            total = time.perf_counter() - start
+            _current.metrics = None
+
+        view = view_label(request)
+        request_duration.observe(view, total)
+        request_queries.observe(view, metrics.queries)
+        for name, (seconds, queries) in metrics.stages.items():
+            stage_duration.observe(name, seconds)
+        if settings.SERVER_TIMING_HEADER:
+            response['Server-Timing'] = server_timing(metrics, total)
+        if profiler and total * 1000 >= settings.PROFILE_SLOW_REQUEST_MS:
+            if not os.path.isdir(settings.PROFILE_DIR):
+                os.makedirs(settings.PROFILE_DIR)
+            profiler.dump_stats(profile_path(request))
+        return response
+
+
+def metrics_view(request):
+    """/metrics: the histograms of this process, in Prometheus' text format. Only for METRICS_ALLOWED_IPS"""
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.text())
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
@@ -0,0 +1,241 @@
+"""
+Import of accounts and historical transactions from CSV or JSON-lines files (the import_ledger command), e.g. to migrate an old ledger.
+Files are read as a stream, in chunks of records. Each chunk is 1 DB transaction: accounts are inserted with bulk_create, and transactions are posted with post_transactions (the accounts locked once, 1 balance update per account, bulk inserts), so the balances and the ledger are right after every chunk.
+Each chunk also saves how far the file has been read (LedgerImport), in the same DB transaction, so after an interruption the import continues right after the last chunk which was committed: nothing is imported twice or skipped.
+Records which can't be imported (not valid, or rejected like the API would, e.g. not enough money) are skipped and reported with their line number.
+
+Accounts: number, currency
+Transactions: date, type (dep, wd or tra), source_account, dest_account, source_amount, dest_amount, and optionally currency_rate and currency_date. Empty values are missing values.
+Dates are ISO dates or datetimes, in the current time zone if they don't have one. Transactions must be in chronological order, and after the ones the accounts already have: the balance after each one is computed in file order.
+"""
+import csv
+import json
+import os
+from decimal import InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from accounts.errors import ApiError
+from accounts.models import Account, AccountNumberSequence, LedgerImport, Transaction, ALLOWED_CURRENCIES, OPERATION_TYPES, bulk_create_accounts, post_transactions, validate_8digits
+from accounts.money import parse_amount, quantize_rate, to_decimal
+from accounts.statements import parse_day
+
+IMPORT_CHUNK_SIZE = 5000 # records per DB transaction
+
+# file extension → format
+IMPORT_FORMATS = {'csv': 'csv', 'jsonl': 'jsonl', 'json': 'jsonl', 'ndjson': 'jsonl'}
+
+CURRENCY_CODES = frozenset(code for code, name in ALLOWED_CURRENCIES)
+OPERATION_CODES = frozenset(code for code, name in OPERATION_TYPES)
+
+
+class ImportFile(object):
+    """A CSV or JSON-lines file read as dicts, 1 line at a time, starting at a byte offset. After each record, offset and line say where the next one starts"""
+    def __init__(self, f, file_format, offset=0, line=0):
+        self.f = f # binary
+        self.format = file_format
+        self.offset = offset
+        self.line = line
+
+    def lines(self):
+        for raw in self.f:
+            self.offset += len(raw)
+            self.line += 1
+            yield raw.decode('utf-8')
+
+    def records(self):
+        """Yields (line number, record); records which aren't a JSON object are None"""
+        if self.format == 'csv':
+            self.f.seek(0)
+            header_line = self.f.readline()
+            header = next(csv.reader([header_line.decode('utf-8-sig')]), [])
+            if not self.offset:
+                self.offset, self.line = len(header_line), 1
+            self.f.seek(self.offset)
+            # csv.reader asks for the lines of 1 record at a time, so offset is right after each record
+            for row in csv.reader(self.lines()):
+                if row:
+                    yield self.line, dict(zip(header, row))
+        else:
+            self.f.seek(self.offset)
+            for text in self.lines():
+                if text.strip():
+                    try:
+                        record = json.loads(text)
+                    except ValueError:
+                        record = None
+                    yield self.line, record if isinstance(record, dict) else None
+
+
+def value(record, name):
+    """The value of a field, None if it's missing or empty"""
+    v = record.get(name)
+    return None if v is None or v == '' else v
+
+def parse_date_value(v):
+    """ISO datetime (in the current time zone if it has none) or date (when it starts). Raises ValidationError"""
+    try:
+        date = parse_datetime(v) or parse_day(v)
+    except (ValueError, TypeError): # bad dates, or not a string
+        date = None
+    if date is None:
+        raise ValidationError(ApiError('no_date'))
+    return timezone.make_aware(date) if timezone.is_naive(date) else date
+
+def parse_number(v):
+    try:
+        return int(v)
+    except (ValueError, TypeError):
+        raise ValidationError(ApiError('no_number'))
+
+
+def account_from_record(record):
+    """A new Account (not saved) from a record. Raises ValidationError"""
+    if record is None:
+        raise ValidationError(ApiError('m_par'))
+    if value(record, 'number') is None or value(record, 'currency') is None:
+        raise ValidationError(ApiError('m_par'))
+    number = parse_number(value(record, 'number'))
+    validate_8digits(number)
+    # JSON values can be lists or dicts, which can't be looked up in a set
+    if not isinstance(record['currency'], str) or record['currency'] not in CURRENCY_CODES:
+        raise ValidationError(ApiError('nf_cur'))
+    return Account(number=number, currency=record['currency'])
+
+def import_accounts(chunk):
+    """Insert the accounts of a chunk of (line, record). Returns (imported, [(line, error message)])"""
+    accounts, errors = [], []
+    for line, record in chunk:
+        try:
+            accounts.append((line, account_from_record(record)))
+        except ValidationError as e:
+            errors.append((line, e.messages[0]))
+    existing = set(Account.objects.filter(number__in=[acc.number for line, acc in accounts]).values_list('number', flat=True))
+    new = []
+    for line, acc in accounts:
+        if acc.number in existing:
+            errors.append((line, "Account %i already exists" % acc.number))
+        else:
+            existing.add(acc.number) # also for repeated numbers in the chunk
+            new.append(acc)
+    if new:
+        bulk_create_accounts(new)
+        # New numbers (see allocate_account_numbers) must come after the imported ones
+        last_number = max(acc.number for acc in new)
+        AccountNumberSequence.objects.filter(next_number__lte=last_number).update(next_number=last_number + 1)
+    return len(new), sorted(errors)
+
+
+def transaction_from_record(record, accounts):
+    """A new Transaction (not saved) from a record, checked with Transaction.clean. accounts: {number: Account}. Raises ValidationError"""
+    if record is None or value(record, 'type') is None or value(record, 'date') is None:
+        raise ValidationError(ApiError('m_par'))
+    if not isinstance(record['type'], str) or record['type'] not in OPERATION_CODES:
+        raise ValidationError("Type must be one of %s" % ", ".join(sorted(OPERATION_CODES)))
+    tr = Transaction(op_type=record['type'], date=parse_date_value(record['date']))
+    for field, column in (('source_acc', 'source_account'), ('dest_acc', 'dest_account')):
+        if value(record, column) is not None:
+            account = accounts.get(parse_number(record[column]))
+            if account is None:
+                raise ValidationError(ApiError('nf_acc'))
+            setattr(tr, field, account)
+    for field, column in (('source_amount', 'source_amount'), ('dest_amount', 'dest_amount')):
+        if value(record, column) is not None:
+            amount = parse_amount(record[column])
+            if amount is None:
+                raise ValidationError(ApiError('no_number'))
+            setattr(tr, field, amount)
+    if value(record, 'currency_rate') is not None:
+        try:
+            tr.currency_rate = quantize_rate(to_decimal(record['currency_rate']))
+        except (InvalidOperation, ValueError, TypeError):
+            raise ValidationError(ApiError('no_number'))
+    if value(record, 'currency_date') is not None:
+        tr.currency_date = parse_date_value(record['currency_date'])
+    if tr.source_acc and tr.source_acc == tr.dest_acc:
+        raise ValidationError(ApiError('no_same'))
+    tr.clean()
+    return tr
+
+def import_transactions(chunk):
+    """Post the transactions of a chunk of (line, record). Returns (imported, [(line, error message)])"""
+    numbers = set()
+    for line, record in chunk:
+        for column in ('source_account', 'dest_account'):
+            try:
+                numbers.add(int(record[column]))
+            except (KeyError, TypeError, ValueError):
+                pass
+    # 1 Account object per account, shared by its transactions (see post_transactions)
+    accounts = dict((acc.number, acc) for acc in Account.objects.filter(number__in=numbers))
+    transactions, lines, errors = [], [], []
+    for line, record in chunk:
+        try:
+            transactions.append(transaction_from_record(record, accounts))
+            lines.append(line)
+        except ValidationError as e:
+            errors.append((line, e.messages[0]))
+    results = post_transactions(transactions, all_or_nothing=False) if transactions else []
+    errors += [(line, str(error)) for line, error in zip(lines, results) if error]
+    return len(transactions) - sum(1 for error in results if error), sorted(errors)
+
+IMPORTERS = {
+    'accounts': import_accounts,
+    'transactions': import_transactions,
+}
+
+
+def file_format(path, given=None):
+    """csv or jsonl: the given one, or the one of the file's extension. Raises ValueError"""
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    if given or extension in IMPORT_FORMATS:
+        return given or IMPORT_FORMATS[extension]
+    raise ValueError("Can't tell the format of %s from its extension; give it" % path)
+
+def chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def import_file(path, kind, given_format=None, chunk_size=IMPORT_CHUNK_SIZE, restart=False):
+    """
+    Import the accounts or transactions (kind) of a file, continuing after the part imported by previous runs unless restart (which doesn't undo anything).
+    A generator: after each chunk is committed, it yields (LedgerImport with the totals so far, records in the chunk, [(line, error message)] of the chunk). Raises ValueError if the file was imported already, or is being imported by another run
+    """
+    fmt = file_format(path, given_format)
+    path = os.path.abspath(path)
+    state = LedgerImport.objects.get_or_create(path=path)[0]
+    if restart:
+        state.offset = state.line = state.imported = state.rejected = 0
+        state.finished = False
+        state.save()
+    if state.finished:
+        raise ValueError("%s was imported already (%i records, %i rejected). Use --restart to import it again" % (path, state.imported, state.rejected))
+    importer = IMPORTERS[kind]
+
+    with open(path, 'rb') as f:
+        source = ImportFile(f, fmt, state.offset, state.line)
+        for chunk in chunks(source.records(), chunk_size):
+            with transaction.atomic():
+                # Checks that nobody else moved the checkpoint since we read it, and keeps others out until we commit
+                moved = LedgerImport.objects.filter(pk=state.pk, offset=state.offset).update(offset=source.offset, line=source.line, last_run=timezone.now())
+                if not moved:
+                    raise ValueError("%s is being imported by another run" % path)
+                imported, errors = importer(chunk)
+                LedgerImport.objects.filter(pk=state.pk).update(imported=F('imported') + imported, rejected=F('rejected') + len(errors))
+            state.offset, state.line = source.offset, source.line
+            state.imported += imported
+            state.rejected += len(errors)
+            yield state, len(chunk), errors
+    state.finished = True
+    state.last_run = timezone.now()
+    state.save(update_fields=['finished', 'last_run'])
@@ -0,0 +1,145 @@
+"""
+Full consistency check of the database: every transaction against the rules of Transaction.clean (and those of Transaction.save), and the balance of every account against the sum of its transactions.
+Nothing is checked row by row in Python. Transactions are read in chunks of ids, and each chunk is checked with 1 query which returns only the rows breaking a rule (the rules are written as SQL conditions, see TRANSACTION_RULES). Balances are recomputed for ranges of account ids with 2 GROUP BY queries (money in, money out).
+Chunks and ranges are checked in parallel by a pool of processes.
+"""
+import json
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q, F, Sum, Case, When, Value, IntegerField, Max, Min, OuterRef, Subquery
+
+from accounts.models import Account, Transaction, OPERATION_TYPES
+from accounts.money import money_field
+from accounts.routers import read_from_replica
+
+TRANSACTION_CHUNK_SIZE = 100000 # transactions checked per query
+ACCOUNT_CHUNK_SIZE = 10000 # account ids per pair of GROUP BY queries
+
+def has(field):
+    """Like "if self.field" in Transaction.clean: not null, and not 0 for amounts"""
+    return Q(**{'%s__isnull' % field: False}) & ~Q(**{field: 0}) if field.endswith('amount') else Q(**{'%s__isnull' % field: False})
+
+# (message, condition matched by the transactions which break the rule). The first ones are Transaction.clean, with its messages
+TRANSACTION_RULES = [
+    ("Deposits must have just a destination amount", Q(op_type='dep') & (has('source_amount') | ~has('dest_amount'))),
+    ("Deposits must have just a destination account", Q(op_type='dep') & (has('source_acc') | ~has('dest_acc'))),
+    ("Withdrawals must have just a source amount", Q(op_type='wd') & (~has('source_amount') | has('dest_amount'))),
+    ("Withdrawals must have just a source account", Q(op_type='wd') & (~has('source_acc') | has('dest_acc'))),
+    ("Transfers must have both amounts", Q(op_type='tra') & (~has('source_amount') | ~has('dest_amount'))),
+    ("Transfers must have both accounts", Q(op_type='tra') & (~has('source_acc') | ~has('dest_acc'))),
+    ("Unknown operation type", ~Q(op_type__in=[code for code, name in OPERATION_TYPES])),
+    # Transaction.save
+    ("Amounts must be positive", Q(source_amount__lt=0) | Q(dest_amount__lt=0)),
+    ("Can't transfer to same account", Q(source_acc=F('dest_acc'))),
+]
+
+
+@read_from_replica()
+def check_transactions(first_id, last_id):
+    """[(transaction id, message)] of the transactions with first_id <= id < last_id which break a rule (only the first rule broken by each)"""
+    broken_rule = Case(*[When(condition, then=Value(i)) for i, (message, condition) in enumerate(TRANSACTION_RULES)], output_field=IntegerField())
+    rows = Transaction.objects.filter(id__gte=first_id, id__lt=last_id).annotate(broken_rule=broken_rule).filter(broken_rule__isnull=False).order_by('id').values_list('id', 'broken_rule')
+    return [(pk, TRANSACTION_RULES[rule][0]) for pk, rule in rows]
+
+def transaction_sum(side, amount):
+    """Subquery: sum of the amounts of the transactions of the (outer) account on 1 side"""
+    transactions = Transaction.objects.filter(**{side: OuterRef('pk')}).order_by().values(side).annotate(total=Sum(amount)).values('total')
+    return Subquery(transactions, output_field=money_field())
+
+@read_from_replica()
+def check_balances(first_id, last_id):
+    """
+    Compare the balance of the accounts with first_id <= id < last_id with the sum of their transactions. Returns (accounts checked, [problems as dicts])
+    Money in and out are summed with 1 GROUP BY query each. Transactions posted meanwhile can make an account look wrong, so those that do are checked again with 1 statement which reads the balance and the sums together
+    """
+    in_range = dict(dest_acc__gte=first_id, dest_acc__lt=last_id)
+    money_in = dict(Transaction.objects.filter(**in_range).order_by().values_list('dest_acc').annotate(total=Sum('dest_amount')))
+    in_range = dict(source_acc__gte=first_id, source_acc__lt=last_id)
+    money_out = dict(Transaction.objects.filter(**in_range).order_by().values_list('source_acc').annotate(total=Sum('source_amount')))
+    accounts = Account.objects.with_shards().filter(id__gte=first_id, id__lt=last_id)
+    checked = 0
+    suspects = []
+    for pk, balance in accounts.values_list('pk', 'current_balance').iterator():
+        checked += 1
+        if balance != money_in.get(pk, 0) - money_out.get(pk, 0) or balance < 0:
+            suspects.append(pk)
+    problems = []
+    if suspects:
+        rows = accounts.filter(pk__in=suspects).annotate(money_in=transaction_sum('dest_acc', 'dest_amount'), money_out=transaction_sum('source_acc', 'source_amount'))
+        for number, balance, money_in, money_out in rows.values_list('number', 'current_balance', 'money_in', 'money_out'):
+            expected = (money_in or 0) - (money_out or 0)
+            if balance != expected:
+                problems.append({'account': number, 'problem': "Balance doesn't match the transactions", 'balance': balance, 'expected': expected, 'difference': balance - expected})
+            elif balance < 0:
+                problems.append({'account': number, 'problem': "Negative balance", 'balance': balance})
+    return checked, problems
+
+def run_task(task):
+    """Runs in the worker processes"""
+    kind, first_id, last_id = task
+    if kind == 'transactions':
+        return kind, last_id - first_id, check_transactions(first_id, last_id)
+    return (kind,) + check_balances(first_id, last_id)
+
+@read_from_replica()
+def id_ranges(model, size):
+    """[(first, last)) ranges of ids covering all the rows of the model, "size" ids each"""
+    ids = model.objects.aggregate(first=Min('id'), last=Max('id'))
+    if ids['first'] is None:
+        return []
+    return [(start, min(start + size, ids['last'] + 1)) for start in range(ids['first'], ids['last'] + 1, size)]
+
+
+def check_ledger(workers=1, transaction_chunk_size=TRANSACTION_CHUNK_SIZE, account_chunk_size=ACCOUNT_CHUNK_SIZE, max_listed=1000):
+    """The report (a dict) of checking everything, with up to max_listed problems of each kind"""
+    tasks = [('transactions',) + r for r in id_ranges(Transaction, transaction_chunk_size)] + [('accounts',) + r for r in id_ranges(Account, account_chunk_size)]
+    began = time.time()
+    if workers > 1 and len(tasks) > 1:
+        # The children must open their own DB connections, not share ours
+        connections.close_all()
+        with multiprocessing.Pool(workers) as pool:
+            results = list(pool.imap_unordered(run_task, tasks))
+    else:
+        results = [run_task(task) for task in tasks]
+
+    report = {'transaction_ids_checked': 0, 'accounts_checked': 0, 'invalid_transactions': 0, 'account_problems': 0, 'transactions': [], 'accounts': []}
+    for kind, checked, problems in results:
+        if kind == 'transactions':
+            report['transaction_ids_checked'] += checked
+            report['invalid_transactions'] += len(problems)
+            report['transactions'].extend({'transaction': pk, 'problem': message} for pk, message in problems)
+        else:
+            report['accounts_checked'] += checked
+            report['account_problems'] += len(problems)
+            report['accounts'].extend(problems)
+    report['transactions'] = sorted(report['transactions'], key=lambda p: p['transaction'])[:max_listed]
+    report['accounts'] = sorted(report['accounts'], key=lambda p: p['account'])[:max_listed]
+    report['ok'] = not (report['invalid_transactions'] or report['account_problems'])
+    report['seconds'] = round(time.time() - began, 3)
+    return report
+
+
+class Command(BaseCommand):
+    help = "Check every transaction (rules of Transaction.clean) and the balance of every account (against its transactions), in parallel. Writes a JSON report; fails (exit code 1) if anything is wrong"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="Processes checking chunks in parallel")
+        parser.add_argument('--chunk-size', type=int, default=TRANSACTION_CHUNK_SIZE, help="Transaction ids per query")
+        parser.add_argument('--account-chunk-size', type=int, default=ACCOUNT_CHUNK_SIZE, help="Account ids per pair of GROUP BY queries")
+        parser.add_argument('--max-listed', type=int, default=1000, help="Problems of each kind listed in the report (all are counted)")
+        parser.add_argument('--output', help="File for the JSON report. Default: standard output")
+
+    def handle(self, *args, **options):
+        report = check_ledger(options['workers'], options['chunk_size'], options['account_chunk_size'], options['max_listed'])
+        text = json.dumps(report, cls=DjangoJSONEncoder, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(text + '\n')
+        else:
+            self.stdout.write(text)
+        if not report['ok']:
+            raise CommandError("%i invalid transactions, %i accounts with problems" % (report['invalid_transactions'], report['account_problems']))
@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.models import Account
+from accounts.shards import compact_balance_shards, set_shard_count
+
+
+class Command(BaseCommand):
+    help = "Move the balance shards of sharded accounts into their balance (see AccountBalanceShard). Run it periodically, or with --loop. With --shards, set the number of shards of the given accounts instead (0 turns sharding off)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('numbers', nargs='*', type=int, help="Account numbers (default: all sharded accounts)")
+        parser.add_argument('--shards', type=int, help="Number of shards to give to the accounts")
+        parser.add_argument('--loop', action='store_true', help="Keep running, compacting every --interval seconds")
+        parser.add_argument('--interval', type=float, default=settings.BALANCE_SHARD_COMPACTION_INTERVAL)
+
+    def handle(self, *args, **options):
+        accounts = Account.objects.filter(number__in=options['numbers']) if options['numbers'] else None
+        if options['numbers']:
+            missing = set(options['numbers']) - set(accounts.values_list('number', flat=True))
+            if missing:
+                raise CommandError("Accounts not found: %s" % ", ".join(str(n) for n in sorted(missing)))
+        if options['shards'] is not None:
+            if not options['numbers'] or options['shards'] < 0:
+                raise CommandError("--shards needs account numbers, and can't be negative")
+            for account in accounts:
+                set_shard_count(account, options['shards'])
+            self.stdout.write("%i accounts now have %i balance shards" % (len(options['numbers']), options['shards']))
+            return
+        while True:
+            compacted, moved = compact_balance_shards(accounts)
+            if compacted or not options['loop']:
+                self.stdout.write("%i accounts compacted, %s moved" % (compacted, moved))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,66 @@
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from accounts.models import Account
+from accounts.routers import read_from_replica
+from accounts.statements import STATEMENT_FORMATS, statement_rows, parse_day
+
+
+@read_from_replica()
+def export_account(args):
+    """Write the statement of 1 account to <directory>/<number>.<extension>. Returns (number, rows written). Runs in the worker processes"""
+    number, directory, statement_format, start, end = args
+    account = Account.objects.get(number=number)
+    content_type, extension, lines = STATEMENT_FORMATS[statement_format]
+    rows = 0
+    with open(os.path.join(directory, '%i.%s' % (number, extension)), 'w', newline='') as f:
+        for line in lines(statement_rows(account, start, end)):
+            f.write(line)
+            rows += 1
+    if statement_format == 'csv':
+        rows -= 1 # header
+    return number, rows
+
+
+class Command(BaseCommand):
+    help = "Write the statements (transactions with the balance after each one) of some or all accounts, 1 file per account. Files are written while the history is read in chunks, so any length of history is fine"
+
+    def add_arguments(self, parser):
+        parser.add_argument('accounts', nargs='*', type=int, help="Account numbers. Default: all accounts")
+        parser.add_argument('--format', choices=sorted(STATEMENT_FORMATS), default='csv')
+        parser.add_argument('--start', help="First day, YYYY-MM-DD")
+        parser.add_argument('--end', help="Last day (included), YYYY-MM-DD")
+        parser.add_argument('--output-dir', default='statements')
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="Processes exporting accounts in parallel")
+
+    def handle(self, *args, **options):
+        try:
+            start = parse_day(options['start'])
+            end = parse_day(options['end'], next_day=True)
+        except ValueError as e:
+            raise CommandError(str(e))
+        numbers = options['accounts']
+        if numbers:
+            missing = set(numbers) - set(Account.objects.filter(number__in=numbers).values_list('number', flat=True))
+            if missing:
+                raise CommandError("Accounts not found: %s" % ", ".join(str(n) for n in sorted(missing)))
+        else:
+            numbers = list(Account.objects.order_by('number').values_list('number', flat=True))
+        if not os.path.isdir(options['output_dir']):
+            os.makedirs(options['output_dir'])
+        tasks = [(number, options['output_dir'], options['format'], start, end) for number in numbers]
+
+        began = time.time()
+        if options['workers'] > 1:
+            # The children must open their own DB connections, not share ours
+            connections.close_all()
+            with multiprocessing.Pool(options['workers']) as pool:
+                results = list(pool.imap_unordered(export_account, tasks, chunksize=10))
+        else:
+            results = [export_account(task) for task in tasks]
+        rows = sum(r for n, r in results)
+        self.stdout.write("%i accounts, %i statement rows exported to %s in %.1f s" % (len(results), rows, options['output_dir'], time.time() - began))
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.ledger_import import IMPORT_CHUNK_SIZE, IMPORTERS, import_file
+
+
+class Command(BaseCommand):
+    help = "Import accounts or historical transactions from a CSV or JSON-lines file, in chunks of 1 DB transaction each. If it's interrupted, run it again: it continues after the last imported chunk. See accounts/ledger_import.py for the columns"
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+        parser.add_argument('--type', choices=sorted(IMPORTERS), default='transactions', help="What the file has. Import the accounts before their transactions")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Default: from the file extension")
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, help="Records per DB transaction")
+        parser.add_argument('--restart', action='store_true', help="Read the file from the beginning, even if it was (partly) imported before")
+
+    def handle(self, *args, **options):
+        began = time.time()
+        records = 0
+        state = None
+        try:
+            for state, chunk_records, errors in import_file(options['file'], options['type'], options['format'], options['chunk_size'], options['restart']):
+                for line, error in errors:
+                    self.stderr.write("Line %i: %s" % (line, error))
+                records += chunk_records
+                self.stdout.write("Line %i: %i imported, %i rejected (%.0f records/s)" % (state.line, state.imported, state.rejected, records / max(time.time() - began, 1e-6)))
+        except ValueError as e:
+            raise CommandError(str(e))
+        except IOError as e:
+            raise CommandError("Can't read %s: %s" % (options['file'], e))
+        if state is None:
+            self.stdout.write("Nothing new to import")
+        else:
+            self.stdout.write("Done in %.1f s: %i imported, %i rejected" % (time.time() - began, state.imported, state.rejected))
@@ -0,0 +1,35 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+
+from accounts.transaction_queue import process_queue
+
+
+class Command(BaseCommand):
+    help = "Post the transactions queued by the API in asynchronous mode (TRANSACTION_QUEUE), in batches: each batch is 1 DB transaction. See accounts/transaction_queue.py"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.TRANSACTION_QUEUE_BATCH_SIZE, help="Operations posted per DB transaction")
+        parser.add_argument('--loop', action='store_true', help="Keep running: post batches while there are queued operations, then wait --interval seconds for more")
+        parser.add_argument('--interval', type=float, default=settings.TRANSACTION_QUEUE_POLL_INTERVAL)
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                posted, failed = process_queue(options['batch_size'])
+            except DatabaseError as e:
+                # e.g. balances changed by a request while posting (see post_transactions). Nothing was posted; the batch is tried again
+                if not options['loop']:
+                    raise
+                self.stderr.write("Batch not posted, retrying: %s" % e)
+                time.sleep(options['interval'])
+                continue
+            if posted or failed or not options['loop']:
+                self.stdout.write("%i operations posted, %i failed" % (posted, failed))
+            if not options['loop']:
+                return
+            if posted + failed < options['batch_size']:
+                # The queue is empty; when it's not, the next batch starts right away
+                time.sleep(options['interval'])
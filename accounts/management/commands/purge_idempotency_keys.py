@@ -0,0 +1,31 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from accounts.models import IdempotencyKey
+
+
+def purge_idempotency_keys(older_than, batch_size=10000):
+    """Delete the stored responses created before older_than, in batches (each one is 1 DELETE … WHERE id IN …), so that the table isn't locked for long. Returns how many were deleted"""
+    deleted = 0
+    old_keys = IdempotencyKey.objects.filter(creation_date__lt=older_than).order_by('id')
+    while True:
+        ids = list(old_keys.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        IdempotencyKey.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+
+
+class Command(BaseCommand):
+    help = "Delete the responses stored for idempotency keys older than IDEMPOTENCY_KEY_TTL. Run it periodically (e.g. daily from cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=int, default=settings.IDEMPOTENCY_KEY_TTL, help="Age in seconds")
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        deleted = purge_idempotency_keys(timezone.now() - datetime.timedelta(seconds=options['ttl']), options['batch_size'])
+        self.stdout.write("%i idempotency keys deleted" % deleted)
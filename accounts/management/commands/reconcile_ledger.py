@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max, Sum, OuterRef, Subquery, Case, When, Value, F
+from django.utils import timezone
+
+from accounts.models import Account, LedgerEntry, ReconciledBalance, ReconciliationState
+from accounts.money import money_field
+
+
+def sum_entries_after(entry_id):
+    """Subquery: sum of the ledger entries of the (outer) account after entry_id. It uses the (account, id) index, so it only reads those entries"""
+    entries = LedgerEntry.objects.filter(account=OuterRef('pk'), id__gt=entry_id).order_by().values('account').annotate(total=Sum('amount')).values('total')
+    return Subquery(entries, output_field=money_field())
+
+
+def reconcile(full=False):
+    """
+    Check that the balance of each account is the sum of its ledger entries, reading only the entries added since the last run (ReconciliationState.last_entry_id) and the accounts they touch.
+    For each account we keep the sum of its entries up to the last checked entry (ReconciledBalance), and add the new ones with 1 GROUP BY query.
+    With full=True, all entries and all accounts are checked again from zero.
+    Returns (number of new entries, number of checked accounts, list of discrepancies as dicts)
+    """
+    with transaction.atomic():
+        # Locking the state row prevents 2 runs at the same time
+        state = ReconciliationState.objects.select_for_update().first() or ReconciliationState.objects.create()
+        start = 0 if full else state.last_entry_id
+        watermark = LedgerEntry.objects.aggregate(last=Max('id'))['last'] or 0
+        new_sums = dict(LedgerEntry.objects.filter(id__gt=start, id__lte=watermark).order_by().values_list('account').annotate(total=Sum('amount')))
+        new_entries = LedgerEntry.objects.filter(id__gt=start, id__lte=watermark).count()
+
+        if full:
+            ReconciledBalance.objects.all().delete()
+            accounts = Account.objects.all()
+            previous_sums = {}
+        else:
+            accounts = Account.objects.filter(pk__in=list(new_sums))
+            previous_sums = dict(ReconciledBalance.objects.filter(account__in=list(new_sums)).values_list('account', 'balance'))
+
+        # Postings committed while we run have entries after the watermark and are already in the balance. Subtract them in the same statement that reads the balance, so that we compare both at the same point
+        discrepancies = []
+        sums = {}
+        checked = 0
+        for pk, number, balance, later in accounts.with_shards().annotate(later=sum_entries_after(watermark)).values_list('pk', 'number', 'current_balance', 'later').iterator():
+            checked += 1
+            expected = balance - (later or 0)
+            ledger_sum = previous_sums.get(pk, 0) + new_sums.get(pk, 0)
+            if ledger_sum != expected:
+                # An entry with a lower id may have been committed after our last run, so sum this account from the beginning before complaining
+                ledger_sum = LedgerEntry.objects.filter(account=pk, id__lte=watermark).aggregate(total=Sum('amount'))['total'] or 0
+                if ledger_sum != expected:
+                    discrepancies.append({'account': number, 'balance': expected, 'ledger': ledger_sum, 'difference': expected - ledger_sum})
+            sums[pk] = ledger_sum
+
+        existing = set(ReconciledBalance.objects.filter(account__in=list(sums)).values_list('account', flat=True))
+        changed = [When(account=pk, then=Value(sums[pk])) for pk in existing if sums[pk] != previous_sums.get(pk)]
+        if changed:
+            ReconciledBalance.objects.filter(account__in=list(existing)).update(balance=Case(*changed, default=F('balance'), output_field=money_field()))
+        ReconciledBalance.objects.bulk_create([ReconciledBalance(account_id=pk, balance=total) for pk, total in sums.items() if pk not in existing])
+        state.last_entry_id = watermark
+        state.last_run = timezone.now()
+        state.save()
+    return new_entries, checked, discrepancies
+
+
+class Command(BaseCommand):
+    help = "Check that the balance of each account matches its ledger entries. Only entries added since the last run are read, so it's cheap to run often. Fails (exit code 1) if there are discrepancies"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="Check all entries and accounts again, not only the new ones")
+
+    def handle(self, *args, **options):
+        new_entries, checked, discrepancies = reconcile(full=options['full'])
+        for d in discrepancies:
+            self.stderr.write("Account %(account)i: balance %(balance)s, ledger %(ledger)s, difference %(difference)s" % d)
+        self.stdout.write("%i new ledger entries, %i accounts checked, %i discrepancies" % (new_entries, checked, len(discrepancies)))
+        if discrepancies:
+            raise CommandError("Balances don't match the ledger")
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from accounts.currency import CurrencyRateError, allowed_currency_codes
+from accounts.models import CurrencyRate
+from accounts.money import quantize_rate
+
+
+async def fetch_all(provider, currencies):
+    """Ask the provider for the rates of each base currency, all at the same time (the providers are blocking, so each call runs in a thread). Returns [(base, {dest: rate}, date)]"""
+    loop = asyncio.get_event_loop()
+    calls = [loop.run_in_executor(None, provider.fetch_base, base, [c for c in currencies if c != base]) for base in currencies]
+    results = await asyncio.gather(*calls)
+    return [(base, rates, date) for base, (rates, date) in zip(currencies, results)]
+
+
+def refresh(provider, currencies):
+    """
+    Fetch the rates of all pairs of currencies and store them in the CurrencyRate table, all with the same fetched_at. Nothing is stored if some of them fail, so the latest rows are always a full matrix.
+    Returns the number of stored rates
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(fetch_all(provider, currencies))
+    finally:
+        loop.close()
+    fetched_at = timezone.now()
+    rows = []
+    for base, rates, date in results:
+        for dest in currencies:
+            if dest == base:
+                continue
+            if dest not in rates:
+                raise CurrencyRateError("No rate for %s→%s" % (base, dest))
+            rows.append(CurrencyRate(source=base, dest=dest, rate=quantize_rate(rates[dest]), date=date, fetched_at=fetched_at))
+    CurrencyRate.objects.bulk_create(rows)
+    return len(rows)
+
+
+class Command(BaseCommand):
+    help = "Get the current exchange rates of all pairs of currencies from CURRENCY_RATE_SOURCE_PROVIDER and store them in the CurrencyRate table, from which new transactions read them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help="Don't exit; refresh again every --interval seconds")
+        parser.add_argument('--interval', type=int, default=settings.CURRENCY_RATE_REFRESH_INTERVAL)
+
+    def handle(self, *args, **options):
+        provider = import_string(settings.CURRENCY_RATE_SOURCE_PROVIDER)()
+        currencies = allowed_currency_codes()
+        while True:
+            try:
+                count = refresh(provider, currencies)
+                self.stdout.write("%i currency rates stored" % count)
+            except CurrencyRateError as e:
+                if not options['loop']:
+                    raise CommandError(str(e))
+                # keep the old rates and try again later
+                self.stderr.write("Couldn't refresh currency rates: %s" % e)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,23 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from accounts.summaries import update_daily_summaries
+
+
+class Command(BaseCommand):
+    help = "Add the ledger entries created since the last run to the daily summaries (per account and per currency). Cheap to run often, e.g. every few minutes from cron, or with --loop"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--settle', type=int, default=settings.DAILY_SUMMARY_SETTLE_SECONDS, help="Only read transactions created at least this many seconds ago")
+        parser.add_argument('--loop', action='store_true', help="Keep running, every --interval seconds")
+        parser.add_argument('--interval', type=int, default=60)
+
+    def handle(self, *args, **options):
+        while True:
+            entries, account_rows, currency_rows = update_daily_summaries(options['settle'])
+            self.stdout.write("%i new ledger entries, %i account summaries and %i currency summaries written" % (entries, account_rows, currency_rows))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 11:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def compute_balances_after(apps, schema_editor):
+    """
+    Fill the balances of existing transactions: for each one, the sum of the transactions of the account up to it, in (date, id) order.
+    1 UPDATE per side, with subqueries, instead of replaying each account in Python with 1 UPDATE per transaction
+    """
+    Transaction = apps.get_model('accounts', 'Transaction')
+    money = models.DecimalField(max_digits=17, decimal_places=5)
+    until = models.Q(date__lt=OuterRef('date')) | models.Q(date=OuterRef('date'), id__lte=OuterRef('id'))
+
+    def total(account_field, side, amount):
+        """Sum of the amounts of the transactions up to the outer one, on 1 side of its account_field account"""
+        rows = Transaction.objects.filter(until, **{side: OuterRef(account_field)}).order_by().values(side).annotate(total=models.Sum(amount)).values('total')
+        return Coalesce(Subquery(rows, output_field=money), Value(0), output_field=money)
+
+    for account_field, balance_field in (('source_acc', 'source_balance_after'), ('dest_acc', 'dest_balance_after')):
+        balance = total(account_field, 'dest_acc', 'dest_amount') - total(account_field, 'source_acc', 'source_amount')
+        Transaction.objects.filter(**{'%s__isnull' % account_field: False}).update(**{balance_field: balance})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0005_auto_20170602_1326'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='dest_balance_after',
+            field=models.DecimalField(blank=True, decimal_places=5, help_text='Balance of the destination account after this transaction', max_digits=17, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='source_balance_after',
+            field=models.DecimalField(blank=True, decimal_places=5, help_text='Balance of the source account after this transaction', max_digits=17, null=True),
+        ),
+        migrations.RunPython(compute_balances_after, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 11:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def create_sequence(apps, schema_editor):
+    """The next number is the one after the biggest one used until now"""
+    Account = apps.get_model('accounts', 'Account')
+    AccountNumberSequence = apps.get_model('accounts', 'AccountNumberSequence')
+    last_number = Account.objects.aggregate(last_number=models.Max('number'))['last_number']
+    AccountNumberSequence.objects.create(pk=1, next_number=last_number+1 if last_number else 10**7)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_transaction_history_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountNumberSequence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('next_number', models.PositiveIntegerField(default=10000000)),
+            ],
+        ),
+        migrations.RunPython(create_sequence, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 11:51
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_ledger_entries(apps, schema_editor):
+    """1 entry per account of each existing transaction"""
+    Transaction = apps.get_model('accounts', 'Transaction')
+    LedgerEntry = apps.get_model('accounts', 'LedgerEntry')
+    entries = []
+    for tr in Transaction.objects.order_by('id').iterator():
+        if tr.source_acc_id:
+            entries.append(LedgerEntry(transaction_id=tr.id, account_id=tr.source_acc_id, amount=-tr.source_amount))
+        if tr.dest_acc_id:
+            entries.append(LedgerEntry(transaction_id=tr.id, account_id=tr.dest_acc_id, amount=tr.dest_amount))
+    LedgerEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_account_number_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=5, help_text="Change in the account's balance, in the account's currency", max_digits=17)),
+            ],
+            options={
+                'verbose_name_plural': 'ledger entries',
+            },
+        ),
+        migrations.CreateModel(
+            name='ReconciledBalance',
+            fields=[
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='reconciled_balance', serialize=False, to='accounts.Account')),
+                ('balance', models.DecimalField(decimal_places=5, default=0, max_digits=17)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReconciliationState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_entry_id', models.PositiveIntegerField(default=0)),
+                ('last_run', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='ledgerentry',
+            name='account',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='accounts.Account'),
+        ),
+        migrations.AddField(
+            model_name='ledgerentry',
+            name='transaction',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='accounts.Transaction'),
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['account', 'id'], name='ledgerentry_account_id_idx'),
+        ),
+        migrations.RunPython(create_ledger_entries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 11:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CurrencyRate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(choices=[('USD', 'USD: US dollar'), ('EUR', 'EUR: Euro'), ('GBP', 'GBP: British pound'), ('CHF', 'CHF: Swiss frank')], max_length=3)),
+                ('dest', models.CharField(choices=[('USD', 'USD: US dollar'), ('EUR', 'EUR: Euro'), ('GBP', 'GBP: British pound'), ('CHF', 'CHF: Swiss frank')], max_length=3)),
+                ('rate', models.DecimalField(decimal_places=10, max_digits=20)),
+                ('date', models.DateTimeField(blank=True, help_text='Date for which the rate is valid, as given by the provider', null=True)),
+                ('fetched_at', models.DateTimeField(help_text='When we got this rate from the provider')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='currency_date',
+            field=models.DateTimeField(blank=True, help_text='Date for which the exchange rate was valid, as given by the rate provider', null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='currency_rate',
+            field=models.DecimalField(blank=True, decimal_places=10, help_text='Exchange rate used in this transaction (1 source currency = this in destination currency)', max_digits=20, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='currencyrate',
+            index=models.Index(fields=['fetched_at'], name='currencyrate_fetched_at_idx'),
+        ),
+    ]
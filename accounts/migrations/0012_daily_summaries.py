@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0011_idempotency_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyAccountSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('inflow', models.DecimalField(decimal_places=5, default=0, help_text='Money that came in', max_digits=17)),
+                ('outflow', models.DecimalField(decimal_places=5, default=0, help_text='Money that went out (positive)', max_digits=17)),
+                ('transactions', models.PositiveIntegerField(default=0)),
+                ('closing_balance', models.DecimalField(decimal_places=5, max_digits=17)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_summaries', to='accounts.Account')),
+            ],
+            options={
+                'verbose_name_plural': 'daily account summaries',
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyCurrencySummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(choices=[('USD', 'USD: US dollar'), ('EUR', 'EUR: Euro'), ('GBP', 'GBP: British pound'), ('CHF', 'CHF: Swiss frank')], max_length=3)),
+                ('day', models.DateField()),
+                ('inflow', models.DecimalField(decimal_places=5, default=0, max_digits=17)),
+                ('outflow', models.DecimalField(decimal_places=5, default=0, max_digits=17)),
+                ('deposits', models.DecimalField(decimal_places=5, default=0, max_digits=17)),
+                ('withdrawals', models.DecimalField(decimal_places=5, default=0, max_digits=17)),
+                ('transactions', models.PositiveIntegerField(default=0)),
+                ('closing_balance', models.DecimalField(decimal_places=5, help_text='Sum of the balances of all accounts of this currency at the end of the day', max_digits=17)),
+            ],
+            options={
+                'verbose_name_plural': 'daily currency summaries',
+            },
+        ),
+        migrations.CreateModel(
+            name='SummaryState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_entry_id', models.PositiveIntegerField(default=0)),
+                ('last_run', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailycurrencysummary',
+            unique_together=set([('currency', 'day')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyaccountsummary',
+            unique_together=set([('account', 'day')]),
+        ),
+    ]
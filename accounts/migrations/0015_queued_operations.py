@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:27
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('accounts', '0014_account_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedOperation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField()),
+                ('op_type', models.CharField(choices=[('dep', 'Deposit (add money)'), ('wd', 'Withdrawal (take money)'), ('tra', 'Transfer (move money)')], max_length=3)),
+                ('source_amount', models.DecimalField(blank=True, decimal_places=5, max_digits=17, null=True)),
+                ('dest_amount', models.DecimalField(blank=True, decimal_places=5, max_digits=17, null=True)),
+                ('currency_rate', models.DecimalField(blank=True, decimal_places=10, max_digits=20, null=True)),
+                ('currency_date', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('queued', 'Waiting to be posted'), ('done', 'Posted'), ('failed', 'Rejected when posting')], default='queued', max_length=6)),
+                ('error', models.CharField(blank=True, help_text='Error code (see errors.py) if it failed', max_length=20)),
+                ('creation_date', models.DateTimeField(auto_now_add=True)),
+                ('processed_date', models.DateTimeField(blank=True, null=True)),
+                ('dest_acc', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.Account')),
+                ('source_acc', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.Account')),
+                ('transaction', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='queued_operation', to='accounts.Transaction')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='queued_operations', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='queuedoperation',
+            index=models.Index(fields=['status', 'id'], name='queuedoperation_status_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0015_queued_operations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountBalanceShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('balance', models.DecimalField(decimal_places=5, default=0, max_digits=17)),
+                ('version', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='account',
+            name='shard_count',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, help_text='Balance shards; 0 means not sharded'),
+        ),
+        migrations.AddField(
+            model_name='accountbalanceshard',
+            name='account',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_shards', to='accounts.Account'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='accountbalanceshard',
+            unique_together=set([('account', 'shard')]),
+        ),
+    ]
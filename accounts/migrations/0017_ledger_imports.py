@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:35
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0016_balance_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerImport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(help_text='Absolute path of the imported file', max_length=255, unique=True)),
+                ('offset', models.BigIntegerField(default=0, help_text='Bytes of the file already imported')),
+                ('line', models.PositiveIntegerField(default=0, help_text='Lines of the file already imported')),
+                ('imported', models.PositiveIntegerField(default=0)),
+                ('rejected', models.PositiveIntegerField(default=0)),
+                ('finished', models.BooleanField(default=False)),
+                ('last_run', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -1,6 +1,16 @@
+from collections import OrderedDict
+import itertools
+import random
+import threading
+from django.conf import settings
 from django.db import models
+from django.db.models import F, Q, Case, When, Value, Max
+from django.db.models.functions import Coalesce
 from django.core.exceptions import ValidationError
-from django.db import transaction
+from django.db import transaction, connection, connections, router, DatabaseError
+from accounts.errors import ApiError
+from accounts.money import MONEY_MAX_DIGITS, MONEY_DECIMAL_PLACES, RATE_MAX_DIGITS, RATE_DECIMAL_PLACES, money_field, quantize_money
+from accounts.instrumentation import stage
 
 
 ALLOWED_CURRENCIES = [
@@ -14,32 +24,141 @@ OPERATION_TYPES = [
     ("wd", "Withdrawal (take money)"),
     ("tra", "Transfer (move money)"), # with same or different currency
 ]
-# For consistent use of numbers representing currency amounts: 00111222333.12345
-MONEY_MAX_DIGITS=12+5
-MONEY_DECIMAL_PLACES=5
+# Digits of amounts and rates, and their rounding: see money.py
+
+FIRST_ACCOUNT_NUMBER = 10**7 # "one, and seven zeros"
+LAST_ACCOUNT_NUMBER = 10**8-1
 
 def validate_8digits(number):
-    if not (10000000 <= number <= 99999999):
+    if not (FIRST_ACCOUNT_NUMBER <= number <= LAST_ACCOUNT_NUMBER):
         raise ValidationError("Account numbers must be 8 digits. Yours has %i"%len(str(number)))
 
+class AccountQuerySet(models.QuerySet):
+    def with_shards(self):
+        """
+        Annotates current_balance and current_version: balance and version plus those of the account's shards (see AccountBalanceShard).
+        Only sharded accounts read their shards (a SUM over shard_count indexed rows); for the others they're balance and version
+        """
+        shards = AccountBalanceShard.objects.filter(account=models.OuterRef('pk')).order_by().values('account')
+        money = money_field()
+        return self.annotate(
+            current_balance=Case(When(shard_count=0, then=F('balance')), default=F('balance') + Coalesce(models.Subquery(shards.annotate(total=models.Sum('balance')).values('total'), output_field=money), 0), output_field=money),
+            current_version=Case(When(shard_count=0, then=F('version')), default=F('version') + Coalesce(models.Subquery(shards.annotate(total=models.Sum('version')).values('total'), output_field=models.IntegerField()), 0), output_field=models.IntegerField()),
+        )
+
+
 class Account(models.Model):
     number = models.PositiveIntegerField(help_text="Account number, 8 digits",unique=True,blank=True,null=False,validators=[validate_8digits])
     currency = models.CharField(max_length=3,choices=ALLOWED_CURRENCIES)
     creation_date = models.DateTimeField(auto_now_add=True)
-    # To store the current balance there are safer ways. E.g. We could store the balance after EACH operation, not only the current one. Then we would also need to verify that all partial balances match. I did this for other project, and it's a lot of validations; more than what this demo requires. So I save just the latest balance
+    # Latest balance. Each Transaction also stores the balance after it (source_balance_after/dest_balance_after), so the history doesn't need to be recomputed
     balance = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,help_text="Latest balance",default=0,blank=False,null=False)
+    # Increased by every change of the account (each UPDATE of the balance, each save), so that cached pages of the account can be keyed on it and are never stale. See views.py
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # Sharded accounts (for accounts which receive many deposits at the same time): credits go to 1 of shard_count AccountBalanceShard rows, and the balance is "balance" plus the shards. See AccountBalanceShard
+    shard_count = models.PositiveSmallIntegerField(default=0, editable=False, help_text="Balance shards; 0 means not sharded")
+
+    objects = AccountQuerySet.as_manager()
 
     def __str__(self):
         return "Account number %i"%self.number
 
-    def save(self):
+    def save(self, *args, **kwargs):
         if not self.number:
             # Give sequential IDs automatically. 8 digits!
-            try:
-                self.number = Account.objects.latest('number').number+1
-            except Account.DoesNotExist:
-                self.number = 1E7 # "one, and seven zeros"
-        super(Account, self).save()
+            self.number = allocate_account_numbers(1)[0]
+        if self._state.adding:
+            return super(Account, self).save(*args, **kwargs)
+        # balance and version only change with UPDATEs in the DB (see add_to_balance). Writing back the values this instance read would undo what happened since
+        fields = kwargs.pop('update_fields', None)
+        if fields is None:
+            fields = [f.name for f in self._meta.concrete_fields if not f.primary_key]
+        fields = [name for name in fields if name not in ('balance', 'version')]
+        db = kwargs.get('using') or self._state.db
+        with transaction.atomic(using=db):
+            super(Account, self).save(*args, update_fields=fields, **kwargs)
+            Account.objects.using(db).filter(pk=self.pk).update(version=F('version')+1)
+        self.balance, self.version = Account.objects.using(db).filter(pk=self.pk).values_list('balance', 'version').get()
+
+
+class AccountBalanceShard(models.Model):
+    """
+    Part of the balance of a sharded account (Account.shard_count > 0). Every transaction changes the Account row, so transactions of the same account wait for each other on it; for an account which receives most of the deposits, that's the bottleneck.
+    So credits to sharded accounts go to 1 of its shards instead (in turns, see credit_shard), and transactions to the same account can run at the same time. Debits still lock the Account row, and check that balance + shards is enough; shards only grow, so that check can't be fooled by concurrent credits.
+    The balance of a sharded account is Account.balance + its shards (Account.objects.with_shards()). The compact_balance_shards command moves the shards into Account.balance from time to time.
+    With row locks (PostgreSQL), the "balance after" stored in a credit to a sharded account doesn't include concurrent credits to other shards which weren't committed yet
+    """
+    account = models.ForeignKey(Account, related_name='balance_shards')
+    shard = models.PositiveSmallIntegerField()
+    balance = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,default=0)
+    # Increased by each credit; part of Account.current_version (see AccountQuerySet.with_shards), for the page cache
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('account', 'shard')]
+
+
+class AccountNumberSequence(models.Model):
+    """
+    Next free account number. There's only 1 row. See allocate_account_numbers
+    Computing "last number + 1" from the Account table isn't safe: 2 requests at the same time would get the same number, and one of them would fail.
+    """
+    next_number = models.PositiveIntegerField(default=FIRST_ACCOUNT_NUMBER)
+
+
+class AccountNumberBlock(object):
+    """Numbers reserved by this process (see ACCOUNT_NUMBER_BLOCK_SIZE) and not yet used"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.numbers = iter(())
+
+    def take(self, count):
+        with self.lock:
+            numbers = list(itertools.islice(self.numbers, count))
+            missing = count - len(numbers)
+            if missing:
+                reserved = reserve_account_numbers(max(missing, settings.ACCOUNT_NUMBER_BLOCK_SIZE))
+                numbers += reserved[:missing]
+                self.numbers = iter(reserved[missing:])
+            return numbers
+
+    def forget(self):
+        """Drop the numbers not used yet (e.g. when the DB transaction that reserved them was rolled back)"""
+        with self.lock:
+            self.numbers = iter(())
+
+account_number_block = AccountNumberBlock()
+
+def reserve_account_numbers(count):
+    """
+    Take "count" consecutive numbers from AccountNumberSequence, with 1 atomic UPDATE (next_number=next_number+count); concurrent callers wait for each other on that row and get different numbers.
+    Don't call it inside a long DB transaction: the row stays locked until it ends.
+    """
+    with transaction.atomic():
+        if AccountNumberSequence.objects.filter(pk=1).update(next_number=F('next_number')+count):
+            next_number = AccountNumberSequence.objects.values_list('next_number', flat=True).get(pk=1)
+        else:
+            # No sequence yet (e.g. the table was emptied): continue after the biggest number in use
+            last_number = Account.objects.aggregate(last_number=Max('number'))['last_number']
+            next_number = (last_number+1 if last_number else FIRST_ACCOUNT_NUMBER) + count
+            AccountNumberSequence.objects.create(pk=1, next_number=next_number)
+    numbers = range(next_number-count, next_number)
+    if numbers[-1] > LAST_ACCOUNT_NUMBER:
+        raise ValidationError(ApiError('e_accnum'))
+    return numbers
+
+def bulk_create_accounts(accounts):
+    """INSERT many new accounts (with their numbers already allocated) with few queries, and set their ids"""
+    with transaction.atomic():
+        Account.objects.bulk_create(accounts)
+        if not connection.features.can_return_ids_from_bulk_insert:
+            ids = dict(Account.objects.filter(number__in=[acc.number for acc in accounts]).values_list('number', 'pk'))
+            for acc in accounts:
+                acc.pk = ids[acc.number]
+
+def allocate_account_numbers(count):
+    """Returns a list of "count" unused account numbers (8 digits). They come from the block of this process, and a new block is reserved from the DB when needed"""
+    return account_number_block.take(count)
 
 class Transaction(models.Model):
     """
@@ -52,11 +171,23 @@ class Transaction(models.Model):
     dest_acc = models.ForeignKey(Account,blank=True,null=True,verbose_name="Destination account",help_text="Used in transfers; must be blank for withdrawals",related_name="transactions_with_this_dest")
     source_amount = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,help_text="Amount in source account's currency, or in withdrawal account's currency. Not used in deposits", blank=True, null=True)
     dest_amount = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,help_text="Amount in destination account's currency, or in deposit account's currency. Not used in withdrawals", blank=True, null=True)
-    # I don't implement (because not required):
-    # - currency_rate: official money exchange rate used in this transaction. Can be computed approximately by dividing source_amount/dest_amount
-    # - currency_date: timestamp of the currency rate used for the transaction
+    # Balance of each account right after this transaction was applied. This allows to show the history without recomputing it from the beginning
+    source_balance_after = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,help_text="Balance of the source account after this transaction", blank=True, null=True)
+    dest_balance_after = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,help_text="Balance of the destination account after this transaction", blank=True, null=True)
+    # Only for transfers between different currencies: dest_amount = source_amount*currency_rate
+    currency_rate = models.DecimalField(max_digits=RATE_MAX_DIGITS,decimal_places=RATE_DECIMAL_PLACES,help_text="Exchange rate used in this transaction (1 source currency = this in destination currency)", blank=True, null=True)
+    currency_date = models.DateTimeField(help_text="Date for which the exchange rate was valid, as given by the rate provider", blank=True, null=True)
     creation_date = models.DateTimeField(auto_now_add=True) # Probably the same as "date" (except for DB migrations, etc.), but it's safe to store both
 
+    class Meta:
+        # The history of an account is read by date, from 2 sides (as source and as destination). See views.history_page
+        indexes = [
+            models.Index(fields=['source_acc', 'date'], name='transaction_source_date_idx'),
+            models.Index(fields=['dest_acc', 'date'], name='transaction_dest_date_idx'),
+            # All transactions, newest first (GET /api/transactions/)
+            models.Index(fields=['date', 'id'], name='transaction_date_id_idx'),
+        ]
+
     def clean(self):
         if self.op_type=='dep':
             if self.source_amount or not self.dest_amount:
@@ -78,30 +209,380 @@ class Transaction(models.Model):
 
     @transaction.atomic
     def save(self, *args, **kwargs):
-        """After saving a transaction, modify the affected accounts to compute the new balance. If any account modification fails, transaction can't be saved"""
-        super(Transaction, self).save(*args, **kwargs)
+        """
+        When a new transaction is saved, modify the affected accounts to compute the new balance. If any account modification fails, transaction can't be saved.
+        Balances are changed in the DB with 1 UPDATE per account (balance=balance+x), never by reading them into Python and saving them back, so concurrent requests can't overwrite each other's changes.
+        """
+        if not self._state.adding:
+            # Already applied to the balances when it was created; just update the row
+            return super(Transaction, self).save(*args, **kwargs)
+
         if self.op_type=='wd':
             assert self.source_amount>0
-            self.source_acc.balance-=self.source_amount
-            self.source_acc.save()
         elif self.op_type=='dep':
             assert self.dest_amount>0
-            self.dest_acc.balance+=self.dest_amount
-            self.dest_acc.save()
         elif self.op_type=='tra':
-            # this is a combination of wd+dep, but I write it for clarity
+            # this is a combination of wd+dep
             assert self.source_amount>0
             assert self.dest_amount>0
-            self.source_acc.balance-=self.source_amount
-            self.source_acc.save()
-            self.dest_acc.balance+=self.dest_amount
-            self.dest_acc.save()
         else:
             raise NotImplementedError(self.op_type)
 
-        # if any forbidden state arises, fail and undo (rollback) all saves (both for transaction and account changes)
-        if self.source_acc and self.source_acc.balance<=0:
-            raise ValidationError(["Source account would have negative balance"])
-        if self.dest_acc and self.dest_acc.balance<=0:
-            raise ValidationError("Destination account would have negative balance")
+        # Balances change by exactly what we store in the transaction
+        self.source_amount = quantize_money(self.source_amount)
+        self.dest_amount = quantize_money(self.dest_amount)
+
+        accounts = [acc for acc in (self.source_acc, self.dest_acc) if acc]
+        # Credits to sharded accounts go to a shard, without touching (or waiting for) the Account row. See AccountBalanceShard
+        sharded_dest = self.dest_acc if self.dest_acc and self.dest_acc.shard_count else None
+        with stage('balances'):
+            lock_accounts([acc for acc in accounts if acc is not sharded_dest])
+            # if any forbidden state arises, fail and undo (rollback) all saves (both for transaction and account changes)
+            if self.source_acc:
+                add_to_balance(self.source_acc, -self.source_amount, ApiError('z_srcacc'))
+            if self.dest_acc and not (sharded_dest and credit_shard(sharded_dest, self.dest_amount)):
+                if sharded_dest:
+                    # Its shard is gone (shard_count changed after we read the account): the Account row gets the credit, so lock it first like the others. Out of id order, but this only happens right after set_shard_count
+                    lock_accounts([sharded_dest])
+                add_to_balance(self.dest_acc, self.dest_amount, ApiError('z_destacc'))
+
+            # Read the new balances. Nobody else can change them until we commit, so they're the exact balances after this transaction (for sharded accounts, see AccountBalanceShard)
+            current = Account.objects.filter(pk__in=[acc.pk for acc in accounts])
+            if any(acc.shard_count for acc in accounts):
+                current = current.with_shards().values_list('pk', 'balance', 'version', 'current_balance', 'current_version')
+            else:
+                current = current.values_list('pk', 'balance', 'version', 'balance', 'version')
+            balances = dict((row[0], row[1:]) for row in current)
+        for acc in accounts:
+            acc.balance, acc.version, acc.current_balance, acc.current_version = balances[acc.pk]
+        self.source_balance_after = self.source_acc.current_balance if self.source_acc else None
+        self.dest_balance_after = self.dest_acc.current_balance if self.dest_acc else None
+        super(Transaction, self).save(*args, **kwargs)
+        LedgerEntry.objects.bulk_create(self.ledger_entries_to_create())
+
+    def ledger_entries_to_create(self):
+        """The LedgerEntry objects (not saved) for this new transaction: 1 per affected account"""
+        entries = []
+        if self.source_acc:
+            entries.append(LedgerEntry(transaction=self, account=self.source_acc, amount=-self.source_amount))
+        if self.dest_acc:
+            entries.append(LedgerEntry(transaction=self, account=self.dest_acc, amount=self.dest_amount))
+        return entries
+
+
+class LedgerEntry(models.Model):
+    """
+    One row per account affected by a Transaction (so transfers have 2). Money going out of the account is negative.
+    This table is append-only: rows are added with their Transaction and never changed, so the sum of the entries of an account must always be its balance. Checking that can be done incrementally, only with the entries added since the last check (see the reconcile_ledger command)
+    """
+    transaction = models.ForeignKey(Transaction, related_name='ledger_entries')
+    account = models.ForeignKey(Account, related_name='ledger_entries')
+    amount = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,help_text="Change in the account's balance, in the account's currency")
+
+    class Meta:
+        verbose_name_plural = "ledger entries"
+        # "entries of account X after entry N" is what reconciliation asks
+        indexes = [models.Index(fields=['account', 'id'], name='ledgerentry_account_id_idx')]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValidationError("Ledger entries can't be modified")
+        super(LedgerEntry, self).save(*args, **kwargs)
+
+
+class ReconciledBalance(models.Model):
+    """Sum of the ledger entries of an account up to ReconciliationState.last_entry_id, as computed by the last reconciliation"""
+    account = models.OneToOneField(Account, primary_key=True, related_name='reconciled_balance')
+    balance = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,default=0)
+
+
+class ReconciliationState(models.Model):
+    """Up to which LedgerEntry the balances have been reconciled ("watermark"). There's only 1 row"""
+    last_entry_id = models.PositiveIntegerField(default=0)
+    last_run = models.DateTimeField(null=True, blank=True)
+
+
+class CurrencyRate(models.Model):
+    """
+    History of exchange rates: 1 source == rate dest. The refresh_currency_rates command adds a row for each pair of currencies every time it runs, all with the same fetched_at.
+    The latest ones are used for new transactions (see currency.DatabaseRateProvider); old ones are kept for audits
+    """
+    source = models.CharField(max_length=3,choices=ALLOWED_CURRENCIES)
+    dest = models.CharField(max_length=3,choices=ALLOWED_CURRENCIES)
+    rate = models.DecimalField(max_digits=RATE_MAX_DIGITS,decimal_places=RATE_DECIMAL_PLACES)
+    date = models.DateTimeField(help_text="Date for which the rate is valid, as given by the provider", blank=True, null=True)
+    fetched_at = models.DateTimeField(help_text="When we got this rate from the provider")
+
+    class Meta:
+        indexes = [models.Index(fields=['fetched_at'], name='currencyrate_fetched_at_idx')]
+
+    def __str__(self):
+        return "1 %s = %s %s (%s)" % (self.source, self.rate, self.dest, self.date)
+
+
+class DailyAccountSummary(models.Model):
+    """
+    Movements of an account during 1 day (by transaction date, in TIME_ZONE) and its balance at the end of that day. Only days with transactions have a row.
+    Filled from the ledger by the update_daily_summaries command; see summaries.py
+    """
+    account = models.ForeignKey(Account, related_name='daily_summaries')
+    day = models.DateField()
+    inflow = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,default=0,help_text="Money that came in")
+    outflow = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,default=0,help_text="Money that went out (positive)")
+    transactions = models.PositiveIntegerField(default=0)
+    closing_balance = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES)
+
+    class Meta:
+        unique_together = [('account', 'day')]
+        verbose_name_plural = "daily account summaries"
 
+
+class DailyCurrencySummary(models.Model):
+    """Like DailyAccountSummary, but for all accounts of a currency. Transfers between 2 accounts of the currency count both as inflow and outflow"""
+    currency = models.CharField(max_length=3,choices=ALLOWED_CURRENCIES)
+    day = models.DateField()
+    inflow = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,default=0)
+    outflow = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,default=0)
+    deposits = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,default=0)
+    withdrawals = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,default=0)
+    transactions = models.PositiveIntegerField(default=0)
+    closing_balance = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,help_text="Sum of the balances of all accounts of this currency at the end of the day")
+
+    class Meta:
+        unique_together = [('currency', 'day')]
+        verbose_name_plural = "daily currency summaries"
+
+
+class SummaryState(models.Model):
+    """Up to which LedgerEntry the daily summaries include. There's only 1 row"""
+    last_entry_id = models.PositiveIntegerField(default=0)
+    last_run = models.DateTimeField(null=True, blank=True)
+
+
+class IdempotencyKey(models.Model):
+    """
+    Response given to a POST with an Idempotency-Key header, so that retries of the same request (e.g. after a timeout) get it again instead of creating another transaction. See TransactionResource.post_list.
+    Keys are per user. They're deleted after IDEMPOTENCY_KEY_TTL by the purge_idempotency_keys command
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='idempotency_keys')
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64, help_text="SHA-256 of the request body. The same key can't be used for other data")
+    status_code = models.PositiveSmallIntegerField()
+    content_type = models.CharField(max_length=100)
+    response = models.TextField()
+    creation_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [('user', 'key')]
+        indexes = [models.Index(fields=['creation_date'], name='idempotencykey_date_idx')]
+
+
+class LedgerImport(models.Model):
+    """Progress of the import of a file by the import_ledger command (see ledger_import.py), saved with each chunk, so that an interrupted import continues where it stopped"""
+    path = models.CharField(max_length=255, unique=True, help_text="Absolute path of the imported file")
+    offset = models.BigIntegerField(default=0, help_text="Bytes of the file already imported")
+    line = models.PositiveIntegerField(default=0, help_text="Lines of the file already imported")
+    imported = models.PositiveIntegerField(default=0)
+    rejected = models.PositiveIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    last_run = models.DateTimeField(null=True, blank=True)
+
+
+QUEUE_STATUSES = [
+    ("queued", "Waiting to be posted"),
+    ("done", "Posted"),
+    ("failed", "Rejected when posting"),
+]
+
+class QueuedOperation(models.Model):
+    """
+    A transaction accepted by the API in asynchronous mode (TRANSACTION_QUEUE), waiting for the process_transaction_queue worker, which posts them in batches. See transaction_queue.py
+    It has the fields of the Transaction it will become, already checked and converted like for a normal POST. After posting, "transaction" is the new Transaction, or "error" the code of the reason why it was rejected (e.g. not enough money)
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='queued_operations')
+    date = models.DateTimeField()
+    op_type = models.CharField(max_length=3,choices=OPERATION_TYPES)
+    source_acc = models.ForeignKey(Account,blank=True,null=True,related_name='+')
+    dest_acc = models.ForeignKey(Account,blank=True,null=True,related_name='+')
+    source_amount = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,blank=True,null=True)
+    dest_amount = models.DecimalField(max_digits=MONEY_MAX_DIGITS,decimal_places=MONEY_DECIMAL_PLACES,blank=True,null=True)
+    currency_rate = models.DecimalField(max_digits=RATE_MAX_DIGITS,decimal_places=RATE_DECIMAL_PLACES,blank=True,null=True)
+    currency_date = models.DateTimeField(blank=True,null=True)
+    status = models.CharField(max_length=6,choices=QUEUE_STATUSES,default='queued')
+    transaction = models.OneToOneField(Transaction,blank=True,null=True,related_name='queued_operation')
+    error = models.CharField(max_length=20,blank=True,help_text="Error code (see errors.py) if it failed")
+    creation_date = models.DateTimeField(auto_now_add=True)
+    processed_date = models.DateTimeField(blank=True,null=True)
+
+    # Fields copied to and from the Transaction
+    TRANSACTION_FIELDS = ('date', 'op_type', 'source_acc_id', 'dest_acc_id', 'source_amount', 'dest_amount', 'currency_rate', 'currency_date')
+
+    class Meta:
+        # The worker asks for "the oldest queued ones"
+        indexes = [models.Index(fields=['status', 'id'], name='queuedoperation_status_idx')]
+
+
+def lock_accounts(accounts):
+    """
+    Lock the rows of these accounts until the end of the DB transaction (SELECT … FOR UPDATE).
+    They're always locked in the same order (by id), so two opposing transfers (A→B and B→A) can't deadlock each other.
+    Must be called inside transaction.atomic. Databases without row locks (SQLite) ignore this; they serialize writers anyway.
+    Returns {account id: balance}, as read while locking. The balance of sharded accounts includes their shards, which can only grow while the account is locked (see AccountBalanceShard)
+    """
+    ids = sorted(set(acc.pk for acc in accounts))
+    rows = Account.objects.select_for_update().filter(pk__in=ids).order_by('pk').values_list('pk', 'balance', 'shard_count')
+    balances = OrderedDict((pk, balance) for pk, balance, shard_count in rows)
+    sharded = [pk for pk, balance, shard_count in rows if shard_count]
+    for pk, total in shard_balances(sharded).items():
+        balances[pk] += total
+    return balances
+
+def shard_balances(ids):
+    """{account id: sum of its balance shards} for these accounts, with 1 query (none if there are no ids)"""
+    if not ids:
+        return {}
+    return dict(AccountBalanceShard.objects.filter(account__in=ids).order_by().values('account').annotate(total=models.Sum('balance')).values_list('account', 'total'))
+
+# Which shard gets the next credit: in turns, starting at a random one in each process so that processes don't all start on the same
+shard_turns = itertools.count(random.randrange(1000))
+
+def credit_shard(account, amount):
+    """
+    Add amount (positive) to 1 of the balance shards of a sharded account, without locking the Account row. Concurrent credits to the account take different shards, so they don't wait for each other (on databases with row locks).
+    Returns False if the shard isn't there (shard_count was just changed, see shards.set_shard_count); then credit the Account row instead.
+    The UPDATE locks the shard row, and that's enough against compaction, which locks the shard rows it reads (SELECT … FOR UPDATE) and takes from each exactly what it read: a credit either commits before that read (and is moved), or waits and is added to what's left. A shard deleted meanwhile updates 0 rows, so the credit goes to the Account row.
+    """
+    shard = next(shard_turns) % account.shard_count
+    return bool(AccountBalanceShard.objects.filter(account=account, shard=shard).update(balance=F('balance')+amount, version=F('version')+1))
+
+def add_to_balance(account, amount, error_message):
+    """
+    Add amount (can be negative) to the balance of the account in 1 statement: UPDATE … SET balance=balance+amount WHERE id=… AND balance+amount>0
+    The condition enforces our "balance must stay positive" rule inside the same statement, so if it fails nothing was changed and we don't need to read the balance first. Raises ValidationError(error_message) then.
+    For debits of sharded accounts the condition counts the shards too (read here: the account must be locked, see lock_accounts), so "balance" alone can go below 0.
+    """
+    shards = shard_balances([account.pk]).get(account.pk, 0) if account.shard_count and amount < 0 else 0
+    updated = Account.objects.filter(pk=account.pk, balance__gt=-amount-shards).update(balance=F('balance')+amount, version=F('version')+1)
+    if not updated:
+        raise ValidationError(error_message)
+
+def add_to_balances(deltas):
+    """
+    Add to many accounts at once, in 1 statement: UPDATE … SET balance = CASE id WHEN 1 THEN balance+… WHEN 2 THEN … END WHERE id IN (…)
+    deltas: {account id: amount to add (can be negative)}. There's no check here, see post_transactions
+    """
+    if not deltas:
+        return
+    whens = [When(pk=pk, then=F('balance')+Value(delta, output_field=money_field())) for pk, delta in deltas.items()]
+    Account.objects.filter(pk__in=list(deltas)).update(balance=Case(*whens, output_field=money_field()), version=F('version')+1)
+
+def bulk_insert(model, objects):
+    """
+    INSERT many objects with few queries, and set their ids. Must be called inside a DB transaction which has already written something (e.g. updated balances).
+    Some databases (SQLite) don't return the ids of bulk inserts. There, we read them back: since our DB transaction has written, nobody else can insert until we commit, so our rows are the ones after the previous last id, in order.
+    """
+    if connection.features.can_return_ids_from_bulk_insert:
+        model.objects.bulk_create(objects)
+        return
+    last_id = model.objects.aggregate(last_id=Max('pk'))['last_id'] or 0
+    model.objects.bulk_create(objects)
+    ids = list(model.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True))
+    assert len(ids) == len(objects)
+    for obj, pk in zip(objects, ids):
+        obj.pk = pk
+
+def post_transactions(transactions, all_or_nothing=True):
+    """
+    Save many new transactions together, with the same rules as Transaction.save, but much faster than saving them one by one: accounts are locked once, transactions are inserted in bulk, and the balance of each account is updated once with the sum of all its changes.
+    Operations are checked in order against the running balances, so e.g. a deposit can pay for a later withdrawal in the same batch.
+    Returns a list with 1 element per transaction: None if it was saved, or the error message if it wasn't. With all_or_nothing, if any fails then nothing is saved.
+    """
+    results = [None] * len(transactions)
+    with transaction.atomic():
+        accounts = dict((acc.pk, acc) for tr in transactions for acc in (tr.source_acc, tr.dest_acc) if acc)
+        initial_balances = lock_accounts(accounts.values())
+        balances = dict(initial_balances)
+        accepted = []
+        for i, tr in enumerate(transactions):
+            tr.source_amount = quantize_money(tr.source_amount)
+            tr.dest_amount = quantize_money(tr.dest_amount)
+            if tr.source_acc:
+                assert tr.source_amount>0
+            if tr.dest_acc:
+                assert tr.dest_amount>0
+            if tr.source_acc and balances[tr.source_acc.pk]-tr.source_amount <= 0:
+                results[i] = ApiError('z_srcacc')
+                continue
+            if tr.dest_acc and balances[tr.dest_acc.pk]+tr.dest_amount <= 0:
+                results[i] = ApiError('z_destacc')
+                continue
+            if tr.source_acc:
+                balances[tr.source_acc.pk] -= tr.source_amount
+                tr.source_balance_after = balances[tr.source_acc.pk]
+            if tr.dest_acc:
+                balances[tr.dest_acc.pk] += tr.dest_amount
+                tr.dest_balance_after = balances[tr.dest_acc.pk]
+            accepted.append(tr)
+
+        if not accepted or (all_or_nothing and len(accepted) < len(transactions)):
+            return results
+
+        with stage('balances'):
+            add_to_balances(dict((pk, balances[pk]-initial_balances[pk]) for pk in balances if balances[pk] != initial_balances[pk]))
+            # On databases without row locks, someone could have changed a balance between our read and our update. Now that we've written, nobody can, so check it. Raising rolls back everything
+            # This also guarantees that the balances after each transaction that we computed are right
+            # (Sharded accounts can receive credits in their shards meanwhile, so theirs can only be higher; see AccountBalanceShard)
+            final = dict((row[0], row[1:]) for row in Account.objects.with_shards().filter(pk__in=list(accounts)).values_list('pk', 'balance', 'version', 'current_balance', 'current_version', 'shard_count'))
+        for pk, balance in balances.items():
+            current_balance, shard_count = final[pk][2], final[pk][4]
+            if current_balance != balance and not (shard_count and current_balance > balance):
+                raise DatabaseError("Account balances changed while posting the batch. Try again")
+        bulk_insert(Transaction, accepted)
+        LedgerEntry.objects.bulk_create([entry for tr in accepted for entry in tr.ledger_entries_to_create()])
+
+    for pk, acc in accounts.items():
+        acc.balance, acc.version, acc.current_balance, acc.current_version = final[pk][:4]
+    return results
+
+
+# Transactions shown per page in the account details
+HISTORY_PAGE_SIZE = 50
+
+def history_ids(account, cursor=None, newer=False, size=HISTORY_PAGE_SIZE):
+    """
+    Ids of up to "size" transactions of the account right before (or after, with newer=True) the cursor transaction, or the latest ones if there's no cursor.
+    A plain "source_acc=X OR dest_acc=X ORDER BY date" can't use 1 index for both sides and must sort all the history. So we ask each side separately, where each can use its (account, date) index and stop after "size" rows, and join both with UNION ALL (a transaction can't be on both sides). The outer query only sorts 2×size rows.
+    """
+    # Raw SQL doesn't go through the routers, so we ask them which DB to read from (e.g. the replica, see routers.py)
+    using = router.db_for_read(Transaction)
+    qn = connections[using].ops.quote_name
+    branches = []
+    params = []
+    for field in ('source_acc', 'dest_acc'):
+        trans = Transaction.objects.using(using).filter(**{field: account})
+        if cursor and newer:
+            trans = trans.filter(Q(date__gt=cursor.date)|Q(date=cursor.date, id__gt=cursor.id))
+        elif cursor:
+            trans = trans.filter(Q(date__lt=cursor.date)|Q(date=cursor.date, id__lt=cursor.id))
+        trans = trans.order_by(*(('date', 'id') if newer else ('-date', '-id'))).values('id', 'date')[:size]
+        sql, branch_params = trans.query.get_compiler(using).as_sql()
+        branches.append("SELECT %s, %s FROM (%s) AS %s" % (qn('id'), qn('date'), sql, field))
+        params.extend(branch_params)
+    order = "ASC" if newer else "DESC"
+    sql = " UNION ALL ".join(branches) + " ORDER BY %s %s, %s %s LIMIT %i" % (qn('date'), order, qn('id'), order, size)
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+def history_page(account, before=None, after=None, size=HISTORY_PAGE_SIZE):
+    """
+    One page of the history of an account, in chronological order (date, then id). Pages are found by "keyset pagination": we ask for the transactions right before/after a given one (the cursor), so the DB only reads 1 page of rows, no matter how long the history is or which page it is.
+    before/after: Transaction to use as cursor. With none of them, it returns the latest page.
+    Returns (transactions, there_are_older, there_are_newer)
+    """
+    cursor = after or before
+    ids = history_ids(account, cursor, newer=bool(after), size=size+1)
+    page = sorted(Transaction.objects.filter(pk__in=ids[:size]).select_related('source_acc', 'dest_acc'), key=lambda tr: (tr.date, tr.id))
+    if after:
+        return page, True, len(ids) > size
+    return page, len(ids) > size, before is not None
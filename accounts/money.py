@@ -0,0 +1,83 @@
+"""
+Money amounts and exchange rates: how many digits we keep, how amounts from the API are read, and how they're rounded and converted.
+All rounding is done here, with 1 decimal context (MONEY_CONTEXT: banker's rounding, enough precision for amount×rate), so the same operation always gives the same cents.
+The models import these names too (accounts.models.MONEY_DECIMAL_PLACES etc. still work).
+"""
+import re
+from decimal import Decimal, Context, ROUND_HALF_EVEN, InvalidOperation
+
+from django.db.models import DecimalField
+
+# For consistent use of numbers representing currency amounts: 00111222333.12345
+MONEY_MAX_DIGITS=12+5
+MONEY_DECIMAL_PLACES=5
+# Exchange rates, e.g. 1 EUR = 1.12170 USD; 1 USD = 0.891504 EUR
+RATE_MAX_DIGITS = 20
+RATE_DECIMAL_PLACES = 10
+
+# Exponents for quantize(), built once instead of in every call
+MONEY_EXPONENT = Decimal(1).scaleb(-MONEY_DECIMAL_PLACES)
+RATE_EXPONENT = Decimal(1).scaleb(-RATE_DECIMAL_PLACES)
+
+# Round half to even ("banker's rounding"): halves don't always go up, so sums of many rounded amounts don't drift. The precision fits an exact amount×rate product, so it's rounded only once (by quantize), never twice
+MONEY_CONTEXT = Context(prec=MONEY_MAX_DIGITS + RATE_MAX_DIGITS, rounding=ROUND_HALF_EVEN, traps=[InvalidOperation])
+
+# Amounts must be below this (12 digits before the point)
+MAX_AMOUNT = Decimal(10) ** (MONEY_MAX_DIGITS - MONEY_DECIMAL_PLACES)
+
+# Amounts as strings: ASCII digits with an optional sign and point ("7.", ".5" as before). Decimal() alone would also take "1_000", " 1 ", "1e3" and "NaN", which the API never accepted
+AMOUNT_RE = re.compile(r'[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)\Z')
+
+
+def money_field():
+    """output_field for expressions which compute amounts (sums, CASEs, subqueries)"""
+    return DecimalField(max_digits=MONEY_MAX_DIGITS, decimal_places=MONEY_DECIMAL_PLACES)
+
+def to_decimal(value):
+    """Decimal from a str, int, float or Decimal. Floats are read from their shortest text form (0.1 → Decimal('0.1')), not from their binary value (Decimal(0.1) is 0.1000000000000000055511151231257827…)"""
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return Decimal(value)
+
+def quantize_money(amount):
+    """Round an amount to the decimals we store (MONEY_DECIMAL_PLACES). None stays None"""
+    if amount is None:
+        return None
+    if amount.__class__ is not Decimal:
+        amount = to_decimal(amount)
+    # The methods of the context are much faster than .quantize(…, context=…)
+    return MONEY_CONTEXT.quantize(amount, MONEY_EXPONENT)
+
+def quantize_rate(rate):
+    """Round an exchange rate to the decimals we store, so that the amounts computed with it can be reproduced from the stored rate"""
+    return MONEY_CONTEXT.quantize(to_decimal(rate), RATE_EXPONENT)
+
+def parse_amount(value):
+    """
+    The amount given in the API (a string like "10.5", or a JSON number), as a Decimal with MONEY_DECIMAL_PLACES. None if it isn't a number, or it's negative or too big.
+    Strings must match AMOUNT_RE, and are read by Decimal as they're written, so "0.1" is exactly 0.1; see to_decimal for floats
+    """
+    try:
+        if value.__class__ is str:
+            if not AMOUNT_RE.match(value):
+                return None
+            amount = Decimal(value)
+        elif value.__class__ is float:
+            amount = Decimal(repr(value))
+        elif isinstance(value, (int, Decimal)) and not isinstance(value, bool):
+            amount = Decimal(value)
+        else:
+            return None
+        # The limit is checked after rounding: "999999999999.999995" rounds to 10**12. NaN can't be compared, and infinity can't be rounded (InvalidOperation)
+        quantized = MONEY_CONTEXT.quantize(amount, MONEY_EXPONENT)
+        if amount < 0 or not quantized < MAX_AMOUNT:
+            return None
+    except InvalidOperation:
+        return None
+    return quantized
+
+def convert(amount, rate):
+    """amount (in the source currency) × rate, rounded once to MONEY_DECIMAL_PLACES"""
+    return MONEY_CONTEXT.quantize(MONEY_CONTEXT.multiply(amount, rate), MONEY_EXPONENT)
@@ -0,0 +1,53 @@
+"""
+Reads from a replica database, where it's safe.
+With a 'replica' alias in DATABASES (DATABASE_REPLICA_URL), code inside read_from_replica() reads from it: the HTML pages and the reports (statements), which can show data a moment old. Everything else, and all writes, use 'default': the API reads accounts and then writes in the same DB transaction, and a replica which is behind would give it old balances.
+"""
+import threading
+from contextlib import ContextDecorator
+
+from django.conf import settings
+
+REPLICA = 'replica'
+
+_state = threading.local()
+
+
+class read_from_replica(ContextDecorator):
+    """Context manager and decorator: queries of this thread inside it read from the replica, if there's one"""
+    def __enter__(self):
+        _state.depth = getattr(_state, 'depth', 0) + 1
+        return self
+
+    def __exit__(self, *exc):
+        _state.depth -= 1
+        return False
+
+
+def replica_iterator(iterable):
+    """Iterate inside read_from_replica. For generators that are consumed after the view returns, e.g. in a StreamingHttpResponse"""
+    iterator = iter(iterable)
+    while True:
+        with read_from_replica():
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        if getattr(_state, 'depth', 0) and REPLICA in settings.DATABASES:
+            return REPLICA
+        return None # default
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Objects read from the replica are the same rows as in default
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica gets its tables from the primary
+        return db != REPLICA
@@ -0,0 +1,66 @@
+"""
+Balance shards of busy accounts (see models.AccountBalanceShard): turning them on and off, and compaction.
+Compaction moves what the shards have received into Account.balance, so that reading the balance stays cheap and the "balance" column means something by itself. It runs per account in short DB transactions, from the compact_balance_shards command.
+"""
+from django.db import transaction
+from django.db.models import F
+
+from accounts.models import Account, AccountBalanceShard
+
+
+def lock_shards(shards):
+    """[(pk, balance, version)] of these shards, locked until the end of the DB transaction. A list: aggregate() would drop the FOR UPDATE"""
+    return list(shards.select_for_update().order_by('shard').values_list('pk', 'balance', 'version'))
+
+def fold_shards(pk, rows):
+    """
+    Move what the locked shard rows (see lock_shards) had into the Account row: each shard loses exactly what we read from it, not "= 0", so nothing is lost even if the lock wasn't there.
+    Returns the amount moved
+    """
+    balance = sum(row[1] for row in rows)
+    version = sum(row[2] for row in rows)
+    if not balance and not version:
+        return 0
+    for shard_pk, shard_balance, shard_version in rows:
+        if shard_balance or shard_version:
+            AccountBalanceShard.objects.filter(pk=shard_pk).update(balance=F('balance')-shard_balance, version=F('version')-shard_version)
+    Account.objects.filter(pk=pk).update(balance=F('balance')+balance, version=F('version')+version)
+    return balance
+
+def compact_account(pk):
+    """
+    Move the balance (and version) of the shards of 1 account into the Account row. The balance and current_version seen by readers don't change.
+    Locks the account and then its shards, like a debit does with the account; credits to a shard wait until we commit, and then add to what we left in it (see credit_shard).
+    Returns the amount moved
+    """
+    with transaction.atomic():
+        if not Account.objects.select_for_update().filter(pk=pk).exists():
+            return 0
+        return fold_shards(pk, lock_shards(AccountBalanceShard.objects.filter(account=pk)))
+
+def compact_balance_shards(accounts=None):
+    """Compact the shards of these accounts (a queryset; default: all sharded accounts), 1 DB transaction each. Returns (accounts which had something to move, total moved)"""
+    if accounts is None:
+        accounts = Account.objects.all()
+    compacted, moved = 0, 0
+    for pk in accounts.filter(shard_count__gt=0).order_by('pk').values_list('pk', flat=True).iterator():
+        amount = compact_account(pk)
+        if amount:
+            compacted += 1
+            moved += amount
+    return compacted, moved
+
+
+@transaction.atomic
+def set_shard_count(account, count):
+    """
+    Give the account "count" balance shards (0: not sharded), in 1 DB transaction with the account locked.
+    shard_count changes first, so new credits go to the shards that stay. The shards that go are locked, folded into the Account row, and deleted: credits waiting for them find no row and credit the Account row instead (see models.credit_shard)
+    """
+    Account.objects.select_for_update().filter(pk=account.pk).update(shard_count=count)
+    rows = lock_shards(AccountBalanceShard.objects.filter(account=account, shard__gte=count))
+    fold_shards(account.pk, rows)
+    AccountBalanceShard.objects.filter(pk__in=[row[0] for row in rows]).delete()
+    existing = set(AccountBalanceShard.objects.filter(account=account).values_list('shard', flat=True))
+    AccountBalanceShard.objects.bulk_create([AccountBalanceShard(account=account, shard=shard) for shard in range(count) if shard not in existing])
+    account.shard_count = count
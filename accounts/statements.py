@@ -0,0 +1,83 @@
+"""
+Account statements: the transactions of an account in a date range, with the balance after each one, as CSV or JSON lines.
+Rows are produced by a generator which reads the history in chunks (keyset pagination, like the account page; see models.history_ids), so memory use doesn't depend on the length of the history. Used by the statement view and by the export_statements command.
+"""
+import csv
+import datetime
+import json
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from accounts.models import Transaction, history_ids
+
+STATEMENT_CHUNK_SIZE = 1000
+STATEMENT_COLUMNS = ['date', 'transaction', 'type', 'counterpart', 'change', 'balance', 'currency']
+
+
+def parse_day(value, next_day=False):
+    """'2017-06-02' → the datetime when that day starts (in the current time zone), or when the next day starts. None for empty values. Raises ValueError for bad dates"""
+    if not value:
+        return None
+    day = parse_date(value)
+    if day is None:
+        raise ValueError("Dates must be YYYY-MM-DD: %s" % value)
+    if next_day:
+        day += datetime.timedelta(days=1)
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def statement_rows(account, start=None, end=None, chunk_size=STATEMENT_CHUNK_SIZE):
+    """
+    Generator of the transactions of the account with start <= date < end (None: no limit), in chronological order, as dicts with STATEMENT_COLUMNS.
+    Amounts are strings, to keep all decimals in any output format
+    """
+    # The cursor is the last transaction we've seen; at the beginning, a fake one right before "start"
+    cursor = Transaction(id=0, date=start or datetime.datetime(1, 1, 1, tzinfo=timezone.utc))
+    fields = ('id', 'date', 'op_type', 'source_acc_id', 'source_acc__number', 'dest_acc__number', 'source_amount', 'dest_amount', 'source_balance_after', 'dest_balance_after')
+    while True:
+        ids = history_ids(account, cursor, newer=True, size=chunk_size)
+        if not ids:
+            return
+        chunk = sorted(Transaction.objects.filter(pk__in=ids).values_list(*fields).iterator(), key=lambda row: (row[1], row[0]))
+        for tr_id, date, op_type, source_id, source_number, dest_number, source_amount, dest_amount, source_balance, dest_balance in chunk:
+            if end and date >= end:
+                return
+            if source_id == account.id:
+                counterpart, change, balance = dest_number, -source_amount, source_balance
+            else:
+                counterpart, change, balance = source_number, dest_amount, dest_balance
+            yield {
+                'date': date.isoformat(),
+                'transaction': tr_id,
+                'type': op_type,
+                'counterpart': counterpart,
+                'change': str(change),
+                'balance': str(balance),
+                'currency': account.currency,
+            }
+        if len(ids) < chunk_size:
+            return
+        cursor = Transaction(id=chunk[-1][0], date=chunk[-1][1])
+
+
+class LineBuffer(object):
+    """File-like object for csv.writer which just returns what it's given, so that each row becomes a string we can yield"""
+    def write(self, value):
+        return value
+
+def csv_lines(rows):
+    writer = csv.DictWriter(LineBuffer(), STATEMENT_COLUMNS)
+    yield writer.writerow(dict(zip(STATEMENT_COLUMNS, STATEMENT_COLUMNS)))
+    for row in rows:
+        yield writer.writerow(row)
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+# format → (content type, file extension, function which turns rows into lines of text)
+STATEMENT_FORMATS = {
+    'csv': ('text/csv', 'csv', csv_lines),
+    'jsonl': ('application/x-ndjson', 'jsonl', jsonl_lines),
+}
@@ -0,0 +1,152 @@
+"""
+Daily summaries of the ledger, for reports: per account and per currency, the money that came in and went out each day and the balance at the end of the day.
+They're built from the ledger entries incrementally (only the entries added since the last run, like reconcile_ledger does), by the update_daily_summaries command, not while posting transactions, so that posting doesn't write more rows.
+balance_at uses them to answer "what was the balance at …" by starting from the closest earlier day and adding only the transactions after it.
+"""
+import datetime
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, When, Value, F, Sum, Count, Min, Max, IntegerField, Subquery, OuterRef
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from accounts.models import DailyAccountSummary, DailyCurrencySummary, LedgerEntry, SummaryState, Transaction
+from accounts.money import money_field
+
+UPDATE_CHUNK_SIZE = 100 # rows changed per UPDATE … CASE statement
+
+
+def movements(entries, group_by, **extra):
+    """{(group_by value, day): {'inflow': …, 'outflow': …, 'transactions': …, …}} for these ledger entries, in 1 GROUP BY query. Days are in the current time zone"""
+    zero = Value(0, output_field=money_field())
+    sums = dict(
+        inflow=Sum(Case(When(amount__gt=0, then=F('amount')), default=zero, output_field=money_field())),
+        outflow=Sum(Case(When(amount__lt=0, then=F('amount') * -1), default=zero, output_field=money_field())),
+        **extra
+    )
+    rows = entries.annotate(day=TruncDate('transaction__date')).order_by().values(group_by, 'day').annotate(**sums)
+    return dict(((row.pop(group_by), row.pop('day')), row) for row in rows)
+
+
+def update_rows(model, changes):
+    """changes: {pk: {field: new value}}. Written with 1 UPDATE … SET field = CASE id WHEN … END per field and chunk of rows (see models.add_to_balances)"""
+    pks = list(changes)
+    for start in range(0, len(pks), UPDATE_CHUNK_SIZE):
+        chunk = pks[start:start + UPDATE_CHUNK_SIZE]
+        fields = set(field for pk in chunk for field in changes[pk])
+        values = {}
+        for field in fields:
+            output_field = IntegerField() if field == 'transactions' else money_field()
+            whens = [When(pk=pk, then=Value(changes[pk][field], output_field=output_field)) for pk in chunk if field in changes[pk]]
+            values[field] = Case(*whens, default=F(field), output_field=output_field)
+        model.objects.filter(pk__in=chunk).update(**values)
+
+
+def apply_movements(model, key, new_movements):
+    """
+    Add new_movements (see movements()) to the summaries in model, whose rows are identified by (key, day).
+    Closing balances are recomputed from the first changed day on, from the closing balance of the day before: in the usual case (entries of today) that's only today's rows, but entries of older days (transactions with a past date) also move the closing balances of the days after them.
+    Returns how many rows were created and updated
+    """
+    if not new_movements:
+        return 0, 0
+    keys = set(k for k, day in new_movements)
+    first_day = min(day for k, day in new_movements)
+    movement_fields = list(next(iter(new_movements.values())))
+    rows = model.objects.filter(**{key + '__in': keys}).order_by('day')
+    # Closing balance of each key on its last day before first_day
+    before = model.objects.filter(**{key: OuterRef(key), 'day__lt': first_day}).order_by('-day').values('day')[:1]
+    opening = dict(rows.filter(day=Subquery(before)).values_list(key, 'closing_balance'))
+    attname = model._meta.get_field(key).attname # account_id: the movements have ids, not Accounts
+    existing = defaultdict(dict)
+    for row in rows.filter(day__gte=first_day):
+        existing[getattr(row, attname)][row.day] = row
+
+    to_create = []
+    changes = {}
+    for k in keys:
+        balance = opening.get(k, 0)
+        days = sorted(set(existing[k]) | set(day for kk, day in new_movements if kk == k))
+        for day in days:
+            row = existing[k].get(day)
+            delta = new_movements.get((k, day), {})
+            if row is None:
+                row = model(day=day, closing_balance=0, **{attname: k})
+                for field in movement_fields:
+                    setattr(row, field, delta[field] or 0)
+                balance += row.inflow - row.outflow
+                row.closing_balance = balance
+                to_create.append(row)
+                continue
+            changed = {}
+            for field in movement_fields:
+                if delta.get(field):
+                    changed[field] = getattr(row, field) + delta[field]
+                    setattr(row, field, changed[field])
+            balance += row.inflow - row.outflow
+            if row.closing_balance != balance:
+                changed['closing_balance'] = balance
+            if changed:
+                changes[row.pk] = changed
+    model.objects.bulk_create(to_create)
+    update_rows(model, changes)
+    return len(to_create), len(changes)
+
+
+def update_daily_summaries(settle_seconds=None):
+    """
+    Add the ledger entries after SummaryState.last_entry_id to the daily summaries.
+    Only entries of transactions created at least settle_seconds (default: DAILY_SUMMARY_SETTLE_SECONDS) ago are read: a transaction still being saved could get a lower id than one already committed, and we'd never read it after moving the watermark past it.
+    Returns (number of entries read, account rows written, currency rows written)
+    """
+    if settle_seconds is None:
+        settle_seconds = settings.DAILY_SUMMARY_SETTLE_SECONDS
+    settled = timezone.now() - datetime.timedelta(seconds=settle_seconds)
+    with transaction.atomic():
+        # Locking the state row prevents 2 runs at the same time
+        state = SummaryState.objects.select_for_update().first() or SummaryState.objects.create()
+        new = LedgerEntry.objects.filter(id__gt=state.last_entry_id)
+        watermark = new.filter(transaction__creation_date__lt=settled).aggregate(last=Max('id'))['last']
+        if watermark is None:
+            return 0, 0, 0
+        new = new.filter(id__lte=watermark)
+        by_account = movements(new, 'account', transactions=Count('id'))
+        by_currency = movements(
+            new, 'account__currency',
+            deposits=Sum(Case(When(transaction__op_type='dep', then=F('amount')), default=Value(0), output_field=money_field())),
+            withdrawals=Sum(Case(When(transaction__op_type='wd', then=F('amount') * -1), default=Value(0), output_field=money_field())),
+            transactions=Count('transaction', distinct=True),
+        )
+        account_rows = sum(apply_movements(DailyAccountSummary, 'account', by_account))
+        currency_rows = sum(apply_movements(DailyCurrencySummary, 'currency', by_currency))
+        entries = sum(m['transactions'] for m in by_account.values())
+        state.last_entry_id = watermark
+        state.last_run = timezone.now()
+        state.save()
+    return entries, account_rows, currency_rows
+
+
+def balance_at(account, when):
+    """
+    Balance of the account right after the last transaction with date <= when.
+    Starts from the closing balance of the latest summarized day before when's day, and adds the transactions after that day: usually only the ones of that same day.
+    Days with entries not summarized yet are replayed too
+    """
+    day = timezone.localtime(when).date()
+    state = SummaryState.objects.first()
+    pending = LedgerEntry.objects.filter(account=account, id__gt=state.last_entry_id if state else 0).aggregate(first=Min('transaction__date'))['first']
+    if pending is not None:
+        day = min(day, timezone.localtime(pending).date())
+    snapshot = account.daily_summaries.filter(day__lt=day).order_by('-day').values_list('day', 'closing_balance').first()
+
+    transactions = Transaction.objects.filter(date__lte=when)
+    balance = 0
+    if snapshot:
+        day, balance = snapshot
+        next_day = timezone.make_aware(datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time.min))
+        transactions = transactions.filter(date__gte=next_day)
+    money_in = transactions.filter(dest_acc=account).aggregate(total=Sum('dest_amount'))['total'] or 0
+    money_out = transactions.filter(source_acc=account).aggregate(total=Sum('source_amount'))['total'] or 0
+    return balance + money_in - money_out
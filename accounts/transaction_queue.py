@@ -0,0 +1,58 @@
+"""
+Asynchronous mode of POST /api/transactions/ (TRANSACTION_QUEUE = True): the API checks the operation as usual but, instead of posting it, stores it in the QueuedOperation table and answers 202 with a URL where the client can ask for its status.
+The process_transaction_queue command (the worker) posts the queued operations in batches with post_transactions: each batch is 1 DB transaction, which locks its accounts once, changes each account's balance once (by the sum of all its operations in the batch) and inserts all the transactions together. Under load this is much less work, and much less waiting for the rows of busy accounts, than 1 DB transaction per operation ("group commit").
+The queue is a table in our own database, so nothing else (no broker) is needed, and an operation is never lost once the API has answered.
+"""
+from django.db import connection, transaction
+from django.db.models import Case, When, Value, IntegerField
+from django.utils import timezone
+
+from accounts.errors import api_error
+from accounts.models import Account, QueuedOperation, Transaction, post_transactions
+
+QUEUE_UPDATE_CHUNK_SIZE = 100 # operations marked as done per UPDATE … CASE statement
+
+
+def enqueue(tr, user):
+    """Store the new Transaction tr (checked, not saved) in the queue instead of posting it. Returns the QueuedOperation"""
+    return QueuedOperation.objects.create(user=user, **dict((field, getattr(tr, field)) for field in QueuedOperation.TRANSACTION_FIELDS))
+
+
+def process_queue(batch_size):
+    """
+    Post up to batch_size queued operations, oldest first, in 1 DB transaction (see post_transactions). Each one is checked against the balances left by the ones before it, and those which can't be posted (e.g. not enough money) are marked as failed without stopping the others.
+    The operations are marked as done or failed in the same DB transaction, so if anything goes wrong nothing is posted and they're still queued: an operation is never posted twice.
+    Several workers can run at the same time: with row locks (PostgreSQL) each one takes operations that the others haven't locked; SQLite lets only 1 DB transaction write at a time.
+    Returns (posted, failed)
+    """
+    with transaction.atomic():
+        queued = QueuedOperation.objects.filter(status='queued').order_by('id')
+        if connection.features.has_select_for_update_skip_locked:
+            queued = queued.select_for_update(skip_locked=True)
+        operations = list(queued[:batch_size])
+        if not operations:
+            return 0, 0
+        accounts = Account.objects.in_bulk(set(pk for op in operations for pk in (op.source_acc_id, op.dest_acc_id) if pk))
+        transactions = []
+        for op in operations:
+            tr = Transaction(**dict((field, getattr(op, field)) for field in QueuedOperation.TRANSACTION_FIELDS))
+            # the same Account object for all the operations of an account, so that they see each other's changes
+            tr.source_acc = accounts.get(op.source_acc_id)
+            tr.dest_acc = accounts.get(op.dest_acc_id)
+            transactions.append(tr)
+        errors = post_transactions(transactions, all_or_nothing=False)
+
+        now = timezone.now()
+        posted = [(op, tr) for op, tr, error in zip(operations, transactions, errors) if not error]
+        for start in range(0, len(posted), QUEUE_UPDATE_CHUNK_SIZE):
+            chunk = posted[start:start + QUEUE_UPDATE_CHUNK_SIZE]
+            transaction_ids = Case(*[When(pk=op.pk, then=Value(tr.pk)) for op, tr in chunk], output_field=IntegerField())
+            QueuedOperation.objects.filter(pk__in=[op.pk for op, tr in chunk]).update(status='done', transaction=transaction_ids, processed_date=now)
+        failed = {}
+        for op, error in zip(operations, errors):
+            if error:
+                failed.setdefault(api_error(error).code, []).append(op.pk)
+        for code, pks in failed.items():
+            QueuedOperation.objects.filter(pk__in=pks).update(status='failed', error=code, processed_date=now)
+    return len(posted), len(operations) - len(posted)
+
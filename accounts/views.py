@@ -1,43 +1,92 @@
+from django.conf import settings
+from django.core.cache import caches
 from django.views.generic.list import ListView
 from django.views.generic.detail import DetailView
-from accounts.models import Account, Transaction
+from accounts.models import Account, Transaction, history_page
 from django.shortcuts import get_object_or_404, render
-from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse, HttpResponseBadRequest
+from accounts.statements import STATEMENT_FORMATS, statement_rows, parse_day
+from accounts.routers import read_from_replica, replica_iterator
+
+def account_version_key(account):
+    """Identifies the current state of the account, for cache keys. The creation date is there so that a new DB (with the same account numbers and versions) doesn't find the pages of the old one. Accounts read with with_shards() include the versions of their shards"""
+    return '%i:%i:%s' % (account.number, getattr(account, 'current_version', account.version), account.creation_date.isoformat())
 
 class AccountListView(ListView):
     model = Account
+    # only the columns shown in the list
+    queryset = Account.objects.with_shards().only('number', 'currency', 'balance', 'version', 'shard_count', 'creation_date').order_by('number')
+    paginate_by = 100
+
+    def get_context_data(self, **kwargs):
+        context = super(AccountListView, self).get_context_data(**kwargs)
+        # The list is cached in the template ({% cache %}). Its content depends only on which accounts are shown and their versions
+        context['accounts_key'] = ','.join(account_version_key(acc) for acc in context['object_list'])
+        context['cache_ttl'] = settings.ACCOUNT_PAGE_CACHE_TTL
+        return context
 
+@read_from_replica()
 def account_and_transactions(request, number):
-    account = get_object_or_404(Account, number=number)
-    trans = Transaction.objects.filter(Q(source_acc=account)|Q(dest_acc=account)).order_by('date')
+    """
+    The page of an account with its history. Pages are cached until the account changes: the key has Account.version, which each transaction of the account increases, so a cached page is never stale and we never need to delete one.
+    A cached page costs 1 query (the account)
+    """
+    account = get_object_or_404(Account.objects.with_shards(), number=number)
+    # ?before=<transaction id> shows the page of older transactions, ?after=<id> the newer ones
+    cursor_ids = dict((direction, request.GET[direction]) for direction in ('before', 'after') if request.GET.get(direction, '').isdigit())
+    key = 'account-page:%s:%s:%s' % (account_version_key(account), cursor_ids.get('before', ''), cursor_ids.get('after', ''))
+    cache = caches[settings.ACCOUNT_PAGE_CACHE]
+    content = cache.get(key)
+    if content is None:
+        content = render_account_page(request, account, cursor_ids).content
+        cache.set(key, content, settings.ACCOUNT_PAGE_CACHE_TTL)
+    return HttpResponse(content)
+
+def render_account_page(request, account, cursor_ids):
+    cursors = {}
+    for direction, tr_id in cursor_ids.items():
+        cursors[direction] = Transaction.objects.filter(pk=tr_id).only('id', 'date').first()
+    trans, there_are_older, there_are_newer = history_page(account, **cursors)
 
-    # Extend transaction history with partial balances (i.e. how much do we have after each operation). This is fast if there are few transactions. See the comment en models.Account.balance about how to improve/avoid this real-time calculation
-    #trans[0].partialbalance=51
+    # Show the change and the balance after each operation. The balance was stored when the transaction was saved, so we don't need to recompute it from the beginning
     amounts_columns=[]
-    accum=0
-    for tr in trans.all():
-        if tr.op_type=='tra' and tr.source_acc==account:
-            change = -tr.source_amount
-        elif tr.op_type=='tra' and tr.dest_acc==account:
-            change = + tr.dest_amount
-        elif tr.op_type=='wd':
-            change = - tr.source_amount
-        elif tr.op_type=='dep':
-            change = + tr.dest_amount
+    for tr in trans:
+        if tr.source_acc_id==account.id:
+            amounts_columns.append({'change': -tr.source_amount, 'accum': tr.source_balance_after})
+        elif tr.dest_acc_id==account.id:
+            amounts_columns.append({'change': tr.dest_amount, 'accum': tr.dest_balance_after})
         else:
             raise NotImplementedError(tr.op_type)
-        accum+=change
-        amounts_columns.append({'change':change,'accum':accum})
-
-    # Now that we we're here…
-    if accum != account.balance:
-        raise Exception("Some past operation didn't update the balance, and now reconstructing the transaction history doesn't produce the current balance. Check code. %f vs %f"%(accum,account.balance))
-    #partialbalances=[51,1,51,35,53,56]
 
+    # Now that we we're here… The last stored balance must be the current one (not for sharded accounts: concurrent credits can be missing from their stored balances, see AccountBalanceShard)
+    if trans and not there_are_newer and not account.shard_count and amounts_columns[-1]['accum'] != account.current_balance:
+        raise Exception("Some past operation didn't update the balance, and now the balance after the last transaction isn't the current balance. Check code. %f vs %f"%(amounts_columns[-1]['accum'],account.current_balance))
 
     return render(request, 'accounts/account_details.html', {
         'account': account,
-        #'transactions': trans,
         # This zip() will allow us to consume two lists at the same time in the template
-        'transactions_and_amountscolumns': zip(trans,amounts_columns),
+        'transactions_and_amountscolumns': list(zip(trans,amounts_columns)),
+        'older_cursor': trans[0].id if trans and there_are_older else None,
+        'newer_cursor': trans[-1].id if trans and there_are_newer else None,
     })
+
+@read_from_replica()
+def account_statement(request, number):
+    """
+    The transactions of the account with the balance after each one, as CSV (?format=csv, default) or JSON lines (?format=jsonl). Optional date range (both days included): ?start=2017-06-01&end=2017-06-30
+    The response is streamed while the history is read in chunks, so it works for any length of history
+    """
+    account = get_object_or_404(Account, number=number)
+    if request.GET.get('format', 'csv') not in STATEMENT_FORMATS:
+        return HttpResponseBadRequest("Formats: %s" % ", ".join(sorted(STATEMENT_FORMATS)))
+    content_type, extension, lines = STATEMENT_FORMATS[request.GET.get('format', 'csv')]
+    try:
+        start = parse_day(request.GET.get('start'))
+        end = parse_day(request.GET.get('end'), next_day=True)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    # The rows are read after we return, while the response is sent
+    response = StreamingHttpResponse(lines(replica_iterator(statement_rows(account, start, end))), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="statement-%i.%s"' % (account.number, extension)
+    return response
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'accounts.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -75,12 +76,19 @@ WSGI_APPLICATION = 'f4y.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
 
+# Chosen with environment variables (URL formats in f4y/databases.py):
+# DATABASE_URL: the main database. Default: SQLite in db.sqlite3, in WAL mode, waiting up to 20 s for the write lock
+# DATABASE_CONN_MAX_AGE: seconds each process/thread keeps its connection for the next requests. Default 60; 0 opens 1 connection per request. For many processes on PostgreSQL, put PgBouncer (transaction pooling) between them and the database
+# DATABASE_REPLICA_URL: optional read replica, used by the HTML pages and statements (see accounts/routers.py)
+from f4y.databases import database_config
+
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+    'default': database_config(os.environ.get('DATABASE_URL', 'sqlite:///db.sqlite3'), BASE_DIR, DATABASE_CONN_MAX_AGE),
 }
+if os.environ.get('DATABASE_REPLICA_URL'):
+    DATABASES['replica'] = database_config(os.environ['DATABASE_REPLICA_URL'], BASE_DIR, DATABASE_CONN_MAX_AGE, test_mirror='default')
+DATABASE_ROUTERS = ['accounts.routers.ReplicaRouter']
 
 
 # Password validation
@@ -120,3 +128,58 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Currency rates. See accounts/currency.py
+# Provider used by requests: accounts.currency.DatabaseRateProvider (latest rates in the CurrencyRate table), accounts.currency.FixerRateProvider (remote API) or accounts.currency.FileRateProvider (reads CURRENCY_RATE_FILE, works offline)
+CURRENCY_RATE_PROVIDER = 'accounts.currency.DatabaseRateProvider'
+# Provider from which ./manage.py refresh_currency_rates fills the CurrencyRate table. Run it periodically (e.g. with --loop)
+CURRENCY_RATE_SOURCE_PROVIDER = 'accounts.currency.FixerRateProvider'
+CURRENCY_RATE_REFRESH_INTERVAL = 10*60 # seconds, for refresh_currency_rates --loop
+CURRENCY_RATE_FILE = os.path.join(BASE_DIR, 'accounts', 'data', 'currency_rates.json')
+CURRENCY_RATE_TTL = 60 # seconds. Fetched rates are used as they are during this time. Reading them from the DB is cheap, so it's short: new rates are used soon after they are stored
+CURRENCY_RATE_STALE_TTL = 24*60*60 # seconds. After CURRENCY_RATE_TTL, old rates are still served during this time while new ones are fetched in background
+CURRENCY_RATE_CACHE = 'default' # Django cache shared by all processes. Configure CACHES (e.g. memcached) so that it's really shared
+
+# API keys which were valid are remembered (see accounts/authentication.py): how many users, and for how long (seconds). Changes to keys/users made in other processes are seen after this time at most
+API_KEY_CACHE_SIZE = 10000
+API_KEY_CACHE_TTL = 60
+API_KEY_CACHE = None # Django cache alias to share them between processes too, e.g. 'default'. None: only in each process
+
+# Responses to POST /api/transactions/ with an Idempotency-Key header are kept this long (seconds) to answer retries. ./manage.py purge_idempotency_keys deletes older ones
+IDEMPOTENCY_KEY_TTL = 24*60*60
+
+# The account pages (and the accounts in the list) are cached in this Django cache until the account changes (see views.account_and_transactions). The TTL only frees space
+ACCOUNT_PAGE_CACHE = 'default'
+ACCOUNT_PAGE_CACHE_TTL = 24*60*60
+
+# update_daily_summaries only reads transactions created at least this long ago (seconds), so that it never skips one which was still being saved
+DAILY_SUMMARY_SETTLE_SECONDS = 60
+
+# Instrumentation of requests, see accounts/instrumentation.py
+SERVER_TIMING_HEADER = True # add timings of each request in the Server-Timing header
+METRICS_ALLOWED_IPS = ['127.0.0.1'] # who can read /metrics (as seen in REMOTE_ADDR; with a proxy in front, the proxy's IP)
+PROFILE_SAMPLE_RATE = 0 # fraction of requests run with cProfile, e.g. 0.01. 0 = never
+PROFILE_SLOW_REQUEST_MS = 500 # profiles of sampled requests slower than this are saved in PROFILE_DIR
+PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+
+# POST /api/transactions/ and /api/accounts/ (1 object, JSON, no Idempotency-Key) are answered without tastypie, see accounts/fastpath.py. Same requests and responses, less CPU
+API_FAST_PATH = True
+
+# Asynchronous mode: POST /api/transactions/ only queues the transaction (answering 202 and a status URL), and the process_transaction_queue command posts the queue in batches of TRANSACTION_QUEUE_BATCH_SIZE, 1 DB transaction each. When the queue is empty, it looks again after TRANSACTION_QUEUE_POLL_INTERVAL seconds. See accounts/transaction_queue.py
+TRANSACTION_QUEUE = False
+TRANSACTION_QUEUE_BATCH_SIZE = 500
+TRANSACTION_QUEUE_POLL_INTERVAL = 0.2
+
+# Busy accounts can have balance shards (./manage.py compact_balance_shards <number> --shards 8): their credits go to 1 of several rows, so they don't wait for each other. compact_balance_shards --loop moves the shards into the balance every BALANCE_SHARD_COMPACTION_INTERVAL seconds. See models.AccountBalanceShard
+BALANCE_SHARD_COMPACTION_INTERVAL = 60
+
+# Max. number of elements accepted by POST /api/transactions/batch/ and /api/accounts/batch/
+API_BATCH_MAX_SIZE = 10000
+
+# Rows per page of GET /api/accounts/ and /api/transactions/ (?limit= can ask for up to API_READ_MAX_PAGE_SIZE)
+API_READ_PAGE_SIZE = 50
+API_READ_MAX_PAGE_SIZE = 500
+
+# Account numbers are reserved from the DB in blocks of this size, and each process hands them out from memory. 1 gives consecutive numbers; bigger blocks need fewer queries but leave gaps (unused numbers of a block are lost when the process ends). See models.allocate_account_numbers
+ACCOUNT_NUMBER_BLOCK_SIZE = 1
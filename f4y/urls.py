@@ -16,7 +16,10 @@ Including another URLconf
 from django.conf.urls import url, include
 from django.contrib import admin
 from accounts.api import AccountResource, TransactionResource
-from accounts.views import AccountListView, account_and_transactions
+from accounts.fastpath import fast_accounts_view, fast_transactions_view
+from accounts.instrumentation import metrics_view
+from accounts.routers import read_from_replica
+from accounts.views import AccountListView, account_and_transactions, account_statement
 
 account_resource = AccountResource()
 transaction_resource = TransactionResource()
@@ -24,9 +27,14 @@ transaction_resource = TransactionResource()
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
 
+    # POST of 1 account/transaction, without tastypie if API_FAST_PATH (see accounts/fastpath.py). Other requests to these URLs go to the resources. Same name and kwargs as tastypie's URLs, for reverse() and the metrics
+    url(r'^api/(?P<resource_name>accounts)/$', fast_accounts_view(account_resource), name='api_dispatch_list'),
+    url(r'^api/(?P<resource_name>transactions)/$', fast_transactions_view(transaction_resource), name='api_dispatch_list'),
     url(r'^api/', include(account_resource.urls)),
     url(r'^api/', include(transaction_resource.urls)),
 
-    url(r'^$', AccountListView.as_view(), name='account-list'),
+    url(r'^$', read_from_replica()(AccountListView.as_view()), name='account-list'),
     url(r'^account/(?P<number>\d{8})/$', account_and_transactions, name='account-detail'),
+    url(r'^account/(?P<number>\d{8})/statement/$', account_statement, name='account-statement'),
+    url(r'^metrics$', metrics_view, name='metrics'),
 ]
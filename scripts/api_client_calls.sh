@@ -9,6 +9,9 @@ echo "(if it fails, create ApiKey in admin)"
 # dc is my user
 curl --dump-header - -H "Content-Type: application/json" -H "Authorization: ApiKey dc:password_set_in_admin" -X POST --data '{"currency": "CHF" }' 'http://localhost:8000/api/accounts/?format=json'
 
+echo "Creating many accounts at once:"
+curl --dump-header - -H "Content-Type: application/json" -H "Authorization: ApiKey dc:password_set_in_admin" -X POST --data '{"accounts": [{"currency": "CHF" }, {"currency": "EUR" }]}' 'http://localhost:8000/api/accounts/batch/?format=json'
+
 echo "Press enter to continue creating transactions"
 read continue
 
@@ -16,7 +19,18 @@ echo "Creating transactions:"
 #  curl --dump-header - -H "Content-Type: application/json" -H "Authorization: ApiKey dc:password_set_in_admin" -X POST --data '{"destAccount": "12355565", "sourceAccount": null }' 'http://localhost:8000/api/transactions/?format=json'
 echo Deposit:
 curl --dump-header - -H "Content-Type: application/json" -H "Authorization: ApiKey dc:password_set_in_admin" -X POST --data '{"destAccount": "12355566", "sourceAccount": null, "amount": 51 }' 'http://localhost:8000/api/transactions/?format=json'
+echo "Deposit that can be retried safely (the same Idempotency-Key returns the first response again):"
+curl --dump-header - -H "Content-Type: application/json" -H "Authorization: ApiKey dc:password_set_in_admin" -H "Idempotency-Key: deposit-2017-06-02-001" -X POST --data '{"destAccount": "12355566", "sourceAccount": null, "amount": 51 }' 'http://localhost:8000/api/transactions/?format=json'
 echo Transfer:
 curl --dump-header - -H "Content-Type: application/json" -H "Authorization: ApiKey dc:password_set_in_admin" -X POST --data '{"destAccount": "12355565", "sourceAccount": "12355565", "amount": 51 }' 'http://localhost:8000/api/transactions/?format=json'
 echo Withdrawal:
 curl --dump-header - -H "Content-Type: application/json" -H "Authorization: ApiKey dc:password_set_in_admin" -X POST --data '{"destAccount": null, "sourceAccount": "12355565", "amount": 51 }' 'http://localhost:8000/api/transactions/?format=json'
+echo "Many operations at once (add \"atomic\": false to save the valid ones even if others fail):"
+curl --dump-header - -H "Content-Type: application/json" -H "Authorization: ApiKey dc:password_set_in_admin" -X POST --data '{"transactions": [{"destAccount": "12355566", "sourceAccount": null, "amount": 51 }, {"destAccount": null, "sourceAccount": "12355566", "amount": 1 }]}' 'http://localhost:8000/api/transactions/batch/?format=json'
+
+echo "Reading: balances of some accounts, and the latest transactions of 1 account (follow \"next\" for more):"
+curl --dump-header - -H "Authorization: ApiKey dc:password_set_in_admin" 'http://localhost:8000/api/accounts/?fields=accountNumber,balance&format=json'
+curl --dump-header - -H "Authorization: ApiKey dc:password_set_in_admin" 'http://localhost:8000/api/transactions/?account=12355565&since=2017-06-01&format=json'
+
+echo "Status of a transaction sent in asynchronous mode (TRANSACTION_QUEUE = True; the URL is in the Location header of the POST):"
+curl --dump-header - -H "Authorization: ApiKey dc:password_set_in_admin" 'http://localhost:8000/api/transactions/queue/1/?format=json'
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Load test of the accounts API: replays a mix of deposits, withdrawals and transfers against POST /api/transactions/ and measures throughput, latency (p50/p99) and DB queries per request.
+It runs in a scratch SQLite database, with rates from accounts/data/currency_rates.json (FileRateProvider), so results don't depend on the network. Two modes:
+- client: Django's test client, in this process. Shows the cost of our code
+- wsgi: a real HTTP server (wsgiref, with f4y/wsgi.py) in a thread of this process, and HTTP clients in --concurrency threads
+
+Results are saved as JSON (with the git commit), so that runs of different commits can be compared:
+
+  python3 scripts/bench_api.py --output /tmp/before.json
+  (change code)
+  python3 scripts/bench_api.py --output /tmp/after.json --compare /tmp/before.json
+"""
+import argparse
+import datetime
+import http.client
+import json
+import random
+import threading
+import time
+from decimal import Decimal
+
+from benchlib import setup_django, percentile, git_commit
+
+USERNAME = 'benchuser'
+INITIAL_BALANCE = Decimal(10**6)
+
+
+def seed(n_accounts):
+    """Create the accounts (all currencies, in turns), each one with money, and a user with an API key. Returns (list of account numbers, API key)"""
+    from django.contrib.auth.models import User
+    from django.utils import timezone
+    from tastypie.models import ApiKey
+    from accounts.models import Account, Transaction, ALLOWED_CURRENCIES, allocate_account_numbers, bulk_create_accounts, post_transactions
+
+    currencies = [code for code, name in ALLOWED_CURRENCIES]
+    accounts = [Account(currency=currencies[i % len(currencies)]) for i in range(n_accounts)]
+    for account, number in zip(accounts, allocate_account_numbers(n_accounts)):
+        account.number = number
+    bulk_create_accounts(accounts)
+    post_transactions([Transaction(op_type='dep', dest_acc=acc, dest_amount=INITIAL_BALANCE, date=timezone.now()) for acc in accounts])
+    user = User.objects.create_user(USERNAME, password='x')
+    return [acc.number for acc in accounts], ApiKey.objects.create(user=user).key
+
+
+def parse_mix(text):
+    """"deposit=2,withdrawal=1,transfer=5" → {'deposit': 2, …}"""
+    mix = {}
+    for part in text.split(','):
+        name, weight = part.split('=')
+        if name not in ('deposit', 'withdrawal', 'transfer'):
+            raise ValueError("Unknown operation %s" % name)
+        mix[name] = float(weight)
+    return mix
+
+
+def operations(numbers, mix, count, seed_value):
+    """The JSON bodies to send, always the same for the same arguments"""
+    rnd = random.Random(seed_value)
+    names = sorted(mix)
+    bodies = []
+    for name in rnd.choices(names, weights=[mix[n] for n in names], k=count):
+        amount = str(rnd.randint(1, 100))
+        if name == 'deposit':
+            data = {'sourceAccount': None, 'destAccount': str(rnd.choice(numbers)), 'amount': amount}
+        elif name == 'withdrawal':
+            data = {'sourceAccount': str(rnd.choice(numbers)), 'destAccount': None, 'amount': amount}
+        else:
+            source, dest = rnd.sample(numbers, 2)
+            data = {'sourceAccount': str(source), 'destAccount': str(dest), 'amount': amount}
+        bodies.append(json.dumps(data))
+    return bodies
+
+
+def summary(latencies, queries, statuses, seconds):
+    """Results of a run, in a JSON-friendly dict. Times in ms"""
+    return {
+        'requests': len(latencies),
+        'seconds': round(seconds, 3),
+        'throughput': round(len(latencies) / seconds, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3),
+        'queries_per_request': round(sum(queries) / float(len(queries)), 2) if queries else None,
+        'statuses': dict((str(k), statuses.count(k)) for k in sorted(set(statuses))),
+    }
+
+
+def run_client(bodies, api_key):
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    client = Client(HTTP_AUTHORIZATION='ApiKey %s:%s' % (USERNAME, api_key))
+    latencies, queries, statuses = [], [], []
+    start = time.perf_counter()
+    for body in bodies:
+        with CaptureQueriesContext(connection) as captured:
+            t = time.perf_counter()
+            response = client.post('/api/transactions/', body, content_type='application/json')
+            latencies.append(time.perf_counter() - t)
+        queries.append(len(captured))
+        statuses.append(response.status_code)
+    return summary(latencies, queries, statuses, time.perf_counter() - start)
+
+
+def start_server(queries):
+    """Serve f4y/wsgi.py on a free port, in a background thread (and 1 thread per request). The queries of each request are appended to "queries". Returns the server"""
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from f4y.wsgi import application
+
+    def counting_application(environ, start_response):
+        with CaptureQueriesContext(connection) as captured:
+            body = b''.join(application(environ, start_response))
+        queries.append(len(captured))
+        connection.close() # each request runs in a new thread
+        return [body]
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', 0, counting_application, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_wsgi(bodies, api_key, concurrency):
+    queries = []
+    server = start_server(queries)
+    headers = {'Content-Type': 'application/json', 'Authorization': 'ApiKey %s:%s' % (USERNAME, api_key)}
+    latencies, statuses = [], []
+    lock = threading.Lock()
+
+    def worker(my_bodies):
+        for body in my_bodies:
+            t = time.perf_counter()
+            conn = http.client.HTTPConnection('127.0.0.1', server.server_port)
+            conn.request('POST', '/api/transactions/', body, headers)
+            status = conn.getresponse().status
+            conn.close()
+            with lock:
+                latencies.append(time.perf_counter() - t)
+                statuses.append(status)
+
+    threads = [threading.Thread(target=worker, args=(bodies[i::concurrency],)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - start
+    server.shutdown()
+    return summary(latencies, queries, statuses, seconds)
+
+
+def compare(results, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print("\nCompared with %s (commit %s):" % (previous_path, previous.get('commit')))
+    for mode, current in results['modes'].items():
+        old = previous['modes'].get(mode)
+        if not old:
+            continue
+        for key in ('throughput', 'p50_ms', 'p99_ms', 'queries_per_request'):
+            if old.get(key) and current.get(key) is not None:
+                print("  %-6s %-20s %10s -> %-10s (%+.1f%%)" % (mode, key, old[key], current[key], (current[key] - old[key]) * 100.0 / old[key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--accounts', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--mix', default='deposit=2,withdrawal=1,transfer=5', help="Relative weights of each operation")
+    parser.add_argument('--mode', choices=['client', 'wsgi', 'both'], default='both')
+    parser.add_argument('--concurrency', type=int, default=1, help="Client threads in wsgi mode. SQLite runs 1 writing request at a time, the others wait for it (see accounts/backends/sqlite3)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', default='/tmp/bench_api.sqlite3')
+    parser.add_argument('--output', help="Save the results to this JSON file")
+    parser.add_argument('--compare', help="JSON file of a previous run, to show the differences")
+    args = parser.parse_args()
+
+    setup_django(args.db, DEBUG=False, ALLOWED_HOSTS=['*'], CURRENCY_RATE_PROVIDER='accounts.currency.FileRateProvider')
+    print("Seeding %i accounts..." % args.accounts)
+    numbers, api_key = seed(args.accounts)
+    bodies = operations(numbers, parse_mix(args.mix), args.requests, args.seed)
+
+    results = {
+        'commit': git_commit(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'arguments': vars(args),
+        'modes': {},
+    }
+    if args.mode in ('client', 'both'):
+        results['modes']['client'] = run_client(bodies, api_key)
+    if args.mode in ('wsgi', 'both'):
+        results['modes']['wsgi'] = run_wsgi(bodies, api_key, args.concurrency)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Benchmark of API authentication: requests/second and queries per request with tastypie's ApiKeyAuthentication and with CachedApiKeyAuthentication (see accounts/authentication.py).
+It uses a scratch SQLite database and Django's test client (no HTTP server), so the numbers show only the cost inside Django.
+
+  python3 scripts/bench_auth.py [--requests 2000] [--db /tmp/bench_auth.sqlite3]
+"""
+import argparse
+import json
+
+from benchlib import setup_django, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--db', default='/tmp/bench_auth.sqlite3')
+    args = parser.parse_args()
+
+    setup_django(args.db, ALLOWED_HOSTS=['testserver'], CURRENCY_RATE_PROVIDER='accounts.currency.FileRateProvider')
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+    from tastypie.authentication import ApiKeyAuthentication
+    from tastypie.models import ApiKey
+    from accounts.api import AccountResource, TransactionResource
+    from accounts.authentication import CachedApiKeyAuthentication
+    from accounts.models import Account
+
+    user = User.objects.create_user('benchuser', password='x')
+    api_key = ApiKey.objects.create(user=user)
+    account = Account.objects.create(currency='EUR')
+    client = Client(HTTP_AUTHORIZATION='ApiKey benchuser:%s' % api_key.key)
+    deposit = json.dumps({'sourceAccount': None, 'destAccount': str(account.number), 'amount': '1'})
+    # Invalid data: the request stops after authentication and validation, so that's almost all it costs
+    invalid = json.dumps({'currency': 'XXX'})
+    cases = [
+        ("deposit", lambda: client.post('/api/transactions/', deposit, content_type='application/json')),
+        ("rejected account creation", lambda: client.post('/api/accounts/', invalid, content_type='application/json')),
+    ]
+
+    for auth_class in (ApiKeyAuthentication, CachedApiKeyAuthentication):
+        # The resources are already built (by the URLs); change their authentication
+        AccountResource._meta.authentication = TransactionResource._meta.authentication = auth_class()
+        print("\n=== %s ===" % auth_class.__name__)
+        for name, request in cases:
+            request() # warm up caches
+            with CaptureQueriesContext(connection) as queries:
+                seconds, response = timed(request, args.requests)
+            assert response.status_code in (201, 400), response.content
+            print("%-28s %8.0f requests/s  %5.2f queries/request" % (name, 1 / seconds, len(queries) / float(args.requests)))
+
+
+if __name__ == '__main__':
+    main()
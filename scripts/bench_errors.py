@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks of the API error path (see accounts/errors.py):
+- finding the code of an error message: the old linear scan of ERROR_CODES with regexes, and the current lookup
+- whole rejected requests (invalid input, unknown account, negative balance), with Django's test client in a scratch SQLite database
+
+  python3 scripts/bench_errors.py [--lookups 200000] [--requests 2000] [--db /tmp/bench_errors.sqlite3]
+"""
+import argparse
+import json
+import re
+
+from benchlib import setup_django, timed
+
+
+def linear_lookup(errors, error_codes):
+    """How extract_error_code_from_bundle used to find codes; kept here for comparison"""
+    for key in ('transactions', 'accounts', 'error'):
+        if key in errors:
+            errors = errors[key]
+            break
+    if isinstance(errors, dict):
+        error_msg = next(iter(errors.values()))
+    else:
+        error_msg = re.sub("^\['", "", errors)
+        error_msg = re.sub("'\]$", "", error_msg)
+    codes = [k for k, v in error_codes.items() if v == error_msg]
+    return codes[0]
+
+
+def bench_lookups(n):
+    from accounts.api import extract_error_code_from_bundle
+    from accounts.errors import ERROR_CODES, ApiError
+    # As the code produced them before (plain messages), and now
+    messages = [
+        {'transactions': {'amount': "Missing amount"}},
+        {'destAccount': "Account doesn't exist"},
+        {'error': "['Source account would have negative balance']"},
+    ]
+    api_errors = [
+        {'transactions': {'amount': ApiError('m_am')}},
+        {'destAccount': ApiError('nf_acc')},
+        {'error': ApiError('z_srcacc')},
+    ]
+    print("=== code of an error message (%i lookups) ===" % n)
+    cases = [
+        ("linear scan + regex", messages, lambda e: linear_lookup(e, ERROR_CODES)),
+        ("index, plain messages", messages, extract_error_code_from_bundle),
+        ("ApiError messages", api_errors, extract_error_code_from_bundle),
+    ]
+    for name, samples, func in cases:
+        seconds, result = timed(lambda: [func(samples[i % 3]) for i in range(n)])
+        print("%-32s %8.3f us/lookup" % (name, seconds * 1e6 / n))
+
+
+def bench_requests(n):
+    from django.contrib.auth.models import User
+    from django.test import Client
+    from django.utils import timezone
+    from tastypie.models import ApiKey
+    from accounts.models import Account, Transaction
+
+    user = User.objects.create_user('benchuser', password='x')
+    client = Client(HTTP_AUTHORIZATION='ApiKey benchuser:%s' % ApiKey.objects.create(user=user).key)
+    account = Account.objects.create(currency='EUR')
+    Transaction(op_type='dep', dest_acc=account, dest_amount=1, date=timezone.now()).save()
+    cases = [
+        ("invalid input", {'sourceAccount': None, 'destAccount': str(account.number)}, 'm_am'),
+        ("unknown account", {'sourceAccount': None, 'destAccount': '99999999', 'amount': '1'}, 'nf_acc'),
+        ("negative balance", {'sourceAccount': str(account.number), 'destAccount': None, 'amount': '5'}, 'z_srcacc'),
+    ]
+    print("\n=== rejected POST /api/transactions/ (%i requests each) ===" % n)
+    for name, data, code in cases:
+        body = json.dumps(data)
+        request = lambda: client.post('/api/transactions/', body, content_type='application/json')
+        assert json.loads(request().content.decode('utf-8'))['code'] == code
+        seconds, response = timed(request, n)
+        print("%-32s %8.3f ms/request" % (name, seconds * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lookups', type=int, default=200000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--db', default='/tmp/bench_errors.sqlite3')
+    args = parser.parse_args()
+
+    setup_django(args.db, ALLOWED_HOSTS=['testserver'])
+    bench_lookups(args.lookups)
+    bench_requests(args.requests)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+POST /api/transactions/ and /api/accounts/ through tastypie and through the fast path (accounts/fastpath.py), side by side, with Django's test client in a scratch SQLite database.
+For each: CPU time per request (process time, which includes SQLite's work, the same in both), wall time, and the peak of memory allocated by Python during a request (tracemalloc, measured in a separate run because it slows everything down).
+
+  python3 scripts/bench_fastpath.py [--requests 2000] [--db /tmp/bench_fastpath.sqlite3]
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from benchlib import setup_django, git_commit
+
+
+def run(client, url, bodies):
+    """(CPU seconds, wall seconds) for POSTing all the bodies"""
+    cpu, wall = time.process_time(), time.perf_counter()
+    for body in bodies:
+        response = client.post(url, body, content_type='application/json')
+        assert response.status_code == 201, response.content
+    return time.process_time() - cpu, time.perf_counter() - wall
+
+def peak_allocation(client, url, bodies):
+    """Average peak of traced memory during a request, in bytes"""
+    peaks = []
+    tracemalloc.start()
+    try:
+        for body in bodies:
+            tracemalloc.clear_traces() # also resets the peak
+            client.post(url, body, content_type='application/json')
+            peaks.append(tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+    return sum(peaks) / len(peaks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--db', default='/tmp/bench_fastpath.sqlite3')
+    args = parser.parse_args()
+
+    setup_django(args.db, ALLOWED_HOSTS=['testserver'], SERVER_TIMING_HEADER=False)
+    from django.contrib.auth.models import User
+    from django.test import Client, override_settings
+    from django.utils import timezone
+    from tastypie.models import ApiKey
+    from accounts.models import Account, Transaction
+
+    user = User.objects.create_user('benchuser', password='x')
+    client = Client(HTTP_AUTHORIZATION='ApiKey benchuser:%s' % ApiKey.objects.create(user=user).key)
+    source, dest = Account.objects.create(currency='EUR'), Account.objects.create(currency='EUR')
+    Transaction(op_type='dep', dest_acc=source, dest_amount=10**9, date=timezone.now()).save()
+    cases = [
+        ("transfer", '/api/transactions/', json.dumps({'sourceAccount': str(source.number), 'destAccount': str(dest.number), 'amount': '1.5'})),
+        ("new account", '/api/accounts/', json.dumps({'currency': 'EUR'})),
+    ]
+
+    print("commit %s, %i requests per case" % (git_commit(), args.requests))
+    print("%-12s %-9s %10s %10s %12s" % ("", "path", "CPU ms/req", "wall ms/req", "peak KB/req"))
+    for name, url, body in cases:
+        bodies = [body] * args.requests
+        for fast in (False, True):
+            with override_settings(API_FAST_PATH=fast):
+                run(client, url, bodies[:50]) # warm-up
+                cpu, wall = run(client, url, bodies)
+                peak = peak_allocation(client, url, bodies[:200])
+            print("%-12s %-9s %10.3f %10.3f %12.1f" % (name, "fast" if fast else "tastypie", cpu * 1000 / args.requests, wall * 1000 / args.requests, peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
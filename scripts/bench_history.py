@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the account history queries (see models.history_page), before and after the (account, date) indexes of migration 0007.
+It seeds a scratch SQLite database with many transactions (1 million by default), and for each case it prints the query plan and the time.
+
+  python3 scripts/bench_history.py [--transactions 1000000] [--accounts 1000] [--db /tmp/bench_history.sqlite3]
+"""
+import argparse
+import datetime
+import random
+
+from benchlib import setup_django, timed
+
+
+def seed(n_transactions, n_accounts):
+    """Insert accounts and transactions directly with executemany; going through Transaction.save would take hours"""
+    from django.db import connection, transaction
+    from django.utils import timezone
+    from accounts.models import Account, Transaction
+
+    Account.objects.bulk_create([Account(number=10**7 + i, currency='EUR', balance=0) for i in range(n_accounts)])
+    account_ids = list(Account.objects.values_list('id', flat=True))
+    start = timezone.now() - datetime.timedelta(days=365)
+    table = Transaction._meta.db_table
+    sql = "INSERT INTO %s (date, creation_date, op_type, source_acc_id, dest_acc_id, source_amount, dest_amount) VALUES (%%s, %%s, 'tra', %%s, %%s, 1, 1)" % table
+    random.seed(1)
+    chunk = 20000
+    with transaction.atomic(), connection.cursor() as cursor:
+        for first in range(0, n_transactions, chunk):
+            rows = []
+            for i in range(first, min(first + chunk, n_transactions)):
+                date = connection.ops.adapt_datetimefield_value(start + datetime.timedelta(seconds=i * 30))
+                source, dest = random.sample(account_ids, 2)
+                rows.append((date, date, source, dest))
+            cursor.executemany(sql, rows)
+    return Account.objects.get(id=account_ids[0])
+
+
+def query_plan(sql, params):
+    from django.db import connection
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def run_cases(account, label, repeat):
+    """Time the old queries (OR + sort) and the new one (UNION of 2 index scans)"""
+    from django.db import connection
+    from django.db.models import Q
+    from django.test.utils import CaptureQueriesContext
+    from accounts.models import Transaction, history_ids
+
+    old_query = Transaction.objects.filter(Q(source_acc=account)|Q(dest_acc=account))
+    cases = [
+        ("whole history, as the old view did", lambda: list(old_query.order_by('date'))),
+        ("latest page with OR", lambda: list(old_query.order_by('-date', '-id').values_list('id', flat=True)[:50])),
+        ("latest page with UNION (history_ids)", lambda: history_ids(account, size=50)),
+    ]
+    print("\n=== %s ===" % label)
+    for name, func in cases:
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        # The SQL of captured queries has the parameters already inlined
+        plan = query_plan(queries.captured_queries[-1]['sql'], [])
+        seconds, result = timed(func, repeat)
+        print("%-40s %9.2f ms  (%i rows)" % (name, seconds * 1000, len(result)))
+        for line in plan:
+            print("    plan: %s" % line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transactions', type=int, default=1000000)
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--db', default='/tmp/bench_history.sqlite3')
+    args = parser.parse_args()
+
+    setup_django(args.db)
+    from django.core.management import call_command
+
+    print("Seeding %i transactions between %i accounts..." % (args.transactions, args.accounts))
+    account = seed(args.transactions, args.accounts)
+
+    call_command('migrate', 'accounts', '0006', verbosity=0)
+    run_cases(account, "without (account, date) indexes", args.repeat)
+    call_command('migrate', 'accounts', verbosity=0)
+    run_cases(account, "with (account, date) indexes", args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of the money handling of a transfer between currencies (see accounts/money.py): reading the amount from the input, converting it with the rate and rounding both amounts, as the code did before and as it does now.
+It also counts how many results of the old way differ from the exact ones (float input, double rounding).
+
+  python3 scripts/bench_money.py [--operations 200000]
+"""
+import argparse
+import random
+import sys
+from decimal import Decimal
+
+from benchlib import BASE_DIR, timed
+
+sys.path.insert(0, BASE_DIR)
+from accounts.money import parse_amount, convert, quantize_money, quantize_rate
+
+
+def old_transfer(amount, rate):
+    """What TransactionInputValidation, hydrate_transaction and Transaction.save used to do; kept here for comparison"""
+    if not isinstance(amount, (float, int)) and not amount.replace('.', '', 1).isdigit():
+        return None
+    amount = Decimal(amount)
+    dest_amount = amount * rate
+    return Decimal(amount).quantize(Decimal(1).scaleb(-5)), Decimal(dest_amount).quantize(Decimal(1).scaleb(-5))
+
+def new_transfer(amount, rate):
+    amount = parse_amount(amount) # validation, which gives the Decimal to hydrate_transaction
+    if amount is None:
+        return None
+    dest_amount = convert(amount, rate)
+    return quantize_money(amount), quantize_money(dest_amount) # Transaction.save
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--operations', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rate = quantize_rate('1.1217')
+    samples = {
+        'string amounts': ['%i.%02i' % (rng.randint(1, 10**6), rng.randint(0, 99)) for i in range(1000)],
+        'JSON float amounts': [rng.randint(1, 10**6) + rng.randint(0, 99) / 100.0 for i in range(1000)],
+    }
+    print("=== transfer with currency change: parse, convert, round (%i operations) ===" % args.operations)
+    for name, amounts in samples.items():
+        for label, func in (("before", old_transfer), ("money.py", new_transfer)):
+            seconds, result = timed(lambda: [func(amounts[i % len(amounts)], rate) for i in range(args.operations)])
+            print("%-20s %-10s %8.3f us/operation" % (name, label, seconds * 1e6 / args.operations))
+        # exact: the amount as written, times the rate, rounded half-even once
+        different = sum(1 for a in amounts if old_transfer(a, rate) != new_transfer(a, rate))
+        print("%-20s %i of %i results differ between both" % (name, different, len(amounts)))
+
+
+if __name__ == '__main__':
+    main()
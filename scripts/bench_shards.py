@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Contention on 1 busy account: many threads post deposits to the same account (and, every --debit-every operations, a withdrawal from it) at the same time, first with the account as a single row, then with balance shards (see AccountBalanceShard).
+For each: transactions per second and p50/p99 latency, and a check that the final balance is the sum of what was posted.
+SQLite lets only 1 DB transaction write at a time, whatever rows it touches, so there shards only add queries (expect them to be slower); the gain is on databases with row locks:
+
+  python3 scripts/bench_shards.py [--threads 16] [--operations 200] [--shards 8] [--database-url postgres://user:pw@localhost/scratch]
+"""
+import argparse
+import threading
+import time
+from decimal import Decimal
+
+from benchlib import setup_django, git_commit, percentile
+
+
+def worker(account_pk, operations, debit_every, latencies, errors):
+    from django.db import connection, OperationalError
+    from django.utils import timezone
+    from accounts.models import Account, Transaction
+    try:
+        account = Account.objects.get(pk=account_pk)
+        for i in range(operations):
+            if debit_every and i % debit_every == debit_every - 1:
+                tr = dict(op_type='wd', source_acc=account, source_amount=Decimal(1))
+            else:
+                tr = dict(op_type='dep', dest_acc=account, dest_amount=Decimal(2))
+            start = time.perf_counter()
+            while True:
+                try:
+                    Transaction(date=timezone.now(), **tr).save()
+                    break
+                except OperationalError:
+                    # SQLite: "database is locked" after the busy timeout. Nothing was saved; try again
+                    time.sleep(0.001)
+            latencies.append(time.perf_counter() - start)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        connection.close()
+
+def run(shards, args):
+    """(transactions/s, p50 s, p99 s) for 1 run with a new account"""
+    from django.db import connection
+    from django.utils import timezone
+    from accounts.models import Account, Transaction
+    from accounts.shards import set_shard_count
+    account = Account.objects.create(currency='EUR')
+    Transaction(op_type='dep', dest_acc=account, dest_amount=Decimal(10**6), date=timezone.now()).save()
+    set_shard_count(account, shards)
+    connection.close() # each thread opens its own
+
+    latencies, errors = [], []
+    threads = [threading.Thread(target=worker, args=(account.pk, args.operations, args.debit_every, latencies, errors)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    assert not errors, errors
+
+    debits = args.operations // args.debit_every if args.debit_every else 0
+    expected = 10**6 + args.threads * ((args.operations - debits) * 2 - debits)
+    assert Account.objects.with_shards().get(pk=account.pk).current_balance == expected
+    return len(latencies) / elapsed, percentile(latencies, 50), percentile(latencies, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--operations', type=int, default=200, help="Per thread")
+    parser.add_argument('--shards', type=int, default=8)
+    parser.add_argument('--debit-every', type=int, default=20, help="1 withdrawal every N operations (0: only deposits)")
+    parser.add_argument('--db', default='/tmp/bench_shards.sqlite3')
+    parser.add_argument('--database-url', help="Use this (empty) database instead of a scratch SQLite file")
+    args = parser.parse_args()
+
+    setup_django(args.db, database_url=args.database_url, SERVER_TIMING_HEADER=False)
+    from django.db import connection
+    print("commit %s, %s, %i threads, %i operations each" % (git_commit(), connection.vendor, args.threads, args.operations))
+    print("%-12s %10s %10s %10s" % ("", "trans/s", "p50 ms", "p99 ms"))
+    for shards in (0, args.shards):
+        rate, p50, p99 = run(shards, args)
+        print("%-12s %10.0f %10.2f %10.2f" % ("%i shards" % shards if shards else "single row", rate, p50 * 1000, p99 * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Common code for the benchmark scripts in this directory.
+They never touch db.sqlite3: each one works in its own scratch SQLite database.
+"""
+import os
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django(db_path, migrate=True, database_url=None, **settings_overrides):
+    """
+    Configure Django with f4y.settings but using the SQLite file db_path (created from scratch), and create the tables.
+    database_url: use that database instead (e.g. a scratch PostgreSQL database, for what depends on row locks). It isn't emptied
+    """
+    sys.path.insert(0, BASE_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'f4y.settings')
+    import django
+    from django.conf import settings
+    if database_url:
+        from f4y.databases import database_config
+        settings.DATABASES['default'] = database_config(database_url, BASE_DIR)
+    else:
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        settings.DATABASES['default']['NAME'] = db_path
+    for name, value in settings_overrides.items():
+        setattr(settings, name, value)
+    django.setup()
+    if migrate:
+        from django.core.management import call_command
+        call_command('migrate', verbosity=0)
+
+
+def timed(func, repeat=1):
+    """Run func() "repeat" times. Returns (seconds per run, result of the last run)"""
+    start = time.perf_counter()
+    for i in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def percentile(values, p):
+    """p-th percentile (0-100) of a list of numbers, by nearest rank"""
+    values = sorted(values)
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+    return values[k]
+
+
+def git_commit():
+    """Short hash of the commit being measured, with "+dirty" if there are uncommitted changes. None outside a git checkout"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BASE_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+dirty' if dirty else '')